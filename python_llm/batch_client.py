@@ -0,0 +1,94 @@
+"""
+ClawDBot – Batch kliens a Python LLM szerver /generate_batch végpontjához
+JSONL fájl (soronként egy GenerateRequest, opcionális "id" mezővel)
+feltöltése egy futó szerverre; az eredmények JSONL-ként, befejezési
+sorrendben érkeznek. A szerver modell- és torch-függőségei nem kellenek.
+
+Példa:
+    python batch_client.py prompts.jsonl -o results.jsonl
+    cat prompts.jsonl | python batch_client.py - > results.jsonl
+"""
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+DEFAULT_URL = os.environ.get("CLAWDBOT_LLM_URL", "http://127.0.0.1:8000")
+
+
+def run_batch_client(url: str, in_path: str, out_path: str, chunk_size: int = 64 * 1024) -> int:
+    """
+    JSONL fájl (vagy stdin) feltöltése chunked kódolással egy külön szálon,
+    miközben az eredmények már érkeznek – a szerver csak akkor olvas tovább,
+    ha a kimenetet elvisszük, így a küldést és a fogadást párhuzamosan kell.
+    """
+    u = urlparse(url)
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80)
+    conn.putrequest("POST", "/generate_batch")
+    conn.putheader("Content-Type", "application/x-ndjson")
+    conn.putheader("Transfer-Encoding", "chunked")
+    conn.endheaders()
+
+    src = sys.stdin.buffer if in_path == "-" else open(in_path, "rb")
+
+    def sender() -> None:
+        try:
+            while chunk := src.read(chunk_size):
+                conn.send(b"%X\r\n%s\r\n" % (len(chunk), chunk))
+            conn.send(b"0\r\n\r\n")
+        except OSError as e:
+            print(f"[FIGYELEM] Feltöltési hiba: {e}", file=sys.stderr)
+
+    threading.Thread(target=sender, name="clawdbot-batch-upload", daemon=True).start()
+
+    t0 = time.perf_counter()
+    ok = failed = 0
+    out = sys.stdout if out_path == "-" else open(out_path, "w", encoding="utf-8")
+    try:
+        resp = conn.getresponse()
+        if resp.status != 200:
+            print(f"[HIBA] HTTP {resp.status}: {resp.read()[:500]!r}", file=sys.stderr)
+            return 1
+        for raw in resp:
+            line = raw.decode("utf-8")
+            out.write(line)
+            if "error" in json.loads(line):
+                failed += 1
+            else:
+                ok += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if src is not sys.stdin.buffer:
+            src.close()
+        conn.close()
+
+    wall = time.perf_counter() - t0
+    print(
+        f"Kész: {ok} sikeres, {failed} hibás sor, {wall:.1f} mp "
+        f"({ok / wall if wall else 0:.2f} kérés/s)",
+        file=sys.stderr,
+    )
+    return 0 if failed == 0 else 2
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="JSONL kérések futtatása egy futó ClawDBot LLM szerveren")
+    ap.add_argument("input", help="JSONL bemenet (soronként egy GenerateRequest, '-' = stdin)")
+    ap.add_argument("-o", "--output", default="-", help="JSONL kimenet (alapból stdout)")
+    ap.add_argument("--url", default=DEFAULT_URL, help="LLM szerver alap URL")
+    return ap.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    return run_batch_client(args.url.rstrip("/"), args.input, args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""
+ClawDBot – Terheléses benchmark a Python LLM szerverhez
+Prompt workload visszajátszása a /generate endpoint ellen (streaming és
+nem streaming módban), konfigurálható párhuzamossággal.
+Eredmény: TTFT, token közti késleltetés, end-to-end p50/p95/p99 és
+aggregált token/s – JSON formátumban.
+
+Példa (GPU nélkül, kis modellel):
+    python bench.py --spawn-server --model sshleifer/tiny-gpt2 --cpu \\
+        --requests 32 --concurrency 4 --max-new-tokens 32
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlparse
+
+DEFAULT_URL = os.environ.get("CLAWDBOT_LLM_URL", "http://127.0.0.1:8000")
+
+# ---------------------------------------------------------------------------
+# Workload
+# ---------------------------------------------------------------------------
+
+_WORDS = (
+    "def class return import python rust async await list dict loop error "
+    "function variable server client token cache batch stream model request"
+).split()
+
+
+def synthetic_prompts(count: int, min_words: int, max_words: int, seed: int) -> list[str]:
+    """Véletlen hosszúságú, kódos szókincsű promptok (reprodukálható seed-del)."""
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(count):
+        n = rng.randint(min_words, max_words)
+        prompts.append("Írj Python kódot: " + " ".join(rng.choice(_WORDS) for _ in range(n)))
+    return prompts
+
+
+def load_prompts(path: str) -> list[str]:
+    """
+    JSONL workload: soronként egy objektum. A prompt a "prompt" mezőből
+    jön; ennek hiányában (pl. requests.jsonl) a "title" + "body" mezőkből.
+    """
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            if "prompt" in obj:
+                prompts.append(obj["prompt"])
+            else:
+                text = "\n\n".join(str(obj[k]) for k in ("title", "body") if obj.get(k))
+                if text:
+                    prompts.append(text)
+    return prompts
+
+
+# ---------------------------------------------------------------------------
+# Egy kérés végrehajtása
+# ---------------------------------------------------------------------------
+
+class _Result:
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.ok = False
+        self.error: Optional[str] = None
+        self.latency = 0.0
+        self.ttft: Optional[float] = None
+        self.inter_token: list[float] = []
+        self.tokens = 0
+
+
+def _connect(url: str) -> http.client.HTTPConnection:
+    u = urlparse(url)
+    return http.client.HTTPConnection(u.hostname, u.port or 80, timeout=600)
+
+
+def run_request(url: str, body: dict, use_cache: bool = False) -> _Result:
+    """
+    Egy /generate hívás. Streaming NDJSON keretekkel: egy keret terhelés alatt
+    több tokent is vihet, ezért a tokenszám az "ids" mezőkből (illetve a záró
+    keret tokens_generated-jéből), a tokenközök a szerver t_ms időbélyegeiből
+    jönnek; a TTFT az első tartalmas keret kliensoldali érkezése.
+    A válasz cache-t alapból megkerüli (X-Cache-Bypass): a mohó, ismétlődő
+    promptok különben a cache-t mérnék, nem a modellt.
+    """
+    res = _Result("stream" if body.get("stream") else "non_stream")
+    payload = json.dumps(body).encode()
+    conn = _connect(url)
+    t0 = time.perf_counter()
+    headers = {"Content-Type": "application/json"}
+    if not use_cache:
+        headers["X-Cache-Bypass"] = "1"
+    try:
+        conn.request("POST", "/generate", body=payload, headers=headers)
+        resp = conn.getresponse()
+        if resp.status != 200:
+            res.error = f"HTTP {resp.status}: {resp.read()[:200]!r}"
+            return res
+
+        if not body.get("stream"):
+            data = json.loads(resp.read())
+            res.tokens = int(data.get("tokens_generated", 0))
+        else:
+            stamps: list[float] = []
+            for raw in resp:
+                if not raw.strip():
+                    continue
+                frame = json.loads(raw)
+                if frame.get("done"):
+                    if frame.get("error"):
+                        res.error = frame["error"]
+                        return res
+                    res.tokens = int(frame.get("tokens_generated", res.tokens))
+                    break
+                if res.ttft is None and (frame.get("ids") or frame.get("text")):
+                    res.ttft = time.perf_counter() - t0
+                res.tokens += len(frame.get("ids", []))
+                stamps.extend(frame.get("t_ms", []))
+            res.inter_token = [(b - a) / 1000 for a, b in zip(stamps, stamps[1:])]
+        res.ok = True
+    except Exception as e:
+        res.error = str(e)
+    finally:
+        res.latency = time.perf_counter() - t0
+        conn.close()
+    return res
+
+
+# ---------------------------------------------------------------------------
+# Statisztika
+# ---------------------------------------------------------------------------
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    """Lineáris interpolációs percentilis (numpy nélkül)."""
+    if not values:
+        return None
+    xs = sorted(values)
+    k = (len(xs) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+
+def _dist_ms(values: list[float]) -> Optional[dict]:
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+def summarize(results: list[_Result], wall: float, concurrency: int) -> dict:
+    ok = [r for r in results if r.ok]
+    tokens = sum(r.tokens for r in ok)
+    errors = [r.error for r in results if not r.ok]
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(errors),
+        "errors": errors[:5],
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 3),
+        "requests_per_sec": round(len(ok) / wall, 3) if wall else 0.0,
+        "tokens_total": tokens,
+        "tokens_per_sec": round(tokens / wall, 2) if wall else 0.0,
+        "latency_ms": _dist_ms([r.latency for r in ok]),
+        "ttft_ms": _dist_ms([r.ttft for r in ok if r.ttft is not None]),
+        "inter_token_ms": _dist_ms([d for r in ok for d in r.inter_token]),
+    }
+
+
+def run_mode(url: str, prompts: list[str], args, stream: bool) -> dict:
+    bodies = [
+        {
+            "prompt": p,
+            "max_new_tokens": args.max_new_tokens,
+            "temperature": args.temperature,
+            "stream": stream,
+            "stream_format": "ndjson",
+        }
+        for p in prompts
+    ]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        results = list(ex.map(lambda b: run_request(url, b, args.use_cache), bodies))
+    return summarize(results, time.perf_counter() - t0, args.concurrency)
+
+
+# ---------------------------------------------------------------------------
+# Szerver indítás (opcionális)
+# ---------------------------------------------------------------------------
+
+def wait_for_health(url: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=2) as r:
+                if json.loads(r.read()).get("model_loaded"):
+                    return True
+        except Exception:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def spawn_server(args) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["LLM_HOST"] = "127.0.0.1"
+    env["LLM_PORT"] = str(args.port)
+    if args.model:
+        env["MODEL_NAME"] = args.model
+    if args.cpu:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_server.py")
+    return subprocess.Popen(
+        [sys.executable, server],
+        cwd=os.path.dirname(server),
+        env=env,
+        stdout=subprocess.DEVNULL if args.quiet_server else None,
+        stderr=subprocess.DEVNULL if args.quiet_server else None,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Belépési pont
+# ---------------------------------------------------------------------------
+
+def parse_args(argv=None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="ClawDBot LLM szerver benchmark")
+    ap.add_argument("--url", default=DEFAULT_URL, help="LLM szerver alap URL")
+    ap.add_argument("--workload", help="JSONL fájl (prompt vagy title/body mezőkkel)")
+    ap.add_argument("--requests", type=int, default=32, help="Kérések száma módonként")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--mode", choices=["stream", "non_stream", "both"], default="both")
+    ap.add_argument("--max-new-tokens", type=int, default=64)
+    ap.add_argument("--temperature", type=float, default=0.0)
+    ap.add_argument("--min-words", type=int, default=8)
+    ap.add_argument("--max-words", type=int, default=64)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--warmup", type=int, default=1, help="Nem mért bemelegítő kérések")
+    ap.add_argument("--output", help="JSON eredmény fájlba (alapból stdout)")
+    ap.add_argument("--use-cache", action="store_true",
+                    help="A szerver válasz cache-ének használata (alapból megkerüli)")
+    # Regressziós kapuk – megsértésük esetén 1-es kilépési kód
+    ap.add_argument("--max-p95-ms", type=float, help="E2E p95 felső korlát (ms)")
+    ap.add_argument("--min-tokens-per-sec", type=float, help="Aggregált token/s alsó korlát")
+    # Saját szerver indítása (pl. CI-ban kis modellel)
+    ap.add_argument("--spawn-server", action="store_true")
+    ap.add_argument("--model", help="MODEL_NAME a --spawn-server-hez")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--cpu", action="store_true", help="CUDA elrejtése a szerver elől")
+    ap.add_argument("--quiet-server", action="store_true")
+    ap.add_argument("--startup-timeout", type=float, default=600)
+    return ap.parse_args(argv)
+
+
+def check_gates(report: dict, args) -> list[str]:
+    failures = []
+    for mode, r in report["modes"].items():
+        if args.max_p95_ms is not None and r["latency_ms"] and r["latency_ms"]["p95"] > args.max_p95_ms:
+            failures.append(f"{mode}: p95 {r['latency_ms']['p95']} ms > {args.max_p95_ms} ms")
+        if args.min_tokens_per_sec is not None and r["tokens_per_sec"] < args.min_tokens_per_sec:
+            failures.append(f"{mode}: {r['tokens_per_sec']} token/s < {args.min_tokens_per_sec}")
+        if r["failed"]:
+            failures.append(f"{mode}: {r['failed']} sikertelen kérés")
+    return failures
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    url = args.url.rstrip("/")
+
+    server = None
+    if args.spawn_server:
+        url = f"http://127.0.0.1:{args.port}"
+        server = spawn_server(args)
+        if not wait_for_health(url, args.startup_timeout):
+            server.terminate()
+            print("[HIBA] A szerver nem indult el időben.", file=sys.stderr)
+            return 2
+
+    try:
+        if args.workload:
+            prompts = load_prompts(args.workload)
+            # A fájl ciklikusan ismétlődik, ha kevesebb sor van a kérésszámnál
+            prompts = [prompts[i % len(prompts)] for i in range(args.requests)]
+        else:
+            prompts = synthetic_prompts(args.requests, args.min_words, args.max_words, args.seed)
+
+        for p in prompts[:args.warmup]:
+            run_request(url, {"prompt": p, "max_new_tokens": 4, "temperature": 0.0}, args.use_cache)
+
+        modes = ["stream", "non_stream"] if args.mode == "both" else [args.mode]
+        report = {
+            "url": url,
+            "workload": args.workload or "synthetic",
+            "max_new_tokens": args.max_new_tokens,
+            "modes": {m: run_mode(url, prompts, args, stream=(m == "stream")) for m in modes},
+        }
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=5) as r:
+                report["server"] = json.loads(r.read())
+        except Exception:
+            report["server"] = None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    failures = check_gates(report, args)
+    report["gate_failures"] = failures
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
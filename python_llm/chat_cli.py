@@ -1,40 +1,67 @@
 """
 ClawDBot – Animált terminál chat kliens
-Rich panelek + ANSI typing / spinner animációk
+Rich panelek + ANSI spinner animációk, élő (streaming) válaszmegjelenítés
+
+Gyors indítás (animációk nélkül; nem interaktív bemenetnél automatikus):
+    echo "Szia" | python chat_cli.py --fast
+
+Batch / terhelés mód (JSONL eredmény, összesítő a stderr-en):
+    python chat_cli.py --batch prompts.txt --connections 4 --window 8 -o out.jsonl
 """
 
+import argparse
 import asyncio
+import collections
 import itertools
 import json
+import math
 import os
 import sys
-import urllib.request
+import time
+from urllib.parse import urlparse
 
 RUST_WS_URL = os.environ.get("CLAWDBOT_WS_URL", "ws://127.0.0.1:3000/ws/chat")
 BOT_NAME    = os.environ.get("CLAWDBOT_BOT_NAME", "ClawDBot")
-
-# ── Függőség ellenőrzés ──────────────────────────────────────────────────────
-_missing = []
-try:
-    import websockets
-except ImportError:
-    _missing.append("websockets>=12.0")
-try:
-    from rich.console import Console
-    from rich.panel import Panel
-    from rich.text import Text
-    from rich.rule import Rule
-    from rich.align import Align
-    from rich.markup import escape
-    from rich import box as rbox
-except ImportError:
-    _missing.append("rich>=13.0")
-
-if _missing:
-    print(f"[HIBA] pip install {' '.join(_missing)}")
+# Képernyőfrissítés streaming közben: ütemenként egy write + flush
+REFRESH_INTERVAL = float(os.environ.get("CLAWDBOT_REFRESH_MS", "33")) / 1000
+
+# ── Függőségek (lusta betöltés) ──────────────────────────────────────────────
+# A websockets és a rich importja az indulási idő nagy része: a websockets
+# az első kapcsolat nyitásakor, a rich csak a kirajzoló (interaktív) úton
+# töltődik be – a --help, az argumentumhibák és a batch mód rich nélkül fut
+websockets = None
+console = None
+Panel = Text = Rule = Align = escape = rbox = None
+
+def _missing_dependency(requirement: str):
+    print(f"[HIBA] pip install {requirement}")
     sys.exit(1)
 
-console = Console(highlight=False)
+def load_websockets():
+    global websockets
+    if websockets is not None:
+        return
+    try:
+        import websockets
+    except ImportError:
+        _missing_dependency("websockets>=12.0")
+
+def load_rich():
+    global console, Panel, Text, Rule, Align, escape, rbox
+    if console is not None:
+        return
+    try:
+        from rich.console import Console
+        from rich.panel import Panel
+        from rich.text import Text
+        from rich.rule import Rule
+        from rich.align import Align
+        from rich.markup import escape
+        from rich import box as rbox
+    except ImportError:
+        _missing_dependency("rich>=13.0")
+
+    console = Console(highlight=False)
 
 # ── ANSI shortcut-ok (typing + spinner animációkhoz) ─────────────────────────
 R  = "\033[0m"
@@ -66,8 +93,16 @@ LOGO = [
 
 # ── Boot animáció ─────────────────────────────────────────────────────────────
 
+def clear_screen():
+    # ANSI törlés: nincs külön "clear" alfolyamat
+    if os.name == "nt":
+        os.system("cls")
+    else:
+        sys.stdout.write("\033[2J\033[H")
+        sys.stdout.flush()
+
 async def boot_animation():
-    os.system("cls" if os.name == "nt" else "clear")
+    clear_screen()
 
     boot_msgs = [
         (GREEN,   "CUDA drivers       OK"),
@@ -82,7 +117,7 @@ async def boot_animation():
         await asyncio.sleep(0.08)
 
     await asyncio.sleep(0.25)
-    os.system("cls" if os.name == "nt" else "clear")
+    clear_screen()
 
     for i, line in enumerate(LOGO):
         print(line)
@@ -97,73 +132,249 @@ async def boot_animation():
 
 # ── Szerver várakozás ─────────────────────────────────────────────────────────
 
-async def wait_for_server() -> bool:
-    health = RUST_WS_URL.replace("ws://", "http://").replace("/ws/chat", "/health")
-    spins  = itertools.cycle(["⣾","⣽","⣻","⢿","⡿","⣟","⣯","⣷"])
-
-    for i in range(30):
-        try:
-            urllib.request.urlopen(health, timeout=1)
-            sys.stdout.write(f"\r  {GREEN}{B}✓ Szerver elérhető!{R}                \n")
-            sys.stdout.flush()
-            return True
-        except Exception:
-            s    = next(spins)
-            dots = "." * ((i % 3) + 1) + "   "
-            sys.stdout.write(f"\r  {YELLOW}{s}{R}  GPU-k betöltése{dots}")
-            sys.stdout.flush()
-            await asyncio.sleep(2)
-
-    print()
-    return False
-
-# ── Thinking spinner ──────────────────────────────────────────────────────────
-
-async def thinking_animation(ws, timeout: float = 120.0):
-    """Spinner amíg a bot válaszol, visszaadja a JSON választ."""
-    spins  = itertools.cycle(["⣾","⣽","⣻","⢿","⡿","⣟","⣯","⣷"])
-    colors = itertools.cycle([YELLOW, "\033[93m", "\033[33m"])
-
-    recv_task = asyncio.create_task(
-        asyncio.wait_for(ws.recv(), timeout=timeout)
-    )
-
-    while not recv_task.done():
-        s = next(spins)
-        c = next(colors)
-        sys.stdout.write(f"\r  {c}{B}{s}{R}{c}  {BOT_NAME} gondolkodik...{R}  ")
+async def _probe_health(url: str) -> bool:
+    """Egy HTTP GET a /health-re asyncio socketen – nem állítja meg a loop-ot."""
+    u = urlparse(url)
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(u.hostname, u.port or 80), timeout=1
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        writer.write(f"GET {u.path or '/'} HTTP/1.0\r\nHost: {u.netloc}\r\n\r\n".encode())
+        status = await asyncio.wait_for(reader.readline(), timeout=2)
+        return status.split(b" ")[1:2] == [b"200"]
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+async def _spinner(label: str):
+    spins = itertools.cycle(["⣾","⣽","⣻","⢿","⡿","⣟","⣯","⣷"])
+    for i in itertools.count():
+        dots = "." * ((i // 10) % 3 + 1) + "   "
+        sys.stdout.write(f"\r  {YELLOW}{next(spins)}{R}  {label}{dots}")
         sys.stdout.flush()
         await asyncio.sleep(0.09)
 
-    sys.stdout.write(f"\r{' ' * 60}\r")
-    sys.stdout.flush()
-
-    raw = await recv_task
-    return json.loads(raw)
-
-# ── Typing hatás ──────────────────────────────────────────────────────────────
+async def wait_for_server(timeout: float = 60.0, quiet: bool = False) -> bool:
+    """
+    /health lekérdezés exponenciális backoff-fal (50 ms → 2 s): futó
+    szervernél azonnal továbblép, a spinner a várakozás alatt is forog.
+    """
+    health = RUST_WS_URL.replace("ws://", "http://").replace("/ws/chat", "/health")
+    loop     = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    spinner  = None if quiet else asyncio.create_task(_spinner("GPU-k betöltése"))
+    delay    = 0.05
+    ok       = False
 
-async def type_response(text: str):
+    try:
+        while True:
+            if await _probe_health(health):
+                ok = True
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 2.0)
+    finally:
+        if spinner is not None:
+            spinner.cancel()
+
+    if not quiet:
+        if ok:
+            sys.stdout.write(f"\r  {GREEN}{B}✓ Szerver elérhető!{R}                \n")
+            sys.stdout.flush()
+        else:
+            print()
+    return ok
+
+# ── Tartós WebSocket kapcsolat ────────────────────────────────────────────────
+
+class ChatConnection:
+    """
+    Tartós WebSocket kapcsolat a Rust szerverhez. Bontás után exponenciális
+    backoff-fal újrakapcsolódik, és a session_id-vel meg az utolsó "connected"
+    üzenetben kapott resume_token-nel ugyanazt a beszélgetést folytatja.
+    """
+
+    MAX_ATTEMPTS = 8
+
+    def __init__(self, url: str):
+        self.url          = url
+        self.ws           = None
+        self.session_id   = None
+        self.resume_token = None
+        self.bot          = BOT_NAME
+        self.reconnects   = 0
+
+    async def connect(self) -> dict:
+        """Kapcsolódás (ismert session-nél folytatással); a welcome üzenetet adja."""
+        url = self.url
+        if self.session_id and self.resume_token:
+            url = f"{self.url}?session_id={self.session_id}&resume_token={self.resume_token}"
+        load_websockets()
+        delay = 0.1
+        for attempt in range(self.MAX_ATTEMPTS):
+            last = attempt == self.MAX_ATTEMPTS - 1
+            try:
+                self.ws = await websockets.connect(url, open_timeout=5)
+                welcome = json.loads(await asyncio.wait_for(self.ws.recv(), timeout=5))
+                # A szerver a régi kapcsolatot még élőnek látja (a bontást
+                # még nem észlelte): kis várakozás után újra próbáljuk
+                if welcome.get("resume_rejected") != "active" or last:
+                    break
+                await self.close()
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+                await self.close()
+                if last:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+        self.session_id   = welcome.get("session_id", self.session_id)
+        self.resume_token = welcome.get("resume_token")
+        self.bot          = welcome.get("bot", self.bot)
+        return welcome
+
+    async def reconnect(self) -> dict:
+        await self.close()
+        self.reconnects += 1
+        return await self.connect()
+
+    async def send(self, payload: dict):
+        """Ha a kapcsolat a küldés előtt megszakadt, újrakapcsolódás után újraküld."""
+        try:
+            await self.ws.send(json.dumps(payload))
+        except websockets.exceptions.ConnectionClosed:
+            await self.reconnect()
+            await self.ws.send(json.dumps(payload))
+
+    async def close(self):
+        if self.ws is not None:
+            ws, self.ws = self.ws, None
+            try:
+                await ws.close()
+            except Exception:
+                pass
+
+# ── Streaming válasz ──────────────────────────────────────────────────────────
+
+def _reply_header():
     w = min(console.width - 6, 76)
+    sys.stdout.write(f"\r{' ' * 60}\r")
     print(f"\n  {GREEN}{B}⚙ {BOT_NAME}{R}")
     print(f"  {D}{'─' * w}{R}")
-    print("  ", end="")
+    sys.stdout.write("  ")
 
-    for char in text:
-        if char == "\n":
-            sys.stdout.write(f"\n  ")
-            await asyncio.sleep(0.01)
-        else:
-            sys.stdout.write(f"{WHITE}{char}{R}")
-            if char in ".!?":
-                await asyncio.sleep(0.055)
-            elif char in ",;:":
-                await asyncio.sleep(0.028)
-            else:
-                await asyncio.sleep(0.013)
-        sys.stdout.flush()
+def _reply_footer(stats: dict):
+    w = min(console.width - 6, 76)
+    print(f"\n  {D}{'─' * w}{R}")
+    parts = []
+    if stats.get("ttft") is not None:
+        parts.append(f"TTFT {stats['ttft']:.2f} s")
+    parts.append(f"{stats['tokens']} token")
+    if stats.get("tokens_per_sec"):
+        parts.append(f"{stats['tokens_per_sec']:.1f} token/s")
+    parts.append(f"{stats['total']:.1f} s")
+    print(f"  {D}{'  ·  '.join(parts)}{R}\n")
+
+async def stream_reply(ws, timeout: float = 120.0) -> dict:
+    """
+    A válasz élő megjelenítése generálás közben. A "token" üzeneteket egy
+    fogadó task gyűjti, a kirajzolás REFRESH_INTERVAL ütemenként egyetlen
+    write + flush (nem karakterenként). Az első tokenig spinner fut.
+    Visszaadja a záró üzenetet ("reply" / "error") a mért statisztikával.
+    A timeout két üzenet közötti legnagyobb csend. A hiteles szöveg a záró
+    üzenetben jön; ha a delták ettől eltértek, az is kiíródik.
+    """
+    spins   = itertools.cycle(["⣾","⣽","⣻","⢿","⡿","⣟","⣯","⣷"])
+    pending = []
+    shown   = []
+    final   = {}
+    t0      = time.perf_counter()
+    first   = None
+    frames  = 0
+
+    async def receive():
+        nonlocal first, frames
+        while True:
+            msg = json.loads(await asyncio.wait_for(ws.recv(), timeout=timeout))
+            if msg.get("type") != "token":
+                final.update(msg)
+                return
+            if first is None:
+                first = time.perf_counter()
+            frames += 1
+            pending.append(msg.get("data", ""))
+
+    def render():
+        text = "".join(pending)
+        pending.clear()
+        shown.append(text)
+        if text:
+            sys.stdout.write(f"{WHITE}{text.replace(chr(10), chr(10) + '  ')}{R}")
+            sys.stdout.flush()
 
-    print(f"\n  {D}{'─' * w}{R}\n")
+    recv_task = asyncio.create_task(receive())
+    streaming = False
+    tick = 0
+    try:
+        while not recv_task.done():
+            if pending and not streaming:
+                _reply_header()
+                streaming = True
+            if streaming:
+                render()
+            elif tick % 3 == 0:
+                sys.stdout.write(f"\r  {YELLOW}{B}{next(spins)}{R}{YELLOW}  {BOT_NAME} gondolkodik...{R}  ")
+                sys.stdout.flush()
+            tick += 1
+            await asyncio.sleep(REFRESH_INTERVAL)
+        await recv_task
+    finally:
+        failed = (not recv_task.done() or recv_task.cancelled()
+                  or recv_task.exception() is not None)
+        if not recv_task.done():
+            recv_task.cancel()
+        if streaming:
+            render()
+            if failed:
+                print()
+        else:
+            sys.stdout.write(f"\r{' ' * 60}\r")
+
+    t_end = time.perf_counter()
+    if final.get("type") != "reply":
+        if streaming:
+            print()
+        return final
+
+    if not streaming:
+        # Token üzenetek nélküli (régebbi) szerver, vagy az első frissítés
+        # előtt befejeződött válasz: a teljes szöveg egyben, a delták helyett
+        _reply_header()
+        pending[:] = [final.get("data", "")]
+        render()
+    elif "".join(shown).strip() != final.get("data", "").strip():
+        # Pl. utófeldolgozást nem streamelő (régebbi) szerver
+        print(f"\n  {D}(javított válasz){R}")
+        sys.stdout.write("  ")
+        pending.append(final.get("data", ""))
+        render()
+    tokens = final.get("tokens_generated") or frames
+    decode = t_end - first if first is not None else 0.0
+    final["stats"] = {
+        "ttft": first - t0 if first is not None else None,
+        "tokens": tokens,
+        "tokens_per_sec": tokens / decode if decode > 0 else None,
+        "total": t_end - t0,
+    }
+    _reply_footer(final["stats"])
+    return final
 
 # ── Üzenet panelek ────────────────────────────────────────────────────────────
 
@@ -200,12 +411,264 @@ def show_error(msg: str):
         box=rbox.HEAVY,
     ))
 
+# ── Batch mód (szkriptelt smoke / terhelés) ──────────────────────────────────
+
+def read_batch(path: str, max_tokens: int) -> list:
+    """
+    Promptok beolvasása fájlból ("-" = stdin). Soronként sima szöveg vagy
+    JSON objektum: {"id", "message" | "prompt", "max_tokens"}.
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+    items = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        item = None
+        if line.startswith("{"):
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                pass
+        if not isinstance(item, dict):
+            item = {"message": line}
+        message = item.get("message", item.get("prompt"))
+        if not message:
+            raise ValueError(f"{path}:{lineno}: hiányzó \"message\" mező")
+        items.append({
+            "id": item.get("id", lineno),
+            "message": message,
+            "max_tokens": int(item.get("max_tokens", max_tokens)),
+        })
+    return items
+
+def _percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+class BatchRunner:
+    """
+    Promptok csővezetékes küldése több WebSocket kapcsolaton. A szerver
+    kapcsolatonként sorban dolgoz, ezért egy kapcsolaton a válaszok
+    küldési sorrendben jönnek; a párhuzamosságot a kapcsolatok száma adja,
+    a window (összes egyidejűleg kint lévő kérés) kapcsolatonként
+    egyenletesen oszlik el. Az eredmények azonnal JSONL-be íródnak.
+    """
+
+    def __init__(self, items: list, out, connections: int, window: int,
+                 stream: bool, timeout: float):
+        self.queue = collections.deque(items)
+        self.total = len(items)
+        self.out = out
+        self.connections = max(1, min(connections, len(items)))
+        self.window = asyncio.Semaphore(max(window, 1))
+        self.depth = max(1, math.ceil(window / self.connections))
+        self.stream = stream
+        self.timeout = timeout
+        self.results = []
+
+    def _record(self, req: dict, conn_idx: int, msg: dict):
+        now = time.perf_counter()
+        ok = msg.get("type") == "reply"
+        result = {
+            "id": req["id"],
+            "connection": conn_idx,
+            "ok": ok,
+            "prompt_chars": req.get("prompt_chars"),
+            "latency": round(now - req["sent"], 4),
+            "ttft": round(req["first"] - req["sent"], 4) if req["first"] else None,
+            "tokens_generated": msg.get("tokens_generated"),
+            "finish_reason": msg.get("finish_reason"),
+        }
+        if ok:
+            result["reply"] = msg.get("data", "")
+        else:
+            result["error"] = msg.get("message", "ismeretlen hiba")
+        self.results.append(result)
+        self.out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.out.flush()
+
+    async def _worker(self, conn_idx: int):
+        conn = ChatConnection(RUST_WS_URL)
+        await conn.connect()
+        inflight = collections.deque()
+        slots = asyncio.Semaphore(self.depth)
+        idle = asyncio.Event()
+        idle.set()
+        # Az utolsó válaszüzenet, vagy a tétlenség utáni első küldés ideje
+        last_activity = time.perf_counter()
+
+        def complete(req: dict, msg: dict):
+            self._record(req, conn_idx, msg)
+            slots.release()
+            self.window.release()
+            if not inflight:
+                idle.set()
+
+        async def receiver():
+            nonlocal last_activity
+            while True:
+                # Időkorlát csak kint lévő kérésre: tétlen kapcsolaton a
+                # csend nem hiba (a recv() megszakítása nem veszít üzenetet)
+                wait = self.timeout
+                if inflight:
+                    wait = max(0.0, self.timeout - (time.perf_counter() - last_activity))
+                try:
+                    msg = json.loads(await asyncio.wait_for(conn.ws.recv(), timeout=wait))
+                    last_activity = time.perf_counter()
+                except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed) as e:
+                    timed_out = isinstance(e, asyncio.TimeoutError)
+                    if timed_out and (not inflight or time.perf_counter() - last_activity < self.timeout):
+                        continue
+                    reason = "timeout" if timed_out else "kapcsolat megszakadt"
+                    # Előbb újrakapcsolódás: a felszabaduló helyekre a küldő
+                    # csak élő kapcsolaton küldhet tovább
+                    await conn.reconnect()
+                    while inflight:
+                        complete(inflight.popleft(), {"type": "error", "message": reason})
+                    continue
+                if not inflight or msg.get("type") not in ("token", "reply", "error"):
+                    continue
+                # A szerver visszaküldi az "id"-t; régebbi szervernél FIFO
+                req = next((r for r in inflight if r["id"] == msg.get("id")), inflight[0])
+                if msg["type"] == "token":
+                    if req["first"] is None:
+                        req["first"] = time.perf_counter()
+                    continue
+                inflight.remove(req)
+                complete(req, msg)
+
+        async def sender():
+            nonlocal last_activity
+            while True:
+                await slots.acquire()
+                await self.window.acquire()
+                if not self.queue:
+                    slots.release()
+                    self.window.release()
+                    return
+                item = self.queue.popleft()
+                req = {"id": item["id"], "sent": time.perf_counter(), "first": None,
+                       "prompt_chars": len(item["message"])}
+                if not inflight:
+                    last_activity = req["sent"]
+                inflight.append(req)
+                idle.clear()
+                await conn.send({
+                    "id": item["id"],
+                    "message": item["message"],
+                    "max_tokens": item["max_tokens"],
+                    "stream": self.stream,
+                    # Minden sor önálló kérés: a szerver ne fűzze a korábbi
+                    # sorokat előzményként a promptba
+                    "stateless": True,
+                })
+
+        recv_task = asyncio.create_task(receiver())
+        send_task = asyncio.create_task(sender())
+        idle_task = None
+        try:
+            # A fogadó csak hibával áll le (pl. sikertelen újrakapcsolódás)
+            await asyncio.wait({send_task, recv_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not recv_task.done():
+                send_task.result()
+                # Az összes kiküldött kérés válaszának megvárása
+                idle_task = asyncio.create_task(idle.wait())
+                await asyncio.wait({idle_task, recv_task}, return_when=asyncio.FIRST_COMPLETED)
+            if recv_task.done():
+                recv_task.result()
+        finally:
+            for task in (send_task, recv_task, idle_task):
+                if task is not None:
+                    task.cancel()
+            while inflight:
+                complete(inflight.popleft(), {"type": "error", "message": "kapcsolat megszakadt"})
+            await conn.close()
+
+    async def run(self) -> dict:
+        t0 = time.perf_counter()
+        outcomes = await asyncio.gather(
+            *(self._worker(i) for i in range(self.connections)),
+            return_exceptions=True,
+        )
+        wall = time.perf_counter() - t0
+
+        failures = [e for e in outcomes if isinstance(e, BaseException)]
+        # Meghiúsult kapcsolat esetén a ki nem küldött promptok hibaként számítanak
+        for item in list(self.queue):
+            req = {"id": item["id"], "sent": time.perf_counter(), "first": None,
+                   "prompt_chars": len(item["message"])}
+            reason = str(failures[0]) if failures else "nem lett elküldve"
+            self._record(req, -1, {"type": "error", "message": reason})
+        self.queue.clear()
+
+        ok = [r for r in self.results if r["ok"]]
+        latencies = [r["latency"] for r in ok]
+        ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+        tokens = sum(r["tokens_generated"] or 0 for r in ok)
+        return {
+            "requests": self.total,
+            "ok": len(ok),
+            "errors": len(self.results) - len(ok),
+            "connections": self.connections,
+            "wall_seconds": round(wall, 3),
+            "requests_per_sec": round(len(ok) / wall, 2) if wall > 0 else None,
+            "tokens_per_sec": round(tokens / wall, 1) if wall > 0 else None,
+            "latency_mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "latency_p50": _percentile(latencies, 0.50),
+            "latency_p90": _percentile(latencies, 0.90),
+            "latency_p99": _percentile(latencies, 0.99),
+            "ttft_p50": _percentile(ttfts, 0.50),
+        }
+
+async def run_batch(args: argparse.Namespace) -> int:
+    try:
+        items = read_batch(args.batch, args.max_tokens)
+    except (OSError, ValueError) as e:
+        print(f"[HIBA] {e}", file=sys.stderr)
+        return 2
+    if not items:
+        print("[HIBA] Üres batch bemenet", file=sys.stderr)
+        return 2
+
+    if not await wait_for_server(quiet=True):
+        print(f"[HIBA] A szerver nem érhető el: {RUST_WS_URL}", file=sys.stderr)
+        return 2
+
+    out = sys.stdout if args.output in (None, "-") else open(args.output, "w", encoding="utf-8")
+    try:
+        runner = BatchRunner(
+            items, out,
+            connections=args.connections,
+            window=args.window or 2 * args.connections,
+            stream=args.stream,
+            timeout=args.timeout,
+        )
+        summary = await runner.run()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    width = max(len(k) for k in summary)
+    for key, value in summary.items():
+        print(f"{key:<{width}}  {value}", file=sys.stderr)
+    return 0 if summary["errors"] == 0 else 1
+
 # ── Fő chat hurok ─────────────────────────────────────────────────────────────
 
-async def chat_loop():
-    await boot_animation()
+async def chat_loop(fast: bool = False):
+    load_rich()
+    if not fast:
+        await boot_animation()
 
-    ok = await wait_for_server()
+    ok = await wait_for_server(quiet=fast)
     if not ok:
         show_error(
             "A szerver nem érhető el 60 másodperc után.\n"
@@ -213,78 +676,116 @@ async def chat_loop():
         )
         return
 
-    session_id = None
-
+    conn = ChatConnection(RUST_WS_URL)
     try:
-        async with websockets.connect(RUST_WS_URL) as ws:
-            raw     = await ws.recv()
-            welcome = json.loads(raw)
-            session_id = welcome.get("session_id", "?")
-            bot_srv    = welcome.get("bot", BOT_NAME)
-
-            console.print(Panel(
-                f"[green]✓ Kapcsolódva![/]\n"
-                f"[dim]Session: [bold]{session_id}[/][/]\n"
-                f"[dim]Bot:     [bold]{bot_srv}[/][/]\n\n"
-                "[dim]Típus [cyan]/help[/][dim] a parancsokért[/]",
-                title=f"[bold green]{BOT_NAME}[/]",
-                border_style="green",
-                box=rbox.DOUBLE,
-            ))
-            console.print()
+        await conn.connect()
+    except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+        show_error(f"Kapcsolódás sikertelen: {RUST_WS_URL}\n{e}\nFuttasd: scripts\\start_all.bat")
+        return
 
-            while True:
+    if fast:
+        console.print(f"[dim]Session: {conn.session_id}[/]")
+    else:
+        console.print(Panel(
+            f"[green]✓ Kapcsolódva![/]\n"
+            f"[dim]Session: [bold]{conn.session_id}[/][/]\n"
+            f"[dim]Bot:     [bold]{conn.bot}[/][/]\n\n"
+            "[dim]Típus [cyan]/help[/][dim] a parancsokért[/]",
+            title=f"[bold green]{BOT_NAME}[/]",
+            border_style="green",
+            box=rbox.DOUBLE,
+        ))
+        console.print()
+
+    try:
+        while True:
+            try:
+                print(f"{CYAN}{B}╭─ Te{R}")
+                user_input = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: input(f"{CYAN}╰─▶ {R}")
+                )
+                user_input = user_input.strip()
+            except (EOFError, KeyboardInterrupt):
+                break
+
+            if not user_input:
+                continue
+
+            if user_input.lower() in ("/quit", "/exit"):
+                break
+            if user_input.lower() == "/help":
+                show_help()
+                continue
+            if user_input.lower() == "/clear":
+                clear_screen()
+                if not fast:
+                    await boot_animation()
+                continue
+            if user_input.lower() == "/session":
+                console.print(f"[dim]Session: {conn.session_id}[/]")
+                continue
+
+            show_user_msg(user_input)
+
+            try:
+                await conn.send({"message": user_input, "max_tokens": 512, "stream": True})
+                resp = await stream_reply(conn.ws, timeout=120.0)
+            except asyncio.TimeoutError:
+                show_error("Timeout – 120mp alatt nem érkezett válasz.")
+                continue
+            except websockets.exceptions.ConnectionClosed:
+                # A szerver a megkezdett választ a session-be még beírja
                 try:
-                    print(f"{CYAN}{B}╭─ Te{R}")
-                    user_input = await asyncio.get_event_loop().run_in_executor(
-                        None, lambda: input(f"{CYAN}╰─▶ {R}")
-                    )
-                    user_input = user_input.strip()
-                except (EOFError, KeyboardInterrupt):
+                    welcome = await conn.reconnect()
+                except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                    show_error(f"A kapcsolat megszakadt, újrakapcsolódás sikertelen: {e}")
                     break
+                resumed = "session folytatva" if welcome.get("resumed") else "új session"
+                show_error(f"A kapcsolat megszakadt a válasz közben – újrakapcsolódva ({resumed}).")
+                continue
+            except Exception as e:
+                show_error(str(e))
+                continue
 
-                if not user_input:
-                    continue
-
-                if user_input.lower() in ("/quit", "/exit"):
-                    break
-                if user_input.lower() == "/help":
-                    show_help()
-                    continue
-                if user_input.lower() == "/clear":
-                    os.system("cls" if os.name == "nt" else "clear")
-                    await boot_animation()
-                    continue
-                if user_input.lower() == "/session":
-                    console.print(f"[dim]Session: {session_id}[/]")
-                    continue
+            if resp.get("type") == "error":
+                show_error(resp.get("message", "Ismeretlen hiba"))
 
-                show_user_msg(user_input)
-                await ws.send(json.dumps({"message": user_input, "max_tokens": 512}))
+            console.print()
+    finally:
+        await conn.close()
 
-                try:
-                    resp = await thinking_animation(ws, timeout=120.0)
-                except asyncio.TimeoutError:
-                    show_error("Timeout – 120mp alatt nem érkezett válasz.")
-                    continue
-                except Exception as e:
-                    show_error(str(e))
-                    continue
+    console.print(Rule(f"[bold cyan]Viszlát![/]", style="cyan"))
 
-                if resp.get("type") == "reply":
-                    await type_response(resp.get("data", ""))
-                elif resp.get("type") == "error":
-                    show_error(resp.get("message", "Ismeretlen hiba"))
 
-                console.print()
+def parse_args(argv=None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="ClawDBot terminál chat kliens")
+    ap.add_argument(
+        "--fast", action="store_true",
+        help="Gyors indítás animációk nélkül (nem interaktív bemenetnél automatikus)",
+    )
+    batch = ap.add_argument_group("batch mód")
+    batch.add_argument(
+        "--batch", metavar="FILE",
+        help="Promptok fájlból (\"-\" = stdin), soronként szöveg vagy JSON",
+    )
+    batch.add_argument("-o", "--output", metavar="FILE", help="JSONL eredmény (alap: stdout)")
+    batch.add_argument("--connections", type=int, default=4, help="WebSocket kapcsolatok száma")
+    batch.add_argument(
+        "--window", type=int, default=0,
+        help="Egyszerre kint lévő kérések száma összesen (alap: 2 × kapcsolatok)",
+    )
+    batch.add_argument("--max-tokens", type=int, default=512)
+    batch.add_argument("--stream", action="store_true", help="Token üzenetek kérése (TTFT méréshez)")
+    batch.add_argument("--timeout", type=float, default=120.0, help="Max. csend két üzenet között (s)")
+    return ap.parse_args(argv)
 
-    except websockets.exceptions.ConnectionRefusedError:
-        show_error(f"Kapcsolat elutasítva: {RUST_WS_URL}\nFuttasd: scripts\\start_all.bat")
-    except Exception as e:
-        show_error(str(e))
 
-    console.print(Rule(f"[bold cyan]Viszlát![/]", style="cyan"))
+def main(argv=None):
+    args = parse_args(argv)
+    if args.batch:
+        sys.exit(asyncio.run(run_batch(args)))
+    asyncio.run(chat_loop(fast=args.fast or not sys.stdin.isatty()))
 
 
 if __name__ == "__main__":
-    asyncio.run(chat_loop())
+    main()
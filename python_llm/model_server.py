@@ -5,24 +5,40 @@ HTTP API: FastAPI + Uvicorn
 """
 
 import os
+import argparse
 import asyncio
+import hashlib
+import json
 import logging
+import random
+import tempfile
+import threading
 import time
-from contextlib import asynccontextmanager
-from typing import Optional, AsyncGenerator
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+from queue import SimpleQueue
+from typing import Optional, AsyncGenerator, Callable, Literal, Union
 
 import torch
+import torch.nn.functional as F
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel, Field, ValidationError
 from transformers import (
+    AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
-    TextIteratorStreamer,
     BitsAndBytesConfig,
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
-from threading import Thread
 
 # ---------------------------------------------------------------------------
 # Logging
@@ -40,6 +56,88 @@ MODEL_NAME = os.environ.get("MODEL_NAME", "WizardLM/WizardCoder-Python-13B-V1.0"
 MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", "512"))
 HOST = os.environ.get("LLM_HOST", "0.0.0.0")
 PORT = int(os.environ.get("LLM_PORT", "8000"))
+# Egyszerre futó (egy batch-ben dekódolt) szekvenciák maximális száma
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+# Ütemezőlépésenként legfeljebb ennyi prompt-token prefillje (0 = egyben):
+# a hosszú prompt darabokban halad, közben a futó kérések tovább dekódolnak
+PREFILL_CHUNK_TOKENS = int(os.environ.get("PREFILL_CHUNK_TOKENS", "512"))
+# Prefix KV-cache memóriakerete (MB, 0 = kikapcsolva) és blokkmérete (token)
+PREFIX_CACHE_MB = int(os.environ.get("PREFIX_CACHE_MB", "1024"))
+PREFIX_CACHE_BLOCK = int(os.environ.get("PREFIX_CACHE_BLOCK", "16"))
+# Streaming: ennyi el nem küldött token után a szekvencia szünetel
+STREAM_MAX_BACKLOG = int(os.environ.get("STREAM_MAX_BACKLOG", "64"))
+# Mikro-batching nem streaming kérésekhez (0 ms = kikapcsolva, continuous batching)
+MICROBATCH_WINDOW_MS = int(os.environ.get("MICROBATCH_WINDOW_MS", "0"))
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", "16"))
+# Determinisztikus válaszok cache-e (0 = kikapcsolva), TTL mp, opcionális fájl
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH") or None
+# Előre konvertált (fp16, safetensors) modell snapshot a gyors induláshoz
+MODEL_SNAPSHOT_DIR = os.environ.get("MODEL_SNAPSHOT_DIR") or None
+SNAPSHOT_SHARD_SIZE = os.environ.get("SNAPSHOT_SHARD_SIZE", "2GB")
+# Betöltés alatt érkező /generate kérések ennyi mp-ig várnak 503 helyett
+READY_WAIT_TIMEOUT = float(os.environ.get("READY_WAIT_TIMEOUT", "600"))
+# Bemelegítés a készenlét előtt: prompt-hossz vödrök tokenben (vesszővel
+# elválasztva; üres = kikapcsolva) és kérésenként ennyi generált token
+WARMUP_BUCKETS = [int(b) for b in os.environ.get("WARMUP_BUCKETS", "").split(",") if b.strip()]
+WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", "8"))
+# torch.compile mód a dekódolási lépéshez (üres = kikapcsolva; pl. default,
+# max-autotune-no-cudagraphs); a bemelegítés fordít a valódi kérések előtt
+COMPILE_MODE = os.environ.get("COMPILE_MODE", "").strip() or None
+# Beengedés: futó kérések token-kerete (prompt + max_new_tokens; 0 = memóriából
+# számolva), a batch osztály részesedése, várakozási sor hossza és ideje (mp)
+ADMISSION_TOKEN_BUDGET = int(os.environ.get("ADMISSION_TOKEN_BUDGET", "0"))
+ADMISSION_MEMORY_FRACTION = float(os.environ.get("ADMISSION_MEMORY_FRACTION", "0.8"))
+ADMISSION_BATCH_SHARE = float(os.environ.get("ADMISSION_BATCH_SHARE", "0.5"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+# KV blokk-pool replikánként: mérete MB-ban (0 = a szabad memóriából, a
+# build_max_memory keretén belül), blokkméret tokenben, és a pool memóriájának
+# előzetes lefoglalása a CUDA allokátorban (töredezettség és csúcsok ellen)
+KV_POOL_MB = int(os.environ.get("KV_POOL_MB", "0"))
+KV_BLOCK_SIZE = int(os.environ.get("KV_BLOCK_SIZE", "16"))
+KV_POOL_PREALLOCATE = os.environ.get("KV_POOL_PREALLOCATE", "1") == "1"
+# Spekulatív dekódolás: kis draft modell (azonos tokenizerrel), lépésenként
+# ennyi javasolt tokennel; csak egyedül futó szekvenciánál aktív
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME") or None
+SPEC_NUM_TOKENS = int(os.environ.get("SPEC_NUM_TOKENS", "4"))
+# Kvantálás: fp16 | int8 | int4 (bitsandbytes, CUDA) | int8_dynamic (CPU, torch)
+QUANTIZATION = os.environ.get("QUANTIZATION", "fp16").strip().lower()
+# Adatpárhuzamos replikák száma ("auto" = GPU-nként egy; 1 = rétegenkénti
+# szétosztás a GPU-k között, mint eddig). GPU nélkül mindig 1: a közös
+# súlyokon futó CPU replika-szálak nem skálázódnak (REPLICAS=2 a tiny Llama
+# modellel 308 token/s, egy replika 412 token/s)
+REPLICAS = os.environ.get("REPLICAS", "1")
+# /generate_batch: egyszerre feldolgozás alatt álló (vagy még el nem küldött) sorok
+BATCH_MAX_IN_FLIGHT = int(os.environ.get("BATCH_MAX_IN_FLIGHT", "64"))
+# Kérésenkénti határidő alapértéke mp-ben (0 = nincs); a kérés timeout mezője
+# vagy az X-Request-Timeout fejléc szigoríthatja
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "0"))
+# Leállításkor ennyi mp-ig fejeződhetnek be a futó kérések, utána megszakadnak
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get("SHUTDOWN_GRACE_SECONDS", "30"))
+# Alapértelmezett stop szekvenciák: a sablon fejlécei és a Rust oldali előzmény
+# formátum ("User: ..." / "<bot>: ...") – a modell ne írjon kitalált új kört
+BOT_NAME = os.environ.get("CLAWDBOT_BOT_NAME", "ClawDBot")
+DEFAULT_STOP_SEQUENCES = ["### Instruction:", "### System:", "\nUser:", f"\n{BOT_NAME}:"]
+# Tokenizálás: szegmens-cache mérete, egy kötegben tokenizált szövegek max. száma
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", "8192"))
+TOKENIZER_MAX_BATCH = int(os.environ.get("TOKENIZER_MAX_BATCH", "64"))
+# /chat: szerveroldali munkamenetek száma és lejárata (mp), kontextusablak
+# tokenben (0 = a modell konfigurációjából)
+CHAT_MAX_SESSIONS = int(os.environ.get("CHAT_MAX_SESSIONS", "1024"))
+CHAT_SESSION_TTL = float(os.environ.get("CHAT_SESSION_TTL", "3600"))
+CHAT_CONTEXT_TOKENS = int(os.environ.get("CHAT_CONTEXT_TOKENS", "0"))
+# Profilozás: kérésre (profile mező / X-Profile fejléc) vagy mintavétellel
+# (pl. 0.01 = a kérések 1%-a). Backend: torch (Chrome trace) | cprofile;
+# a trace legfeljebb PROFILE_MAX_STEPS dekódolási lépést fog át. Mintavételes
+# kérés alapból csak időbontást kap; trace-t PROFILE_SAMPLE_TRACES=1 mellett
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_TRACES = os.environ.get("PROFILE_SAMPLE_TRACES", "0") == "1"
+PROFILE_BACKEND = os.environ.get("PROFILE_BACKEND", "torch").strip().lower()
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "clawdbot-profiles")
+PROFILE_MAX_STEPS = int(os.environ.get("PROFILE_MAX_STEPS", "16"))
+PROFILE_MAX_TRACES = int(os.environ.get("PROFILE_MAX_TRACES", "100"))
 
 # ---------------------------------------------------------------------------
 # GPU detektálás
@@ -67,30 +165,153 @@ def detect_gpus() -> dict:
     return {"device_count": count, "gpus": gpus}
 
 
-def build_device_map(gpu_info: dict) -> str | dict:
+# ---------------------------------------------------------------------------
+# Kvantálás
+# ---------------------------------------------------------------------------
+QUANTIZATION_MODES = ("fp16", "int8", "int4", "int8_dynamic")
+_BYTES_PER_PARAM = {"fp16": 2.0, "int8": 1.0, "int4": 0.5, "int8_dynamic": 1.0}
+
+
+def resolve_quantization(gpu_info: dict, mode: str = QUANTIZATION) -> str:
+    """
+    A kért mód ellenőrzése. A bitsandbytes (int8/int4) CUDA-t igényel,
+    GPU nélkül a torch dinamikus int8 kvantálására váltunk.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Ismeretlen QUANTIZATION: {mode} (lehetséges: {', '.join(QUANTIZATION_MODES)})")
+    if mode in ("int8", "int4") and gpu_info["device_count"] == 0:
+        log.warning(f"{mode}: a bitsandbytes CUDA-t igényel – int8_dynamic (CPU) mód használata.")
+        return "int8_dynamic"
+    if mode == "int8_dynamic" and gpu_info["device_count"] > 0:
+        log.warning("int8_dynamic: csak CPU-n fut, a GPU-k kihasználatlanok maradnak.")
+    return mode
+
+
+def estimate_model_bytes(source: str, quantization: str) -> Optional[int]:
+    """Súlyméret becslése betöltés előtt, a config alapján (transzformer blokkok + embeddingek)."""
+    try:
+        cfg = AutoConfig.from_pretrained(source, trust_remote_code=True)
+        h, layers, vocab = cfg.hidden_size, cfg.num_hidden_layers, cfg.vocab_size
+    except Exception:
+        return None
+    inter = getattr(cfg, "intermediate_size", None) or 4 * h
+    params = layers * (4 * h * h + 3 * h * inter) + 2 * vocab * h
+    return int(params * _BYTES_PER_PARAM[quantization])
+
+
+def _quantization_kwargs(mode: str) -> dict:
+    """from_pretrained() paraméterek a kvantálási módhoz."""
+    if mode == "int8":
+        return {"torch_dtype": torch.float16,
+                "quantization_config": BitsAndBytesConfig(load_in_8bit=True)}
+    if mode == "int4":
+        return {"torch_dtype": torch.float16,
+                "quantization_config": BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                )}
+    if mode == "int8_dynamic":
+        # A dinamikus kvantálás fp32 súlyokból indul (CPU-n az fp16 amúgy is lassú)
+        return {"torch_dtype": torch.float32}
+    return {"torch_dtype": torch.float16}
+
+
+def _apply_quantization(model, mode: str):
+    """Betöltés utáni kvantálás: int8_dynamic esetén a Linear rétegek int8 súlyt kapnak."""
+    if mode == "int8_dynamic":
+        torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
+
+
+def _model_footprint(model) -> int:
+    """Súlyok + bufferek tényleges mérete bájtban (a csomagolt int8 rétegekkel együtt)."""
+    def tensors(value):
+        if isinstance(value, torch.Tensor):
+            yield value
+        elif isinstance(value, (tuple, list)):
+            for v in value:
+                yield from tensors(v)
+
+    seen, total = set(), 0
+    for value in model.state_dict().values():
+        for t in tensors(value):
+            key = (t.data_ptr(), t.numel())
+            if key not in seen:
+                seen.add(key)
+                total += t.numel() * t.element_size()
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Eszközkiosztás
+# ---------------------------------------------------------------------------
+
+def build_device_map(
+    gpu_info: dict, quantization: str = "fp16", model_bytes: Optional[int] = None
+) -> str | dict:
     """
     Automatikus device_map: ha >=2 GPU van, 'auto' elegendő –
     a Hugging Face accelerate maga osztja szét a rétegeket.
     Ha csak 1 GPU van, 'cuda:0'-t használunk.
-    Ha nincs GPU, 'cpu'-t.
+    Ha nincs GPU (vagy int8_dynamic a mód), 'cpu'-t.
+    Ha a (kvantált) modell egy kártyán is bőven elfér, nem osztjuk szét.
     """
     count = gpu_info["device_count"]
-    if count == 0:
+    if count == 0 or quantization == "int8_dynamic":
         return "cpu"
     if count == 1:
         return "cuda:0"
+    smallest = min(g["vram_gb"] for g in gpu_info["gpus"]) * 1024 ** 3
+    if model_bytes is not None and model_bytes * 1.3 < smallest:
+        log.info(f"A modell (~{model_bytes / 1024 ** 3:.1f} GB, {quantization}) egy GPU-n "
+                 f"is elfér – REPLICAS=auto a többi GPU kihasználásához.")
+        return "cuda:0"
     # 2+ GPU: accelerate auto-balancing
     log.info(f"Multi-GPU mód: {count} GPU között osztjuk szét a modellt.")
     return "auto"
 
 
-def build_max_memory(gpu_info: dict) -> Optional[dict]:
+def resolve_replica_count(gpu_info: dict, quantization: str = "fp16") -> int:
+    """
+    REPLICAS értelmezése: "auto" GPU-nként egy replikát jelent. CPU-n (GPU
+    nélkül vagy int8_dynamic módban) mindig egy: a replikák egy folyamat
+    szálai lennének ugyanazokon a magokon, ami csak lassít.
+    """
+    requested = (
+        gpu_info["device_count"] if REPLICAS.strip().lower() == "auto" else int(REPLICAS)
+    )
+    requested = max(1, requested)
+    _replica_info["requested"] = requested
+    if requested > 1 and (gpu_info["device_count"] == 0 or quantization == "int8_dynamic"):
+        _replica_info["note"] = (
+            f"REPLICAS={requested} figyelmen kívül hagyva: CPU-n a replikák nem "
+            f"skálázódnak (mérve 2 replikával 0.75x token/s), egy replika fut."
+        )
+        log.warning(_replica_info["note"])
+        return 1
+    return requested
+
+
+def build_replica_devices(gpu_info: dict, count: int) -> list[str]:
+    """
+    Replikánként egy teljes modell egy eszközön (a modellnek el kell férnie
+    egy kártyán). Több replika, mint GPU esetén körbeosztás.
+    """
+    return [f"cuda:{i % gpu_info['device_count']}" for i in range(count)]
+
+
+def build_max_memory(gpu_info: dict, quantization: str = "fp16") -> Optional[dict]:
     """
     Explicit memóriakorlát GPU-nként.
     18 GB-os teljes VRAM esetén megpróbálunk ~8.5 GB-ot hagyni mindkét kártyán.
+    A bitsandbytes kvantált súlyai nem tehetők CPU-ra, ott nincs CPU fallback.
     """
     count = gpu_info["device_count"]
-    if count < 2:
+    if count < 2 or quantization == "int8_dynamic":
         return None
 
     max_mem = {}
@@ -100,7 +321,8 @@ def build_max_memory(gpu_info: dict) -> Optional[dict]:
         max_mem[g["index"]] = f"{safe_vram:.0f}GiB"
 
     # CPU fallback ha szükséges
-    max_mem["cpu"] = "24GiB"
+    if quantization == "fp16":
+        max_mem["cpu"] = "24GiB"
     log.info(f"Max memória GPU-nként: {max_mem}")
     return max_mem
 
@@ -109,37 +331,129 @@ def build_max_memory(gpu_info: dict) -> Optional[dict]:
 # ---------------------------------------------------------------------------
 _model: Optional[AutoModelForCausalLM] = None
 _tokenizer: Optional[AutoTokenizer] = None
+_draft_model: Optional[AutoModelForCausalLM] = None
+# Replikánként (modell, draft modell); az első megegyezik a _model/_draft_model-lel
+_replica_models: list[tuple] = []
+# A ténylegesen használt kvantálási mód és a betöltött súlyok mérete
+_quantization_info: dict = {"mode": None, "footprint_bytes": []}
+# A kért replikaszám, és ha ettől eltértünk, miért
+_replica_info: dict = {"requested": 1, "note": None}
+# GPU-nkénti memóriakorlát (build_max_memory); a KV blokk-pool méretezéséhez
+_max_memory: Optional[dict] = None
+
+
+# ---------------------------------------------------------------------------
+# Betöltési állapot (a szerver a modell betöltése alatt is válaszol)
+# ---------------------------------------------------------------------------
+SNAPSHOT_META_FILE = "clawdbot_snapshot.json"
+
+_readiness = {
+    "stage": "starting",
+    "progress": 0.0,
+    "started_at": time.time(),
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "source": None,
+    "error": None,
+}
+_ready: Optional[asyncio.Event] = None
+
+
+def _set_stage(stage: str, progress: float) -> None:
+    _readiness["stage"] = stage
+    _readiness["progress"] = progress
+    log.info(f"Betöltési fázis: {stage} ({progress:.0%})")
 
 
-def load_model():
-    global _model, _tokenizer
+def _read_snapshot_meta(path: Optional[str]) -> Optional[dict]:
+    if not path:
+        return None
+    meta_path = os.path.join(path, SNAPSHOT_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_model(use_snapshot: bool = True, quantization: str = QUANTIZATION):
+    global _model, _tokenizer, _draft_model, _replica_models, _max_memory
 
     gpu_info = detect_gpus()
-    device_map = build_device_map(gpu_info)
-    max_memory = build_max_memory(gpu_info)
+    quantization = resolve_quantization(gpu_info, quantization)
+    # Snapshot készítésekor egyetlen példány kell
+    replicas = resolve_replica_count(gpu_info, quantization) if use_snapshot else 1
 
-    log.info(f"Modell betöltése: {MODEL_NAME}")
-    log.info(f"dtype: float16 | device_map: {device_map}")
+    # Snapshot: mmap-elt safetensors, már fp16, a korábbi device_map-pel
+    source = MODEL_NAME
+    meta = _read_snapshot_meta(MODEL_SNAPSHOT_DIR) if use_snapshot else None
+    if meta is not None:
+        source = MODEL_SNAPSHOT_DIR
 
+    device_map = build_device_map(gpu_info, quantization, estimate_model_bytes(source, quantization))
+    max_memory = _max_memory = build_max_memory(gpu_info, quantization)
+    if meta is not None:
+        if (meta.get("device_map") and replicas == 1 and quantization == "fp16"
+                and meta.get("gpu_count") == gpu_info["device_count"]):
+            device_map = meta["device_map"]
+        log.info(f"Snapshot használata: {source} (forrás: {meta.get('source_model')})")
+    elif use_snapshot and MODEL_SNAPSHOT_DIR:
+        log.warning(f"Nincs snapshot itt: {MODEL_SNAPSHOT_DIR} – betöltés az eredeti modellből.")
+    _readiness["source"] = source
+
+    log.info(f"Modell betöltése: {source}")
+    if replicas > 1:
+        devices = build_replica_devices(gpu_info, replicas)
+        log.info(f"kvantálás: {quantization} | {replicas} replika: {devices}")
+    else:
+        devices = [None]
+        log.info(f"kvantálás: {quantization} | device_map: {device_map}")
+
+    _set_stage("loading_tokenizer", 0.05)
     _tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME,
+        source,
         use_fast=True,
         trust_remote_code=True,
     )
+    if _tokenizer.pad_token is None:
+        _tokenizer.pad_token = _tokenizer.eos_token
 
-    load_kwargs = dict(
-        torch_dtype=torch.float16,
-        device_map=device_map,
-        trust_remote_code=True,
-        low_cpu_mem_usage=True,
-    )
-    if max_memory:
-        load_kwargs["max_memory"] = max_memory
+    _replica_models = []
+    for r, device in enumerate(devices):
+        load_kwargs = dict(
+            device_map=device_map if device is None else {"": device},
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+            **_quantization_kwargs(quantization),
+        )
+        if max_memory and device is None:
+            load_kwargs["max_memory"] = max_memory
+        if meta is not None:
+            load_kwargs["use_safetensors"] = True
+
+        _set_stage("loading_model", 0.15 + 0.7 * r / len(devices))
+        model = AutoModelForCausalLM.from_pretrained(source, **load_kwargs)
+        model = _apply_quantization(model.eval(), quantization)
+        log.info(f"Modell sikeresen betöltve ({r + 1}/{len(devices)}), "
+                 f"súlyok: {_model_footprint(model) / 1024 ** 3:.2f} GB.")
 
-    _model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, **load_kwargs)
-    _model.eval()
+        draft = None
+        if DRAFT_MODEL_NAME and use_snapshot:
+            _set_stage("loading_draft_model", 0.15 + 0.7 * (r + 0.9) / len(devices))
+            log.info(f"Draft modell betöltése (spekulatív dekódolás): {DRAFT_MODEL_NAME}")
+            draft = AutoModelForCausalLM.from_pretrained(
+                DRAFT_MODEL_NAME,
+                device_map={"": str(_model_device(model))},
+                trust_remote_code=True,
+                low_cpu_mem_usage=True,
+                **_quantization_kwargs(quantization),
+            )
+            draft = _apply_quantization(draft.eval(), quantization)
 
-    log.info("Modell sikeresen betöltve.")
+        _replica_models.append((model, draft))
+
+    _model, _draft_model = _replica_models[0]
+    _quantization_info["mode"] = quantization
+    _quantization_info["footprint_bytes"] = [_model_footprint(m) for m, _ in _replica_models]
 
     # GPU memória kiírása betöltés után
     if torch.cuda.is_available():
@@ -148,16 +462,185 @@ def load_model():
             total = torch.cuda.get_device_properties(i).total_memory / (1024**3)
             log.info(f"  GPU {i} mem: {alloc:.2f} / {total:.2f} GB használatban")
 
+
+def create_snapshot(out_dir: str) -> None:
+    """
+    Snapshot készítése: a modell a szokásos módon betöltődik, majd fp16
+    safetensors shardokba mentődik a tokenizerrel és a device_map-pel együtt.
+    """
+    load_model(use_snapshot=False, quantization="fp16")
+    os.makedirs(out_dir, exist_ok=True)
+
+    log.info(f"Snapshot mentése: {out_dir} (shard: {SNAPSHOT_SHARD_SIZE})")
+    _model.save_pretrained(out_dir, safe_serialization=True, max_shard_size=SNAPSHOT_SHARD_SIZE)
+    _tokenizer.save_pretrained(out_dir)
+
+    # A device_map értékei lehetnek torch.device-ok (CPU módban) – JSON-hoz szöveggé
+    device_map = getattr(_model, "hf_device_map", None)
+    if device_map is not None:
+        device_map = {k: v if isinstance(v, (int, str)) else str(v) for k, v in device_map.items()}
+    meta = {
+        "source_model": MODEL_NAME,
+        "dtype": "float16",
+        "device_map": device_map,
+        "gpu_count": torch.cuda.device_count() if torch.cuda.is_available() else 0,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(out_dir, SNAPSHOT_META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    log.info("Snapshot kész.")
+
 # ---------------------------------------------------------------------------
 # FastAPI lifespan (betöltés induláskor)
 # ---------------------------------------------------------------------------
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, load_model)
+    global _response_cache, _ready, _dispatcher, _microbatcher, _admission, _prompt_encoder
+    global _draining
+    _ready = asyncio.Event()
+    if RESPONSE_CACHE_SIZE > 0:
+        _response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+    # A betöltés háttérben fut: a szerver azonnal fogad kéréseket,
+    # a /health a haladást mutatja, a /generate kivárja a készenlétet.
+    startup = asyncio.create_task(_startup())
     yield
+    # A futó kérések kivárása már a leállítási jelnél megtörtént
+    # (_GracefulServer); ide csak a kapcsolatok lezárása után jutunk
     log.info("Szerver leáll.")
+    _draining = True
+    if not startup.done():
+        startup.cancel()
+    if _dispatcher is not None:
+        await asyncio.get_running_loop().run_in_executor(None, _dispatcher.stop)
+    if _response_cache is not None:
+        await asyncio.get_running_loop().run_in_executor(None, _response_cache.close)
+    _dispatcher = _microbatcher = _admission = _prompt_encoder = None
+    _draining = False
+
+
+async def _startup() -> None:
+    global _dispatcher, _microbatcher, _admission, _prompt_encoder
+    loop = asyncio.get_running_loop()
+    _readiness.update(started_at=time.time(), load_seconds=None, warmup_seconds=None, error=None)
+    try:
+        await loop.run_in_executor(None, load_model)
+        _set_stage("initializing", 0.95)
+        _prompt_encoder = PromptEncoder(_tokenizer)
+        dispatcher = ReplicaDispatcher([
+            GenerationScheduler(model, _tokenizer, draft_model=draft, replica=i)
+            for i, (model, draft) in enumerate(_replica_models)
+        ])
+        for s in dispatcher.replicas:
+            st = s.kv_pool.stats()
+            log.info(f"KV pool (replika {s.replica}): {st['total_blocks']} blokk × "
+                     f"{st['block_size']} token ({st['capacity_mb']} MB)")
+        dispatcher.start()
+        if WARMUP_BUCKETS:
+            # A kérések csak a bemelegítés után jutnak a modellhez
+            _set_stage("warming_up", 0.97)
+            try:
+                _readiness["warmup_seconds"] = await _warmup(dispatcher.replicas)
+            except BaseException:
+                await loop.run_in_executor(None, dispatcher.stop)
+                raise
+            log.info(f"Bemelegítés kész: {_readiness['warmup_seconds']} mp")
+        _dispatcher = dispatcher
+        _admission = AdmissionController(
+            _derive_token_budget(_dispatcher.replicas),
+            ADMISSION_BATCH_SHARE,
+            ADMISSION_MAX_QUEUE,
+            ADMISSION_QUEUE_TIMEOUT,
+        )
+        log.info(f"Beengedési token-keret: {_admission.budget} "
+                 f"(batch: {_admission.batch_budget})")
+        if MICROBATCH_WINDOW_MS > 0:
+            _microbatcher = MicroBatcher(_dispatcher, MICROBATCH_WINDOW_MS, MICROBATCH_MAX_SIZE)
+            log.info(f"Mikro-batching: {MICROBATCH_WINDOW_MS} ms / max {MICROBATCH_MAX_SIZE} kérés")
+        _readiness["load_seconds"] = round(time.time() - _readiness["started_at"], 2)
+        _set_stage("ready", 1.0)
+    except Exception as e:
+        log.exception("Modell betöltési hiba")
+        _readiness["error"] = str(e)
+        _set_stage("failed", _readiness["progress"])
+    finally:
+        _ready.set()
+
+
+WARMUP_PROMPT = (
+    "Írj egy Python függvényt, amely beolvas egy CSV fájlt, soronként "
+    "validálja a mezőket, és a hibás sorokat naplózva egy listát ad vissza."
+)
+
+
+async def _warmup(schedulers: list["GenerationScheduler"]) -> float:
+    """
+    Reprezentatív promptok minden WARMUP_BUCKETS hosszon, replikánként
+    párhuzamosan: előbb egyenként (prefill alakok), majd egyszerre
+    (batch-elt dekódolás). A CUDA kontextus, a kernel-hangolás, az
+    allokátor növekedése és a torch.compile fordítás így nem a valódi
+    kérésekre esik. Sikertelen fordításnál a replika eager módban marad.
+    Visszatérés: az eltelt idő mp-ben.
+    """
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    req = GenerateRequest(prompt="", max_new_tokens=WARMUP_MAX_NEW_TOKENS, temperature=0.0)
+    longest = max(WARMUP_BUCKETS)
+    text = WARMUP_PROMPT
+    ids = _prompt_encoder.encode_prompt_sync(req.model_copy(update={"prompt": text}))
+    while len(ids) < longest:
+        text = f"{text}\n{WARMUP_PROMPT}"
+        ids = _prompt_encoder.encode_prompt_sync(req.model_copy(update={"prompt": text}))
+
+    async def run(s: "GenerationScheduler", n: int) -> None:
+        done = loop.create_future()
+        # A prompt vége (a válasz fejléc) marad meg, mint a valódi kéréseknél
+        seq = _Sequence(
+            req,
+            on_finish=lambda q: loop.call_soon_threadsafe(_set_future, done, q, None),
+            prompt_ids=ids[-n:],
+        )
+        seq.mode = "warmup"
+        s.submit(seq)
+        await done
+        if seq.error is not None:
+            raise seq.error
+
+    async def warm(s: "GenerationScheduler") -> None:
+        context = getattr(s.model.config, "max_position_embeddings", None) or 2048
+        lengths = sorted({
+            max(1, min(b, context - WARMUP_MAX_NEW_TOKENS)) for b in WARMUP_BUCKETS if b > 0
+        })
+        try:
+            for n in lengths:
+                await run(s, n)
+        except Exception:
+            if not s.compiled:
+                raise
+            log.exception(f"torch.compile hiba (replika {s.replica}) – eager dekódolás")
+            s.disable_compile()
+            for n in lengths:
+                await run(s, n)
+        await asyncio.gather(*(run(s, n) for n in lengths))
+        if s.prefix_cache is not None:
+            s.prefix_cache.clear()
+
+    await asyncio.gather(*(warm(s) for s in schedulers))
+    return round(time.perf_counter() - t0, 2)
+
+
+async def _await_ready() -> None:
+    """Betöltés alatt a kérés sorban áll (503 helyett), legfeljebb READY_WAIT_TIMEOUT-ig."""
+    if _draining:
+        raise HTTPException(503, "A szerver leáll.", headers={"Retry-After": "5"})
+    if _dispatcher is not None:
+        return
+    try:
+        await asyncio.wait_for(_ready.wait(), READY_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "A modell még nem töltődött be.")
+    if _dispatcher is None:
+        raise HTTPException(503, f"A modell betöltése sikertelen: {_readiness['error']}")
 
 
 app = FastAPI(
@@ -178,10 +661,40 @@ class GenerateRequest(BaseModel):
     top_k: int = Field(50, ge=0)
     repetition_penalty: float = Field(1.1, ge=0.5, le=2.0)
     stream: bool = Field(False, description="Streaming válasz SSE-n keresztül")
+    stream_format: Literal["sse", "ndjson"] = Field(
+        "sse",
+        description="Streaming formátum: SSE szövegdarabok, vagy NDJSON keretek "
+                    "token id-kkal, szövegdeltával és időzítéssel",
+    )
+    logprobs: bool = Field(
+        False, description="Tokenenkénti log-valószínűség az NDJSON keretekben"
+    )
+    priority: Literal["interactive", "batch"] = Field(
+        "interactive",
+        description="Prioritási osztály: a batch kérések csak a token-keret egy részét kapják",
+    )
+    session_id: Optional[str] = Field(
+        None,
+        description="Munkamenet azonosító: azonos replikára irányít (prefix cache találat)",
+    )
+    stop: Optional[list[str]] = Field(
+        None,
+        max_length=16,
+        description="Stop szekvenciák (None = alapértelmezés a sablonból, [] = nincs)",
+    )
+    timeout: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Határidő mp-ben: lejártakor a generálás az addigi szöveggel zárul",
+    )
     system_prompt: Optional[str] = Field(
         None,
         description="Opcionális rendszer prompt (a felhasználói prompt elé kerül)",
     )
+    profile: bool = Field(
+        False,
+        description="Profilozás: trace a lemezre (GET /profiles/{id}) és időbontás a válaszban",
+    )
 
 
 class GenerateResponse(BaseModel):
@@ -189,148 +702,3589 @@ class GenerateResponse(BaseModel):
     tokens_generated: int
     elapsed_seconds: float
     model: str
+    finish_reason: Optional[str] = Field(None, description="eos | stop | length | timeout | ...")
+    stop_sequence: Optional[str] = Field(None, description="A generálást leállító stop szekvencia")
+    draft_acceptance_rate: Optional[float] = Field(
+        None, description="Elfogadott / javasolt draft tokenek (csak spekulatív dekódolásnál)"
+    )
+    profile: Optional[dict] = Field(
+        None, description="Fázis- és tokenenkénti időbontás + trace azonosító (csak profile kérésnél)"
+    )
+
+
+class ChatMessage(BaseModel):
+    role: Literal["system", "user", "assistant"]
+    content: str
+
+
+class ChatRequest(GenerateRequest):
+    """
+    Strukturált chat kérés. session_id esetén a szerver őrzi az előzményt,
+    elég az új üzenetet küldeni; nélküle a messages a teljes beszélgetés.
+    """
+    prompt: str = Field("", description="Új felhasználói üzenet (a messages után fűzve)")
+    messages: list[ChatMessage] = Field(
+        default_factory=list,
+        description="Üzenetek (munkamenetnél az előzmény végére kerülnek)",
+    )
+
+
+class TokenizeRequest(BaseModel):
+    text: Union[str, list[str]] = Field(..., description="Szöveg vagy szövegek listája (kötegelve)")
+    template: bool = Field(
+        False, description="A /generate prompt sablonjával (és a kezdő speciális tokenekkel)"
+    )
+    system_prompt: Optional[str] = Field(None, description="Sablon esetén a rendszer prompt")
+
+
+class ChatResponse(GenerateResponse):
+    session_id: Optional[str] = None
+    prompt_tokens: int = Field(..., description="A csonkolt előzménnyel együtt a prompt hossza")
+    truncated_messages: int = Field(0, description="A kontextusablak miatt kihagyott üzenetek")
 
 
 # ---------------------------------------------------------------------------
 # Generálási segédfüggvény
 # ---------------------------------------------------------------------------
 
+# A prompt sablon szegmensei – a PromptEncoder ezeket külön tokenizálja és cache-eli
+PROMPT_SEGMENTS = {
+    "system": "### System:\n{}\n\n",
+    "user": "### Instruction:\n{}\n\n",
+    "assistant": "### Response:\n{}\n\n",
+}
+GENERATION_PROMPT = "### Response:\n"
+
+
+def _prompt_segments(req: GenerateRequest) -> list[str]:
+    segments = []
+    if req.system_prompt:
+        segments.append(PROMPT_SEGMENTS["system"].format(req.system_prompt))
+    segments.append(PROMPT_SEGMENTS["user"].format(req.prompt))
+    segments.append(GENERATION_PROMPT)
+    return segments
+
+
 def _build_full_prompt(req: GenerateRequest) -> str:
     """WizardCoder stílusú prompt formátum."""
-    if req.system_prompt:
-        return (
-            f"### System:\n{req.system_prompt}\n\n"
-            f"### Instruction:\n{req.prompt}\n\n"
-            f"### Response:\n"
-        )
-    return f"### Instruction:\n{req.prompt}\n\n### Response:\n"
+    return "".join(_prompt_segments(req))
 
 
-def _get_input_device() -> str:
-    """Az első GPU (ahol az embedding van) – ide kerülnek az inputok."""
-    if torch.cuda.is_available():
-        return "cuda:0"
-    return "cpu"
+def _resolve_stops(req: GenerateRequest) -> list[str]:
+    return [s for s in (DEFAULT_STOP_SEQUENCES if req.stop is None else req.stop) if s]
+
+
+def _model_device(model) -> torch.device:
+    """A modell bemeneti eszköze (replikánként eltérhet)."""
+    return model.get_input_embeddings().weight.device
 
 
 # ---------------------------------------------------------------------------
-# Endpointok
+# Metrikák (Prometheus text formátum, külső függőség nélkül)
 # ---------------------------------------------------------------------------
 
-@app.get("/health")
-async def health():
-    gpu_info = []
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+_TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+_RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+_RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{_format_labels(labels)} {value}" for name, labels, value in self.samples()]
+        return lines
+
+    def samples(self) -> list[tuple]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[tuple]:
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Pillanatnyi érték; fn megadásakor lekérdezéskor számolódik (címke → érték dict)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Optional[Callable[[], dict]] = None):
+        super().__init__(name, help_text)
+        self._fn = fn
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list[tuple]:
+        if self._fn is not None:
+            try:
+                values = self._fn()
+            except Exception:
+                return []
+            return [(self.name, tuple(sorted(k)), v) for k, v in values.items()]
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        self._series: dict[tuple, list] = {}   # címkék → [bucket számlálók, sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> list[tuple]:
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                for bound, c in zip(self.buckets, counts):
+                    out.append((f"{self.name}_bucket", key + (("le", bound),), c))
+                out.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                out.append((f"{self.name}_sum", key, round(total, 6)))
+                out.append((f"{self.name}_count", key, count))
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def _memory_gauge() -> dict:
+    values = {}
     if torch.cuda.is_available():
         for i in range(torch.cuda.device_count()):
-            alloc = torch.cuda.memory_allocated(i) / (1024**3)
-            total = torch.cuda.get_device_properties(i).total_memory / (1024**3)
-            gpu_info.append({
-                "index": i,
-                "name": torch.cuda.get_device_properties(i).name,
-                "used_gb": round(alloc, 2),
-                "total_gb": round(total, 2),
-            })
-    return {
-        "status": "ok",
-        "model": MODEL_NAME,
-        "model_loaded": _model is not None,
-        "gpus": gpu_info,
-    }
+            values[(("device", f"cuda:{i}"), ("kind", "allocated"))] = torch.cuda.memory_allocated(i)
+            values[(("device", f"cuda:{i}"), ("kind", "reserved"))] = torch.cuda.memory_reserved(i)
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        values[(("device", "cpu"), ("kind", "rss"))] = rss_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    return values
 
 
-@app.post("/generate", response_model=GenerateResponse)
-async def generate(req: GenerateRequest):
-    if _model is None or _tokenizer is None:
-        raise HTTPException(503, "A modell még nem töltődött be.")
+def _scheduler_gauge() -> dict:
+    if _dispatcher is None:
+        return {}
+    values = {}
+    for s in _dispatcher.replicas:
+        st = s.stats()
+        for k in ("waiting", "prefilling", "running", "paused"):
+            values[(("replica", s.replica), ("state", k))] = st[k]
+    return values
 
-    if req.stream:
-        return await _stream_response(req)
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, _generate_sync, req)
-    return result
+def _prefill_gauge() -> dict:
+    if _dispatcher is None:
+        return {}
+    return {(("replica", s.replica),): s.stats()["prefill_pending_tokens"] for s in _dispatcher.replicas}
 
 
-async def _stream_response(req: GenerateRequest) -> StreamingResponse:
-    """Server-Sent Events alapú streaming."""
+def _kv_pool_gauge() -> dict:
+    if _dispatcher is None:
+        return {}
+    values = {}
+    for s in _dispatcher.replicas:
+        values[(("replica", s.replica), ("state", "used"))] = s.kv_pool.used
+        values[(("replica", s.replica), ("state", "free"))] = s.kv_pool.free
+    return values
 
-    async def event_generator() -> AsyncGenerator[str, None]:
-        streamer = TextIteratorStreamer(
-            _tokenizer, skip_prompt=True, skip_special_tokens=True
-        )
-        full_prompt = _build_full_prompt(req)
-        inputs = _tokenizer(full_prompt, return_tensors="pt").to(_get_input_device())
-
-        gen_kwargs = dict(
-            **inputs,
-            max_new_tokens=req.max_new_tokens,
-            temperature=req.temperature,
-            top_p=req.top_p,
-            top_k=req.top_k,
-            repetition_penalty=req.repetition_penalty,
-            do_sample=req.temperature > 0,
-            streamer=streamer,
-            pad_token_id=_tokenizer.eos_token_id,
-        )
 
-        thread = Thread(target=_model.generate, kwargs=gen_kwargs, daemon=True)
-        thread.start()
+def _admission_gauge() -> dict:
+    if _admission is None:
+        return {}
+    st = _admission.stats()
+    return {(("kind", k),): st[k] for k in ("budget", "in_use", "queued")}
 
-        for token_text in streamer:
-            yield f"data: {token_text}\n\n"
 
-        thread.join()
-        yield "data: [DONE]\n\n"
+METRICS = MetricsRegistry()
+M_REQUESTS = METRICS.register(Counter(
+    "clawdbot_requests_total", "Befejezett generálási kérések (mód, befejezés oka)"))
+M_TOKENS = METRICS.register(Counter(
+    "clawdbot_generated_tokens_total", "Összes generált token"))
+M_IN_FLIGHT = METRICS.register(Gauge(
+    "clawdbot_requests_in_flight", "Folyamatban lévő /generate kérések"))
+M_DISCONNECTS = METRICS.register(Counter(
+    "clawdbot_client_disconnects_total", "Válasz előtt bontott kapcsolatok (megszakított kérések)"))
+M_SEQUENCES = METRICS.register(Gauge(
+    "clawdbot_scheduler_sequences", "Szekvenciák az ütemezőben állapot szerint", _scheduler_gauge))
+M_PREFILL_PENDING = METRICS.register(Gauge(
+    "clawdbot_prefill_pending_tokens", "Még fel nem dolgozott prompt-tokenek (darabolt prefill)",
+    _prefill_gauge))
+M_PREFILL_CHUNKS = METRICS.register(Counter(
+    "clawdbot_prefill_chunks_total", "Prefill darabok és feldolgozott prompt-tokenek replikánként"))
+M_MEMORY = METRICS.register(Gauge(
+    "clawdbot_memory_bytes", "Memóriahasználat eszközönként", _memory_gauge))
+M_KV_BLOCKS = METRICS.register(Gauge(
+    "clawdbot_kv_pool_blocks", "KV blokk-pool foglaltsága replikánként", _kv_pool_gauge))
+M_KV_POOL_EVENTS = METRICS.register(Counter(
+    "clawdbot_kv_pool_events_total", "KV pool: helyhiány miatt várakozó (deferred) és elutasított kérések"))
+M_PHASE = METRICS.register(Histogram(
+    "clawdbot_phase_seconds",
+    "Kérésenkénti fázisidők (queue, tokenize, prefill, decode, detokenize)",
+    _LATENCY_BUCKETS))
+M_LATENCY = METRICS.register(Histogram(
+    "clawdbot_request_duration_seconds", "Teljes kérésidő (sorba állástól a végéig)",
+    _LATENCY_BUCKETS))
+M_TTFT = METRICS.register(Histogram(
+    "clawdbot_time_to_first_token_seconds", "Első token megjelenéséig eltelt idő",
+    _LATENCY_BUCKETS))
+M_PROMPT_LEN = METRICS.register(Histogram(
+    "clawdbot_prompt_tokens", "Prompt hossza tokenben", _TOKEN_BUCKETS))
+M_GEN_LEN = METRICS.register(Histogram(
+    "clawdbot_generated_tokens", "Generált tokenek száma kérésenként", _TOKEN_BUCKETS))
+M_TOKENS_PER_SEC = METRICS.register(Histogram(
+    "clawdbot_tokens_per_second", "Dekódolási sebesség kérésenként", _RATE_BUCKETS))
+M_RESPONSE_CACHE = METRICS.register(Counter(
+    "clawdbot_response_cache_total", "Válasz cache lekérdezések (hit, miss, bypass)"))
+M_SPEC_TOKENS = METRICS.register(Counter(
+    "clawdbot_speculative_tokens_total", "Spekulatív dekódolás: javasolt és elfogadott draft tokenek"))
+M_SPEC_ACCEPTANCE = METRICS.register(Histogram(
+    "clawdbot_speculative_acceptance_ratio", "Draft tokenek elfogadási aránya kérésenként",
+    _RATIO_BUCKETS))
+M_ADMISSION = METRICS.register(Counter(
+    "clawdbot_admission_total", "Beengedési döntések (prioritás, admitted/queued/rejected)"))
+M_ADMISSION_TOKENS = METRICS.register(Gauge(
+    "clawdbot_admission_tokens", "Beengedési token-keret, foglalt és várakozó tokenek",
+    _admission_gauge))
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
 
+def _record_sequence_metrics(seq: "_Sequence") -> None:
+    """Egy befejezett szekvencia fázisidőinek rögzítése."""
+    M_REQUESTS.inc(mode=seq.mode, finish_reason=seq.finish_reason or "unknown")
+    # A bemelegítés (fordítás, kernel-hangolás) ne torzítsa a késleltetéseket
+    if seq.t_start is None or seq.mode == "warmup":
+        return
+    M_PHASE.observe(seq.t_start - seq.t_submit, phase="queue")
+    if seq.tokenize_s:
+        # Előre tokenizált promptnál a PromptEncoder méri
+        M_PHASE.observe(seq.tokenize_s, phase="tokenize")
+    M_PHASE.observe(seq.prefill_s, phase="prefill")
+    if seq.stopper is not None:
+        M_PHASE.observe(seq.detokenize_s, phase="detokenize")
+    M_PROMPT_LEN.observe(len(seq.prompt_ids))
+    M_GEN_LEN.observe(len(seq.output_ids))
+    M_TOKENS.inc(len(seq.output_ids))
+    M_LATENCY.observe(seq.t_end - seq.t_submit)
+    if seq.t_first_token is not None:
+        M_TTFT.observe(seq.t_first_token - seq.t_submit)
+        decode_s = seq.t_end - seq.t_first_token
+        M_PHASE.observe(decode_s, phase="decode")
+        if decode_s > 0 and len(seq.output_ids) > 1:
+            M_TOKENS_PER_SEC.observe((len(seq.output_ids) - 1) / decode_s)
+    if seq.spec_proposed:
+        M_SPEC_TOKENS.inc(seq.spec_proposed, kind="proposed")
+        M_SPEC_TOKENS.inc(seq.spec_accepted, kind="accepted")
+        M_SPEC_ACCEPTANCE.observe(seq.spec_accepted / seq.spec_proposed)
 
-def _generate_sync(req: GenerateRequest) -> GenerateResponse:
-    full_prompt = _build_full_prompt(req)
-    inputs = _tokenizer(full_prompt, return_tensors="pt").to(_get_input_device())
-    input_len = inputs["input_ids"].shape[1]
 
-    t0 = time.perf_counter()
-    with torch.no_grad():
-        outputs = _model.generate(
-            **inputs,
-            max_new_tokens=req.max_new_tokens,
-            temperature=req.temperature,
-            top_p=req.top_p,
-            top_k=req.top_k,
-            repetition_penalty=req.repetition_penalty,
-            do_sample=req.temperature > 0,
-            pad_token_id=_tokenizer.eos_token_id,
-        )
-    elapsed = time.perf_counter() - t0
+# ---------------------------------------------------------------------------
+# Profilozás (kérésenkénti trace + tokenidők)
+# ---------------------------------------------------------------------------
 
-    # Csak az újonnan generált tokenek
-    new_tokens = outputs[0][input_len:]
-    text = _tokenizer.decode(new_tokens, skip_special_tokens=True)
-    tokens_generated = len(new_tokens)
+class _ProfileRecord:
+    """Egy profilozott kérés mérései; a tokenidőket az ütemező szála tölti."""
 
-    return GenerateResponse(
-        text=text,
-        tokens_generated=tokens_generated,
-        elapsed_seconds=round(elapsed, 3),
-        model=MODEL_NAME,
-    )
+    def __init__(self, sampled: bool, trace: bool = True):
+        self.id = uuid.uuid4().hex
+        # Mintavételezett kérés: a válasz nem változik, csak a fejléc jelzi
+        self.sampled = sampled
+        self.trace = trace
+        self.tokenize_s: Optional[float] = None
+        self.cached_tokens = 0
+        self.token_times: list[float] = []
+        self.batch_sizes: list[int] = []
+        # None = fut / még nem indult; különben a trace sorsa (saved, busy, off, ...)
+        self.trace_status: Optional[str] = None
+        self.result: Optional[dict] = None
 
+    def summary(self, seq: "_Sequence") -> dict:
+        """Fázis- és tokenenkénti időbontás (ms)."""
+        def ms(value: Optional[float]) -> Optional[float]:
+            return round(value * 1000, 3) if value is not None else None
 
-@app.get("/gpu_info")
-async def gpu_info_endpoint():
-    return detect_gpus()
+        gaps = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+        started = seq.t_start is not None
+        return {
+            "id": self.id,
+            "sampled": self.sampled,
+            "backend": PROFILE_BACKEND,
+            "trace": self.trace_status,
+            "finish_reason": seq.finish_reason,
+            "prompt_tokens": len(seq.prompt_ids),
+            "cached_prompt_tokens": self.cached_tokens,
+            "tokens_generated": len(seq.output_ids),
+            "tokenize_ms": ms(self.tokenize_s if self.tokenize_s is not None else seq.tokenize_s),
+            "queue_ms": ms(seq.t_start - seq.t_submit) if started else None,
+            "prefill_ms": ms(seq.prefill_s) if started else None,
+            "decode_ms": (
+                ms(seq.t_end - seq.t_first_token)
+                if seq.t_first_token is not None and seq.t_end is not None else None
+            ),
+            "detokenize_ms": ms(seq.detokenize_s),
+            # Az első elem a beküldéstől az első tokenig (TTFT), a többi tokenköz
+            "token_ms": [ms(t) for t in ([self.token_times[0] - seq.t_submit] + gaps)]
+                        if self.token_times else [],
+            "decode_batch_sizes": self.batch_sizes,
+        }
+
+
+class RequestProfiler:
+    """
+    Kérésenkénti profilozás. Egyszerre egy trace fut (a torch profiler és a
+    cProfile is folyamatszintű); ami közben érkezik, csak az időbontást kapja.
+    Mintavételes kérés csak sample_traces mellett indít trace-t: a profiler
+    a vele egy batch-ben futó kéréseket is lassítja.
+    A trace a kérés prefilljétől indul az ütemező szálán, így a vele egy
+    batch-ben haladó kérések munkáját is tartalmazza, és PROFILE_MAX_STEPS
+    dekódolási lépés után leáll. Lemezre háttérszál ír; a legrégebbi
+    PROFILE_MAX_TRACES feletti profilok törlődnek.
+    """
+
+    def __init__(self, directory: str, backend: str, sample_rate: float,
+                 max_steps: int, max_traces: int, sample_traces: bool = False):
+        if backend not in ("torch", "cprofile"):
+            raise ValueError(f"Ismeretlen PROFILE_BACKEND: {backend} (torch | cprofile)")
+        self.directory = directory
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self.sample_traces = sample_traces
+        self.max_steps = max(1, max_steps)
+        self.max_traces = max(1, max_traces)
+        self._lock = threading.Lock()
+        self._owner: Optional[_ProfileRecord] = None
+        self._session = None
+        self._steps = 0
+        self.requested = 0
+        self.sampled = 0
+        self.traces_saved = 0
+        self.traces_skipped = 0
+
+    @property
+    def active(self) -> bool:
+        return self._session is not None
+
+    def begin(self, req: GenerateRequest) -> Optional[_ProfileRecord]:
+        """Profilozás eldöntése a tokenizálás előtt (kérésre vagy mintavétellel)."""
+        if req.profile:
+            self.requested += 1
+            return _ProfileRecord(sampled=False)
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.sampled += 1
+            return _ProfileRecord(sampled=True, trace=self.sample_traces)
+        return None
+
+    def start(self, record: _ProfileRecord) -> None:
+        """Trace indítása az ütemező szálán (ha kért és épp nem fut másik)."""
+        if not record.trace:
+            record.trace_status = "off"
+            return
+        with self._lock:
+            if self._session is not None:
+                record.trace_status = "busy"
+                self.traces_skipped += 1
+                return
+            self._owner = record
+            self._steps = 0
+            try:
+                if self.backend == "torch":
+                    activities = [torch.profiler.ProfilerActivity.CPU]
+                    if torch.cuda.is_available():
+                        activities.append(torch.profiler.ProfilerActivity.CUDA)
+                    self._session = torch.profiler.profile(activities=activities)
+                    self._session.start()
+                else:
+                    import cProfile
+                    self._session = cProfile.Profile()
+                    self._session.enable()
+            except Exception as e:
+                log.warning(f"Profilozás nem indítható: {e}")
+                self._session = self._owner = None
+                record.trace_status = "unavailable"
+                self.traces_skipped += 1
+
+    def range(self, name: str):
+        """Elnevezett szakasz a torch trace-ben (trace nélkül üres kontextus)."""
+        if self._session is None or self.backend != "torch":
+            return nullcontext()
+        return torch.profiler.record_function(name)
+
+    def step(self, seqs: list["_Sequence"]) -> None:
+        """Dekódolási lépés vége: a trace gazdájának lépéskorlátjánál leáll."""
+        owner = self._owner
+        if owner is None or not any(seq.profile is owner for seq in seqs):
+            return
+        self._steps += 1
+        if self._steps >= self.max_steps:
+            self._stop()
+
+    def finish(self, seq: "_Sequence") -> dict:
+        """A kérés vége: trace leállítása (ha övé) és az időbontás mentése."""
+        record = seq.profile
+        if self._owner is record:
+            self._stop()
+        record.result = record.summary(seq)
+        self._spawn(self._write_summary, record.result)
+        return record.result
+
+    def _stop(self) -> None:
+        with self._lock:
+            session, record = self._session, self._owner
+            self._session = self._owner = None
+        if session is None:
+            return
+        try:
+            if self.backend == "torch":
+                session.stop()
+            else:
+                session.disable()
+        except Exception as e:
+            log.warning(f"Profilozás leállítása sikertelen: {e}")
+            record.trace_status = "failed"
+            return
+        record.trace_status = "saved"
+        self.traces_saved += 1
+        # Az exportálás (akár több MB JSON) ne az ütemező szálán fusson
+        self._spawn(self._write_trace, record.id, session)
+
+    def _spawn(self, fn: Callable, *args) -> None:
+        threading.Thread(target=fn, args=args, name="clawdbot-profile-writer", daemon=True).start()
+
+    def trace_path(self, profile_id: str) -> str:
+        ext = "trace.json" if self.backend == "torch" else "prof"
+        return os.path.join(self.directory, f"{profile_id}.{ext}")
+
+    def _write_trace(self, profile_id: str, session) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.trace_path(profile_id) + ".tmp"
+            if self.backend == "torch":
+                session.export_chrome_trace(tmp)
+            else:
+                session.dump_stats(tmp)
+            os.replace(tmp, self.trace_path(profile_id))
+        except Exception as e:
+            log.warning(f"Trace mentése sikertelen ({profile_id}): {e}")
+
+    def _write_summary(self, summary: dict) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{summary['id']}.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({**summary, "created": time.time()}, f)
+            os.replace(path + ".tmp", path)
+            self._prune()
+        except Exception as e:
+            log.warning(f"Profil mentése sikertelen ({summary['id']}): {e}")
+
+    def _summaries(self) -> list:
+        """Időbontás-fájlok, a legrégebbivel kezdve."""
+        try:
+            entries = [
+                e for e in os.scandir(self.directory)
+                if e.name.endswith(".json") and not e.name.endswith(".trace.json")
+            ]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda e: e.stat().st_mtime)
+
+    def _prune(self) -> None:
+        for entry in self._summaries()[:-self.max_traces]:
+            profile_id = entry.name[:-len(".json")]
+            for path in (entry.path, self.trace_path(profile_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def load(self, profile_id: str) -> Optional[dict]:
+        if not profile_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{profile_id}.json"), encoding="utf-8") as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            return None
+        summary["trace_ready"] = os.path.exists(self.trace_path(profile_id))
+        return summary
+
+    def recent(self, limit: int = 50) -> list[dict]:
+        entries = self._summaries()[::-1][:limit]
+        profiles = [self.load(e.name[:-len(".json")]) for e in entries]
+        return [p for p in profiles if p is not None]
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "sample_rate": self.sample_rate,
+            "sample_traces": self.sample_traces,
+            "active": self.active,
+            "requested": self.requested,
+            "sampled": self.sampled,
+            "traces_saved": self.traces_saved,
+            "traces_skipped": self.traces_skipped,
+            "directory": self.directory,
+        }
+
+
+_profiler = RequestProfiler(
+    PROFILE_DIR, PROFILE_BACKEND, PROFILE_SAMPLE_RATE, PROFILE_MAX_STEPS, PROFILE_MAX_TRACES,
+    PROFILE_SAMPLE_TRACES,
+)
 
 
 # ---------------------------------------------------------------------------
-# Belépési pont
+# KV-cache segédfüggvények
 # ---------------------------------------------------------------------------
+# A cache-t "legacy" formában (rétegenként tuple-ök, tensor alak
+# [batch, ..., seq, dim]) kezeljük, így modelltípustól függetlenül
+# a 0. dimenzió a batch, a -2. dimenzió a szekvencia.
 
-if __name__ == "__main__":
-    uvicorn.run(
-        "model_server:app",
-        host=HOST,
-        port=PORT,
-        log_level="info",
-        workers=1,          # Több worker nem kompatibilis a GPU-megosztással
-    )
+def _kv_map(fn: Callable, kv):
+    """fn alkalmazása a cache minden tensorára (a szerkezet megtartásával)."""
+    if isinstance(kv, torch.Tensor):
+        return fn(kv)
+    return tuple(_kv_map(fn, x) for x in kv)
+
+
+def _kv_zip(fn: Callable, kvs: list):
+    """Több azonos szerkezetű cache összefésülése tensoronként."""
+    first = kvs[0]
+    if isinstance(first, torch.Tensor):
+        return fn(kvs)
+    return tuple(_kv_zip(fn, [kv[i] for kv in kvs]) for i in range(len(first)))
+
+
+def _kv_len(kv) -> int:
+    """A cache szekvencia hossza."""
+    while not isinstance(kv, torch.Tensor):
+        kv = kv[0]
+    return kv.shape[-2]
+
+
+def _kv_nbytes(kv) -> int:
+    if isinstance(kv, torch.Tensor):
+        return kv.numel() * kv.element_size()
+    return sum(_kv_nbytes(x) for x in kv)
+
+
+def _pad_left(t: torch.Tensor, n: int) -> torch.Tensor:
+    """n darab nulla pozíció a szekvencia dimenzió elejére."""
+    if n == 0:
+        return t
+    return F.pad(t, (0, 0, n, 0))
+
+
+def _cache_to_legacy(past):
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def _cache_from_legacy(model, legacy):
+    """Az újabb modellosztályok Cache objektumot várnak tuple helyett."""
+    if getattr(model, "_supports_cache_class", False):
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+
+def _empty_cache(model):
+    """Üres cache a prefillhez (None esetén az új modellek figyelmeztetnek)."""
+    if getattr(model, "_supports_cache_class", False):
+        return DynamicCache()
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Prefix KV-cache (közös system prompt + korábbi chat körök)
+# ---------------------------------------------------------------------------
+
+class _PrefixEntry:
+    def __init__(self, ids: list[int], past, nbytes: int, block_hashes: list[int]):
+        self.ids = ids
+        self.past = past
+        self.nbytes = nbytes
+        self.block_hashes = block_hashes
+
+
+class PrefixCache:
+    """
+    Korábbi promptok KV-cache-e, token-prefix hash-ek szerint indexelve.
+    A keresés blokkhatáron (block_size token) illeszt, így a közös
+    system prompt fejléc és a chat history eleje is újrahasznosul.
+    LRU kilakoltatás memóriakeret (bájt) alapján.
+    """
+
+    def __init__(self, budget_bytes: int, block_size: int = PREFIX_CACHE_BLOCK):
+        self.budget_bytes = budget_bytes
+        self.block_size = max(1, block_size)
+        self._entries: "OrderedDict[int, _PrefixEntry]" = OrderedDict()
+        self._index: dict[int, set[int]] = {}
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def _block_hashes(self, ids: list[int]) -> list[int]:
+        """Láncolt hash minden teljes blokk végéig: h[k] a ids[:(k+1)*block] prefixé."""
+        hashes, h, b = [], 0, self.block_size
+        for start in range(0, len(ids) - b + 1, b):
+            h = hash((h, tuple(ids[start:start + b])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, ids: list[int]) -> tuple[int, Optional[tuple]]:
+        """
+        A leghosszabb cache-elt prefix hossza és KV-ja.
+        Legalább egy tokent meghagyunk a prefillnek (kell a logits).
+        """
+        hashes = self._block_hashes(ids[:-1])
+        with self._lock:
+            for k in range(len(hashes) - 1, -1, -1):
+                keys = self._index.get(hashes[k])
+                if not keys:
+                    continue
+                n = (k + 1) * self.block_size
+                for key in keys:
+                    entry = self._entries[key]
+                    if entry.ids[:n] == ids[:n]:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        self.reused_tokens += n
+                        return n, _kv_map(lambda t: t[..., :n, :], entry.past)
+            self.misses += 1
+        return 0, None
+
+    def insert(self, ids: list[int], past) -> None:
+        if len(ids) < self.block_size:
+            return
+        nbytes = _kv_nbytes(past)
+        if nbytes > self.budget_bytes:
+            return
+        key = hash(tuple(ids))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            hashes = self._block_hashes(ids)
+            self._entries[key] = _PrefixEntry(list(ids), past, nbytes, hashes)
+            for h in hashes:
+                self._index.setdefault(h, set()).add(key)
+            self.bytes_used += nbytes
+            while self.bytes_used > self.budget_bytes:
+                self._evict_oldest()
+
+    def clear(self) -> None:
+        """Minden bejegyzés és statisztika törlése (pl. a bemelegítés után)."""
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self.bytes_used = 0
+            self.hits = self.misses = self.reused_tokens = self.evictions = 0
+
+    def _evict_oldest(self) -> None:
+        key, entry = self._entries.popitem(last=False)
+        for h in entry.block_hashes:
+            keys = self._index.get(h)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[h]
+        self.bytes_used -= entry.nbytes
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "used_mb": round(self.bytes_used / (1024 ** 2), 2),
+            "budget_mb": round(self.budget_bytes / (1024 ** 2), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "reused_tokens": self.reused_tokens,
+            "evictions": self.evictions,
+        }
+
+
+# ---------------------------------------------------------------------------
+# KV blokk-pool (lapozott memória-könyvelés)
+# ---------------------------------------------------------------------------
+
+class KVBlockPool:
+    """
+    Egy replika KV-cache memóriája block_size tokenes blokkokra osztva.
+    A szekvencia a prefill előtt a teljes hosszára (prompt + max_new_tokens)
+    foglal blokkokat, és a befejezéskor adja vissza őket: ami most nem fér
+    be, a sorban vár, ami üres pool mellett sem férne be, azonnal 413-at
+    kap – generálás közben így nem fogy el a memória. A balra paddolás
+    többletét az ADMISSION_MEMORY_FRACTION tartaléka fedezi.
+    Foglalni csak az ütemező szálából lehet.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int, bytes_per_token: int):
+        self.block_size = max(1, block_size)
+        self.num_blocks = max(1, num_blocks)
+        self.bytes_per_token = bytes_per_token
+        self.used = 0
+        self.peak_used = 0
+        self.deferred_total = 0
+        self.rejected_total = 0
+
+    @property
+    def capacity_tokens(self) -> int:
+        return self.num_blocks * self.block_size
+
+    @property
+    def capacity_bytes(self) -> int:
+        return self.capacity_tokens * self.bytes_per_token
+
+    @property
+    def free(self) -> int:
+        return self.num_blocks - self.used
+
+    def blocks_for(self, tokens: int) -> int:
+        return -(-tokens // self.block_size)
+
+    def check(self, tokens: int) -> None:
+        """413, ha a kérés üres pool mellett sem férne el."""
+        need = self.blocks_for(tokens)
+        if need > self.num_blocks:
+            self.rejected_total += 1
+            M_KV_POOL_EVENTS.inc(event="rejected")
+            raise HTTPException(
+                413,
+                f"A kérés KV-cache igénye ({need} blokk, {tokens} token) meghaladja "
+                f"a replika KV pooljának méretét ({self.num_blocks} blokk).",
+            )
+
+    def fits(self, seq: "_Sequence") -> bool:
+        return self.blocks_for(len(seq.prompt_ids) + seq.req.max_new_tokens) <= self.free
+
+    def reserve(self, seq: "_Sequence") -> bool:
+        need = self.blocks_for(len(seq.prompt_ids) + seq.req.max_new_tokens)
+        if need > self.free:
+            if not seq.kv_deferred:
+                seq.kv_deferred = True
+                self.deferred_total += 1
+                M_KV_POOL_EVENTS.inc(event="deferred")
+            return False
+        seq.kv_blocks = need
+        self.used += need
+        self.peak_used = max(self.peak_used, self.used)
+        return True
+
+    def release(self, seq: "_Sequence") -> None:
+        if seq.kv_blocks:
+            self.used -= seq.kv_blocks
+            seq.kv_blocks = 0
+
+    def stats(self) -> dict:
+        return {
+            "block_size": self.block_size,
+            "total_blocks": self.num_blocks,
+            "used_blocks": self.used,
+            "free_blocks": self.free,
+            "peak_used_blocks": self.peak_used,
+            "utilization": round(self.used / self.num_blocks, 3),
+            "capacity_tokens": self.capacity_tokens,
+            "capacity_mb": round(self.capacity_bytes / 1024 ** 2, 1),
+            "deferred_total": self.deferred_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+def _parse_memory(value) -> Optional[int]:
+    """A build_max_memory értékei ("17GiB") bájtban."""
+    if isinstance(value, int):
+        return value
+    for suffix, unit in (("GiB", 1024 ** 3), ("MiB", 1024 ** 2)):
+        if isinstance(value, str) and value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * unit)
+    return None
+
+
+def _model_cuda_devices(model) -> list[int]:
+    return sorted({p.device.index for p in model.parameters() if p.device.type == "cuda"})
+
+
+def _kv_pool_tokens(model) -> int:
+    """
+    KV_POOL_MB, vagy a replika GPU-in a betöltés utáni szabad memória
+    (eszközönként legfeljebb a build_max_memory korlátjáig) a prefix cache
+    keretét levonva, ADMISSION_MEMORY_FRACTION arányban. GPU nélkül
+    MAX_BATCH_SIZE teljes kontextusnyi token.
+    """
+    per_token = _kv_bytes_per_token(model)
+    if KV_POOL_MB > 0:
+        return KV_POOL_MB * 1024 ** 2 // per_token
+    context = getattr(model.config, "max_position_embeddings", None) or 2048
+    devices = _model_cuda_devices(model)
+    if not devices:
+        return MAX_BATCH_SIZE * context
+    free = 0
+    for i in devices:
+        available = torch.cuda.mem_get_info(i)[0]
+        limit = _parse_memory((_max_memory or {}).get(i))
+        if limit is not None:
+            available = min(available, limit - torch.cuda.memory_allocated(i))
+        free += max(0, available)
+    free = (free - PREFIX_CACHE_MB * 1024 ** 2) * ADMISSION_MEMORY_FRACTION
+    # Legalább egy teljes kontextusnyi kérésnek mindig el kell férnie
+    return max(int(free / per_token), context)
+
+
+def _preallocate_kv_pool(model, nbytes: int) -> None:
+    """
+    A pool memóriájának lefoglalása és azonnali elengedése: a CUDA caching
+    allokátor megtartja a szegmenst, így a növekvő KV tenzorok ebből
+    darabolódnak új cudaMalloc hívások (és memory_reserved csúcsok) helyett.
+    Rétegenkénti szétosztásnál a rész eszközönként egyenlő.
+
+    Csak addig hat, amíg az allokátor a szegmenst lefoglalva tartja: egy
+    torch.cuda.empty_cache() hívás (bárhonnan) visszaadja a drivernek, és
+    expandable_segments mellett sem marad egyben. Nem garancia – a memóriát
+    a KVBlockPool elszámolása korlátozza, ez csak a töredezettséget csökkenti.
+    """
+    devices = _model_cuda_devices(model)
+    for i in devices:
+        try:
+            block = torch.empty(nbytes // len(devices), dtype=torch.uint8, device=f"cuda:{i}")
+        except torch.cuda.OutOfMemoryError:
+            log.warning(f"A KV pool előfoglalása nem sikerült (cuda:{i}).")
+            continue
+        del block
+
+
+# ---------------------------------------------------------------------------
+# Tokenizálás (szegmens cache + kötegelt tokenizálás)
+# ---------------------------------------------------------------------------
+
+class PromptEncoder:
+    """
+    Prompt → token id-k a sablon szegmenseiből (rendszer prompt, utasítás,
+    válasz fejléc). A szegmensek külön kódolódnak és LRU-ban maradnak, így
+    az állandó részeket (sablon, rendszer prompt) csak egyszer tokenizáljuk,
+    a promptot id-k összefűzésével kapjuk. A hiányzó szegmenseket egy
+    háttérfeladat kötegben tokenizálja: az egyidejű kérések egy hívásba
+    kerülnek (a fast tokenizer a köteget párhuzamosan dolgozza fel).
+
+    Az összefűzés csak akkor egyezik a teljes szöveg kódolásával, ha a
+    tokenizer nem von össze tokent a szegmenshatárokon át. Byte-level BPE
+    (GPT-2, StarCoder) a "\n\n###" elejét másképp bontja, mint a szegmens
+    végi "\n\n"-t, így ott nem. Ezt induláskor próbapromptokkal ellenőrizzük;
+    ha bármelyik eltér, a prompt egyben kódolódik (a cache és a kötegelés
+    marad, csak a szegmensek közös része nem).
+    """
+
+    # A nem első szegmensek e horgony mögött kódolódnak (nincs szókezdő szóköz)
+    ANCHOR = "\n\n"
+    # Az ekvivalencia-próba felhasználói szövegei: a határ előtt szó,
+    # szóköz, sortörés és üres tartalom
+    PROBE_PROMPTS = ("Write a function", "hello  ", "x\n", "a\n\n\n", "", " ")
+
+    def __init__(self, tokenizer, cache_size: int = TOKENIZER_CACHE_SIZE,
+                 max_batch: int = TOKENIZER_MAX_BATCH):
+        self.tokenizer = tokenizer
+        self.cache_size = max(1, cache_size)
+        self.max_batch = max(1, max_batch)
+        self.prefix = tuple(tokenizer.encode("", add_special_tokens=True))
+        self._anchor = tokenizer.encode(self.ANCHOR, add_special_tokens=False)
+        self._cache: "OrderedDict[tuple[str, bool], tuple[int, ...]]" = OrderedDict()
+        # Az ütemező szál (prefill, mikro-batch) is használja
+        self._lock = threading.Lock()
+        self._pending: list[tuple[tuple[str, bool], asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self.segmented = self._probe()
+        if not self.segmented:
+            log.info("A tokenizer a szegmenshatárokon összevon – a promptok egyben kódolódnak.")
+        # A próba kötegei nem számítanak
+        self.batches = self.batched_texts = 0
+
+    # -- Szinkron út --------------------------------------------------------
+
+    def segment(self, text: str, first: bool = False) -> tuple[int, ...]:
+        """Egy szegmens id-i (first: a prompt elején áll, horgony nélkül)."""
+        ids = self._lookup((text, first))
+        if ids is None:
+            ids = self._encode_batch([(text, first)])[0]
+            self._store((text, first), ids)
+        return ids
+
+    def encode_prompt_sync(self, req: GenerateRequest) -> list[int]:
+        ids = list(self.prefix)
+        for i, text in enumerate(self._segments(req)):
+            ids.extend(self.segment(text, i == 0))
+        return ids
+
+    # -- Aszinkron (kötegelt) út --------------------------------------------
+
+    async def segments(self, items: list[tuple[str, bool]]) -> list[tuple[int, ...]]:
+        results: list[Optional[tuple[int, ...]]] = [self._lookup(item) for item in items]
+        missing = [i for i, ids in enumerate(results) if ids is None]
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = []
+            for i in missing:
+                fut = loop.create_future()
+                self._pending.append((items[i], fut))
+                futures.append(fut)
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._flush())
+            for i, ids in zip(missing, await asyncio.gather(*futures)):
+                results[i] = ids
+        return results
+
+    async def encode_prompt(self, req: GenerateRequest) -> list[int]:
+        t0 = time.perf_counter()
+        parts = await self.segments(
+            [(text, i == 0) for i, text in enumerate(self._segments(req))]
+        )
+        ids = list(self.prefix)
+        for part in parts:
+            ids.extend(part)
+        M_PHASE.observe(time.perf_counter() - t0, phase="tokenize")
+        return ids
+
+    async def _flush(self) -> None:
+        """Amíg van függő szegmens, kötegenként tokenizál (egyszerre egy köteg fut)."""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            # Azonos szöveg egy kötegen belül csak egyszer
+            items = list(dict.fromkeys(item for item, _ in batch))
+            try:
+                encoded = await loop.run_in_executor(None, self._encode_batch, items)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            by_item = dict(zip(items, encoded))
+            for item, ids in by_item.items():
+                self._store(item, ids)
+            for item, fut in batch:
+                if not fut.done():
+                    fut.set_result(by_item[item])
+
+    # -- Belső --------------------------------------------------------------
+
+    def _segments(self, req: GenerateRequest) -> list[str]:
+        return _prompt_segments(req) if self.segmented else [_build_full_prompt(req)]
+
+    def _probe(self) -> bool:
+        """A szegmensenkénti kódolás egyezik-e a teljes prompt kódolásával."""
+        for system_prompt in (None, "Be brief."):
+            for text in self.PROBE_PROMPTS:
+                req = GenerateRequest.model_construct(prompt=text, system_prompt=system_prompt)
+                segments = _prompt_segments(req)
+                ids = list(self.prefix)
+                for part in self._encode_batch([(t, i == 0) for i, t in enumerate(segments)]):
+                    ids.extend(part)
+                if ids != self.tokenizer("".join(segments))["input_ids"]:
+                    return False
+        return True
+
+    def _encode_batch(self, items: list[tuple[str, bool]]) -> list[tuple[int, ...]]:
+        texts = [text if first else self.ANCHOR + text for text, first in items]
+        encoded = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        self.batches += 1
+        self.batched_texts += len(texts)
+        out = []
+        n = len(self._anchor)
+        for (text, first), ids in zip(items, encoded):
+            if not first:
+                if ids[:n] == self._anchor:
+                    ids = ids[n:]
+                else:
+                    ids = self.tokenizer.encode(text, add_special_tokens=False)
+            out.append(tuple(ids))
+        return out
+
+    def _lookup(self, item: tuple[str, bool]) -> Optional[tuple[int, ...]]:
+        with self._lock:
+            ids = self._cache.get(item)
+            if ids is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(item)
+            self.hits += 1
+            return ids
+
+    def _store(self, item: tuple[str, bool], ids: tuple[int, ...]) -> None:
+        with self._lock:
+            self._cache[item] = ids
+            self._cache.move_to_end(item)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "max_entries": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "segmented": self.segmented,
+            "batches": self.batches,
+            "avg_batch_size": round(self.batched_texts / self.batches, 2) if self.batches else None,
+        }
+
+
+_prompt_encoder: Optional[PromptEncoder] = None
+
+
+# ---------------------------------------------------------------------------
+# Continuous batching ütemező
+# ---------------------------------------------------------------------------
+
+class _Sequence:
+    """Egy generálási kérés állapota az ütemezőben."""
+
+    def __init__(
+        self,
+        req: GenerateRequest,
+        on_token: Optional[Callable[["_Sequence", int], None]] = None,
+        on_finish: Optional[Callable[["_Sequence"], None]] = None,
+        prompt_ids: Optional[list[int]] = None,
+        deadline: Optional[float] = None,
+        profile: Optional[_ProfileRecord] = None,
+    ):
+        self.req = req
+        # Abszolút határidő (perf_counter); a kérés beérkezésétől számítva
+        self.deadline = deadline
+        self.on_token = on_token
+        self.on_finish = on_finish
+        # Előre tokenizált prompt (pl. /chat); üresen a prefill tokenizál
+        self.prompt_ids: list[int] = list(prompt_ids) if prompt_ids else []
+        self.output_ids: list[int] = []
+        # Csak logprobs kérésnél töltődik (a mintavételezési eloszlás szerint)
+        self.output_logprobs: list[float] = []
+        self.processors = _build_logits_processors(req)
+        # Szövegkövetés (stop szekvenciák, streaming); a prefill hozza létre
+        self.stopper: Optional[_StopChecker] = None
+        self.text_delta = ""
+        self.detokenize_s = 0.0
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.mode = "non_stream"
+        self.t_submit = time.perf_counter()
+        self.t_start: Optional[float] = None
+        self.t_first_token: Optional[float] = None
+        self.t_end: Optional[float] = None
+        self.tokenize_s = 0.0
+        self.prefill_s = 0.0
+        # Backpressure: az emitted-et az ütemező, a consumed-ot a fogyasztó írja
+        self.max_backlog: Optional[int] = None
+        self.emitted = 0
+        self.consumed = 0
+        self.paused = False
+        self.cancel_requested = False
+        # Spekulatív dekódolás: a draft modell saját cache-e (az első
+        # draft_len tokenre) és az elfogadási statisztika
+        self.draft_past = None
+        self.draft_len = 0
+        self.spec_proposed = 0
+        self.spec_accepted = 0
+        # KV blokk-pool: lefoglalt blokkok; a várakozás csak egyszer számít
+        self.kv_blocks = 0
+        self.kv_deferred = False
+        # Profilozott kérésnél tokenidők és (ha szabad) trace
+        self.profile = profile
+        # Darabolt prefill: a cache-ben lévő prompt-tokenek és a modell cache-e
+        self.prefill_pos = 0
+        self.prefill_past = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def stalled(self) -> bool:
+        """A fogyasztó lemaradt – a további dekódolás csak puffert töltene."""
+        return self.max_backlog is not None and self.emitted - self.consumed >= self.max_backlog
+
+    @property
+    def drained(self) -> bool:
+        """Szüneteltetés után csak félig ürült puffernél folytatjuk (hiszterézis)."""
+        return self.max_backlog is None or self.emitted - self.consumed <= self.max_backlog // 2
+
+    def cancel(self) -> None:
+        """Leállítási kérés; az ütemező a következő lépésnél veszi figyelembe."""
+        self.cancel_requested = True
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+    @property
+    def elapsed(self) -> float:
+        if self.t_start is None or self.t_end is None:
+            return 0.0
+        return self.t_end - self.t_start
+
+    @property
+    def draft_acceptance_rate(self) -> Optional[float]:
+        if not self.spec_proposed:
+            return None
+        return round(self.spec_accepted / self.spec_proposed, 3)
+
+
+def _build_logits_processors(req: GenerateRequest) -> LogitsProcessorList:
+    """A generate() mintavételezési logikája, kérésenként külön."""
+    procs = LogitsProcessorList()
+    if req.repetition_penalty != 1.0:
+        procs.append(RepetitionPenaltyLogitsProcessor(req.repetition_penalty))
+    if req.temperature > 0:
+        if req.temperature != 1.0:
+            procs.append(TemperatureLogitsWarper(req.temperature))
+        if req.top_k > 0:
+            procs.append(TopKLogitsWarper(req.top_k))
+        if req.top_p < 1.0:
+            procs.append(TopPLogitsWarper(req.top_p))
+    return procs
+
+
+class _RunningBatch:
+    """A futó szekvenciák közös, balra paddolt KV-cache-e."""
+
+    def __init__(self, device: str):
+        self.device = device
+        self.seqs: list[_Sequence] = []
+        self.past = None
+        self.attention_mask: Optional[torch.Tensor] = None
+
+    def __len__(self) -> int:
+        return len(self.seqs)
+
+    def add(self, seq: _Sequence, past) -> None:
+        """Új szekvencia felvétele a prefill után kapott cache-ével."""
+        new_len = _kv_len(past)
+        mask = torch.ones((1, new_len), dtype=torch.long, device=self.device)
+        if not self.seqs:
+            self.seqs = [seq]
+            self.past = past
+            self.attention_mask = mask
+            return
+
+        cur_len = self.attention_mask.shape[1]
+        total = max(cur_len, new_len)
+        self.past = _kv_zip(
+            lambda ts: torch.cat(
+                [_pad_left(ts[0], total - cur_len), _pad_left(ts[1], total - new_len)],
+                dim=0,
+            ),
+            [self.past, past],
+        )
+        self.attention_mask = torch.cat(
+            [F.pad(self.attention_mask, (total - cur_len, 0)), F.pad(mask, (total - new_len, 0))],
+            dim=0,
+        )
+        self.seqs.append(seq)
+
+    def keep(self, rows: list[int]) -> None:
+        """Csak a megadott sorok maradnak; a felesleges bal padding levágva."""
+        if len(rows) == len(self.seqs):
+            return
+        if not rows:
+            self.seqs, self.past, self.attention_mask = [], None, None
+            return
+
+        idx = torch.tensor(rows, device=self.device)
+        mask = self.attention_mask.index_select(0, idx)
+        start = int(mask.any(dim=0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.past = _kv_map(
+            lambda t: t.index_select(0, idx.to(t.device))[..., start:, :], self.past
+        )
+        self.seqs = [self.seqs[i] for i in rows]
+
+    def extract(self, row: int) -> tuple:
+        """
+        Egy sor saját (padding nélküli) cache-e – a sort nem távolítja el.
+        Másolat: egy nézet a teljes batch rétegenkénti tenzorait tartaná életben.
+        """
+        start = int(self.attention_mask[row].nonzero()[0])
+        return _kv_map(lambda t: t[row:row + 1, ..., start:, :].clone(), self.past)
+
+
+class _IncrementalDecoder:
+    """
+    Tokenenkénti detokenizálás: csak a biztosan végleges szövegrészt adja
+    vissza (félkész UTF-8 / szóköz-összevonás esetén vár a következő tokenre).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids: list[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_id: int) -> str:
+        self.ids.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset:], skip_special_tokens=True
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        """A végén visszatartott maradék (pl. csonka UTF-8 szekvencia)."""
+        prefix_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset:], skip_special_tokens=True
+        )
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class _StopChecker:
+    """
+    Tokenenkénti szövegkövetés és stop szekvencia keresés az ütemező
+    szálán. A kiadott szöveg sosem tartalmazza a stop szekvenciát: egy
+    lehetséges stop eleje visszatartódik, amíg el nem dől. Tokenenként csak
+    az új darabot és a visszatartott (< leghosszabb stop) végét vizsgálja.
+    """
+
+    def __init__(self, tokenizer, stops: list[str]):
+        self.decoder = _IncrementalDecoder(tokenizer)
+        self.stops = stops
+        self.max_len = max(map(len, stops), default=0)
+        self.text = ""
+        self.pending = ""
+        self.matched: Optional[str] = None
+
+    def push(self, token_id: int) -> str:
+        """Az új token után biztosan kiadható szövegrész."""
+        return self._feed(self.decoder.push(token_id), final=False)
+
+    def flush(self) -> str:
+        """A generálás végén (stop nélkül) a visszatartott maradék."""
+        return self._feed(self.decoder.flush(), final=True)
+
+    def _feed(self, piece: str, final: bool) -> str:
+        if self.matched is not None:
+            return ""
+        buf = self.pending + piece
+        hit = min(
+            ((i, stop) for stop in self.stops if (i := buf.find(stop)) != -1), default=None
+        )
+        if hit is not None:
+            self.matched = hit[1]
+            out, self.pending = buf[:hit[0]], ""
+        else:
+            hold = 0 if final else self._partial(buf)
+            out, self.pending = buf[:len(buf) - hold], buf[len(buf) - hold:]
+        self.text += out
+        return out
+
+    def _partial(self, buf: str) -> int:
+        """A leghosszabb végződés hossza, ami valamely stop szekvencia eleje."""
+        for n in range(min(len(buf), self.max_len - 1), 0, -1):
+            tail = buf[-n:]
+            if any(stop.startswith(tail) for stop in self.stops):
+                return n
+        return 0
+
+
+class GenerationScheduler:
+    """
+    Egyetlen háttérszál birtokolja a modellt: a beérkező kéréseket
+    tokenlépés-szinten veszi fel a futó batch-be, a befejezetteket kiveszi.
+    Minden kérés megtartja a saját mintavételezési paramétereit.
+    Draft modell esetén az egyedül futó szekvencia spekulatívan dekódol.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        draft_model=None,
+        replica: int = 0,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.replica = replica
+        self.device = _model_device(model)
+        self.eos_ids = _collect_eos_ids(model, tokenizer)
+        self.draft_model = draft_model
+        self.spec_num_tokens = max(1, SPEC_NUM_TOKENS)
+        # Eltérő (paddolt) szótárméretnél csak a közös részt hasonlítjuk
+        self.spec_vocab = (
+            min(model.config.vocab_size, draft_model.config.vocab_size) if draft_model else 0
+        )
+        self.prefix_cache = (
+            PrefixCache(PREFIX_CACHE_MB * 1024 ** 2) if PREFIX_CACHE_MB > 0 else None
+        )
+        self.kv_pool = KVBlockPool(
+            _kv_pool_tokens(model) // max(1, KV_BLOCK_SIZE), KV_BLOCK_SIZE,
+            _kv_bytes_per_token(model),
+        )
+        if KV_POOL_PREALLOCATE:
+            _preallocate_kv_pool(model, self.kv_pool.capacity_bytes)
+        # Dinamikus alakokkal fordítva a batch méret és a KV hossz változása
+        # nem okoz újrafordítást; a prefill és a spekulatív lépés eager marad
+        self.compiled = COMPILE_MODE is not None
+        self._decode_forward = (
+            torch.compile(model, mode=COMPILE_MODE, dynamic=True) if self.compiled else model
+        )
+
+        self._waiting: deque[_Sequence] = deque()
+        # Beengedett, de prompt-feldolgozás alatt álló szekvenciák (FIFO)
+        self._prefilling: deque[_Sequence] = deque()
+        self._batch = _RunningBatch(self.device)
+        # Lassú fogyasztó miatt szüneteltetett szekvenciák a saját cache-ükkel
+        self._paused: list[tuple[_Sequence, tuple]] = []
+        # Kizárólagos modellhasználatot igénylő feladatok (pl. mikro-batch)
+        self._jobs: deque[tuple[Callable, asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._cv = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.tokens_generated_total = 0
+
+    # -- Publikus API -------------------------------------------------------
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name=f"clawdbot-scheduler-{self.replica}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cv:
+            self._stopping = True
+            self._cv.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, seq: _Sequence) -> None:
+        if not seq.prompt_ids:
+            # Tartalék: az endpointok előre tokenizálnak
+            t0 = time.perf_counter()
+            seq.prompt_ids = _prompt_encoder.encode_prompt_sync(seq.req)
+            seq.tokenize_s = time.perf_counter() - t0
+        try:
+            self.kv_pool.check(len(seq.prompt_ids) + seq.req.max_new_tokens)
+        except HTTPException as e:
+            self._fail(seq, e)
+            return
+        with self._cv:
+            self._waiting.append(seq)
+            self._cv.notify()
+
+    async def run_exclusive(self, fn: Callable):
+        """fn futtatása az ütemező szálán, két dekódolási lépés között."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._cv:
+            self._jobs.append((fn, loop, fut))
+            self._cv.notify()
+        return await fut
+
+    def wake(self) -> None:
+        """Ütemező ébresztése (pl. megszakítás vagy fogyasztói előrelépés után)."""
+        with self._cv:
+            self._cv.notify()
+
+    def disable_compile(self) -> None:
+        """Visszaállás eager dekódolásra (pl. ha a fordítás nem támogatott)."""
+        self.compiled = False
+        self._decode_forward = self.model
+
+    @property
+    def healthy(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stopping
+
+    @property
+    def load(self) -> int:
+        """Terhelés a diszpécsernek: futó + várakozó + prefill alatti + szüneteltetett szekvenciák."""
+        return len(self._batch) + len(self._waiting) + len(self._prefilling) + len(self._paused)
+
+    def stats(self) -> dict:
+        return {
+            "replica": self.replica,
+            "device": str(self.device),
+            "healthy": self.healthy,
+            "running": len(self._batch),
+            "waiting": len(self._waiting),
+            "prefilling": len(self._prefilling),
+            "paused": len(self._paused),
+            "prefill_pending_tokens": sum(
+                len(seq.prompt_ids) - seq.prefill_pos for seq in list(self._prefilling)
+            ),
+            "prefill_chunk_tokens": PREFILL_CHUNK_TOKENS,
+            "max_batch_size": self.max_batch_size,
+            "compile_mode": COMPILE_MODE if self.compiled else None,
+            "tokens_generated_total": self.tokens_generated_total,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "kv_pool": self.kv_pool.stats(),
+            "speculative": (
+                {"draft_model": DRAFT_MODEL_NAME, "num_tokens": self.spec_num_tokens}
+                if self.draft_model is not None else None
+            ),
+        }
+
+    async def generate(
+        self,
+        req: GenerateRequest,
+        prompt_ids: Optional[list[int]] = None,
+        deadline: Optional[float] = None,
+        profile: Optional[_ProfileRecord] = None,
+    ) -> _Sequence:
+        """Kérés beküldése és a befejezés bevárása (nem blokkolja a loop-ot)."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        seq = _Sequence(
+            req,
+            on_finish=lambda s: loop.call_soon_threadsafe(_set_future, done, s, None),
+            prompt_ids=prompt_ids,
+            deadline=deadline,
+            profile=profile,
+        )
+        self.submit(seq)
+        try:
+            await done
+        except asyncio.CancelledError:
+            seq.cancel()
+            self.wake()
+            raise
+        if seq.error is not None:
+            raise seq.error
+        return seq
+
+    # -- Ütemező szál -------------------------------------------------------
+
+    def _has_work(self) -> bool:
+        """
+        A várakozó kérés csak akkor munka, ha beengedhető: ha a helyeket
+        vagy a KV blokkokat szüneteltetett streamek foglalják, a szál alszik
+        (nem pörög a GIL-ért a streameket ürítő event loop ellen), amíg egy
+        wake / submit / határidő fel nem ébreszti.
+        """
+        if self._prefilling or self._batch.seqs or self._jobs:
+            return True
+        now = time.perf_counter()
+        if any(s.cancel_requested or s.expired(now) for s in self._waiting):
+            return True
+        if self._waiting and self._admissible(self._next_waiting()):
+            return True
+        return any(s.cancel_requested or s.drained or s.expired(now) for s, _ in self._paused)
+
+    def _admissible(self, seq: _Sequence) -> bool:
+        in_use = len(self._batch) + len(self._prefilling) + len(self._paused)
+        return in_use < self.max_batch_size and self.kv_pool.fits(seq)
+
+    def _wait_timeout(self) -> Optional[float]:
+        """Várakozó és szüneteltetett szekvenciáknál a legközelebbi határidőig alszunk."""
+        deadlines = [s.deadline for s in self._waiting if s.deadline is not None]
+        deadlines += [s.deadline for s, _ in self._paused if s.deadline is not None]
+        return max(0.0, min(deadlines) - time.perf_counter()) if deadlines else None
+
+    def _run(self) -> None:
+        while True:
+            with self._cv:
+                while not self._stopping and not self._has_work():
+                    self._cv.wait(self._wait_timeout())
+                if self._stopping:
+                    break
+                now = time.perf_counter()
+                # Megszakított / lejárt várakozók kiesnek (akkor is, ha nincs szabad hely)
+                dropped = [s for s in self._waiting if s.cancel_requested or s.expired(now)]
+                for seq in dropped:
+                    self._waiting.remove(seq)
+                admitted = []
+                in_use = len(self._batch) + len(self._prefilling) + len(self._paused)
+                while self._waiting and in_use + len(admitted) < self.max_batch_size:
+                    # Ami nem fér a KV poolba, a sor elején vár (a prioritás megmarad)
+                    seq = self._next_waiting()
+                    if not self.kv_pool.reserve(seq):
+                        break
+                    self._waiting.remove(seq)
+                    admitted.append(seq)
+                jobs = list(self._jobs)
+                self._jobs.clear()
+
+            for seq in dropped:
+                if seq.cancel_requested:
+                    seq.finish_reason = "cancelled"
+                    self._finish(seq)
+                else:
+                    self._expire(seq)
+
+            with torch.inference_mode():
+                for job in jobs:
+                    self._run_job(*job)
+                self._retire_cancelled()
+                self._resume_paused()
+                for seq in admitted:
+                    self._prefill(seq)
+                self._prefill_chunks()
+                self._pause_stalled()
+                if self._speculative_ready():
+                    self._speculative_step()
+                elif self._batch.seqs:
+                    self._decode_step()
+
+        # Leálláskor a függő kérések hibával zárulnak
+        pending = (
+            list(self._waiting) + list(self._prefilling) + self._batch.seqs
+            + [s for s, _ in self._paused]
+        )
+        for seq in pending:
+            self._fail(seq, RuntimeError("A szerver leáll."))
+        for _, loop, fut in self._jobs:
+            loop.call_soon_threadsafe(_set_future, fut, None, RuntimeError("A szerver leáll."))
+
+    def _next_waiting(self) -> _Sequence:
+        """Az interaktív kérések megelőzik a batch kéréseket (osztályon belül FIFO)."""
+        for seq in self._waiting:
+            if seq.req.priority == "interactive":
+                return seq
+        return self._waiting[0]
+
+    @staticmethod
+    def _run_job(fn: Callable, loop: asyncio.AbstractEventLoop, fut: asyncio.Future) -> None:
+        try:
+            result = fn()
+        except Exception as e:
+            loop.call_soon_threadsafe(_set_future, fut, None, e)
+        else:
+            loop.call_soon_threadsafe(_set_future, fut, result, None)
+
+    def _retire_cancelled(self) -> None:
+        """
+        A megszakított kérések (pl. bontott kapcsolat) azonnal kiesnek; a
+        lejárt határidejű szüneteltetettek az addigi szöveggel zárulnak, a
+        prefill közben lejártak (még kimenet nélkül) 504-gyel.
+        """
+        keep = []
+        for i, seq in enumerate(self._batch.seqs):
+            if seq.cancel_requested:
+                seq.finish_reason = "cancelled"
+                self._finish(seq)
+            else:
+                keep.append(i)
+        self._batch.keep(keep)
+
+        now = time.perf_counter()
+        for seq in self._prefilling:
+            if seq.cancel_requested:
+                seq.finish_reason = "cancelled"
+                self._finish(seq)
+            elif seq.expired(now):
+                # Még nincs kimenet: ugyanaz, mint a sorban lejárt kérés
+                self._expire(seq)
+        self._prefilling = deque(s for s in self._prefilling if not s.finished)
+
+        for seq, _ in self._paused:
+            if seq.cancel_requested:
+                seq.finish_reason = "cancelled"
+                self._finish(seq)
+            elif seq.expired(now):
+                seq.finish_reason = "timeout"
+                self._finish(seq)
+        self._paused = [(s, past) for s, past in self._paused if not s.finished]
+
+    def _pause_stalled(self) -> None:
+        """Lemaradt fogyasztójú sorok kivétele a batch-ből, a többiek haladnak."""
+        keep = []
+        for i, seq in enumerate(self._batch.seqs):
+            if seq.stalled:
+                seq.paused = True
+                self._paused.append((seq, self._batch.extract(i)))
+            else:
+                keep.append(i)
+        self._batch.keep(keep)
+
+    def _resume_paused(self) -> None:
+        still_paused = []
+        for seq, past in self._paused:
+            if seq.drained:
+                seq.paused = False
+                self._batch.add(seq, past)
+            else:
+                still_paused.append((seq, past))
+        self._paused = still_paused
+
+    def _prefill(self, seq: _Sequence) -> None:
+        """Prefill előkészítése (stop-ellenőrző, prefix cache); a prompt a _prefill_chunks-ban fut le."""
+        if seq.cancel_requested:
+            seq.finish_reason = "cancelled"
+            self._finish(seq)
+            return
+        if seq.expired(time.perf_counter()):
+            self._expire(seq)
+            return
+        if seq.profile is not None:
+            _profiler.start(seq.profile)
+        seq.t_start = time.perf_counter()
+        try:
+            stops = _resolve_stops(seq.req)
+            # Profilozásnál a detokenizálás is itt (mérve, a trace-en belül) fut
+            if stops or seq.mode == "stream" or seq.profile is not None:
+                seq.stopper = _StopChecker(self.tokenizer, stops)
+            cached_len, cached_past = 0, None
+            if self.prefix_cache is not None:
+                cached_len, cached_past = self.prefix_cache.lookup(seq.prompt_ids)
+            if seq.profile is not None:
+                seq.profile.cached_tokens = cached_len
+            seq.prefill_pos = cached_len
+            seq.prefill_past = (
+                _cache_from_legacy(self.model, cached_past)
+                if cached_past is not None else _empty_cache(self.model)
+            )
+        except Exception as e:
+            log.exception("Prefill hiba")
+            self._fail(seq, e)
+            return
+        seq.prefill_s = time.perf_counter() - seq.t_start
+        self._prefilling.append(seq)
+
+    def _prefill_chunks(self) -> None:
+        """
+        Ütemezőlépésenként legfeljebb PREFILL_CHUNK_TOKENS prompt-token
+        feldolgozása (FIFO): egy hosszú prompt több lépésen át, darabokban
+        halad, a lépések között a futó batch dekódol, így a prefill nem
+        akasztja meg a többi stream következő tokenjét. A prefill_s a
+        darabok számítási idejének összege (a közbeékelt dekódolás nélkül).
+        """
+        budget = PREFILL_CHUNK_TOKENS if PREFILL_CHUNK_TOKENS > 0 else None
+        while self._prefilling and (budget is None or budget > 0):
+            seq = self._prefilling[0]
+            total = len(seq.prompt_ids)
+            end = total if budget is None else min(total, seq.prefill_pos + budget)
+            t0 = time.perf_counter()
+            try:
+                input_ids = torch.tensor([seq.prompt_ids[seq.prefill_pos:end]], device=self.device)
+                with _profiler.range("clawdbot::prefill_chunk"):
+                    out = self.model(
+                        input_ids=input_ids,
+                        past_key_values=seq.prefill_past,
+                        use_cache=True,
+                    )
+                seq.prefill_past = out.past_key_values
+                M_PREFILL_CHUNKS.inc(replica=self.replica, kind="chunks")
+                M_PREFILL_CHUNKS.inc(end - seq.prefill_pos, replica=self.replica, kind="tokens")
+                if budget is not None:
+                    budget -= end - seq.prefill_pos
+                seq.prefill_pos = end
+                if end < total:
+                    seq.prefill_s += time.perf_counter() - t0
+                    continue
+
+                self._prefilling.popleft()
+                past = _cache_to_legacy(seq.prefill_past)
+                seq.prefill_past = None
+                if self.prefix_cache is not None:
+                    self.prefix_cache.insert(seq.prompt_ids, past)
+                self._accept(seq, *self._sample(seq, out.logits[0, -1]))
+                seq.prefill_s += time.perf_counter() - t0
+            except Exception as e:
+                log.exception("Prefill hiba")
+                if self._prefilling and self._prefilling[0] is seq:
+                    self._prefilling.popleft()
+                self._fail(seq, e)
+                continue
+
+            if seq.finished:
+                self._finish(seq)
+            else:
+                self._batch.add(seq, past)
+
+    def _decode_step(self) -> None:
+        batch = self._batch
+        try:
+            input_ids = torch.tensor(
+                [[seq.output_ids[-1]] for seq in batch.seqs], device=self.device
+            )
+            attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+            position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+            with _profiler.range("clawdbot::decode_forward"):
+                out = self._decode_forward(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=_cache_from_legacy(self.model, batch.past),
+                    use_cache=True,
+                )
+            batch.past = _cache_to_legacy(out.past_key_values)
+            batch.attention_mask = attention_mask
+            logits = out.logits[:, -1]
+            with _profiler.range("clawdbot::sample"):
+                for i, seq in enumerate(batch.seqs):
+                    if seq.profile is not None:
+                        seq.profile.batch_sizes.append(len(batch.seqs))
+                    self._accept(seq, *self._sample(seq, logits[i]))
+        except Exception as e:
+            log.exception("Dekódolási hiba – a futó batch eldobva")
+            for seq in batch.seqs:
+                self._fail(seq, e)
+            batch.keep([])
+            return
+        _profiler.step(batch.seqs)
+
+        keep = []
+        for i, seq in enumerate(batch.seqs):
+            if seq.finished:
+                self._finish(seq)
+            else:
+                keep.append(i)
+        batch.keep(keep)
+
+    # -- Spekulatív dekódolás ----------------------------------------------
+
+    def _speculative_ready(self) -> bool:
+        """Batch 1 a memória-sávszélesség által korlátozott eset: ilyenkor éri meg."""
+        if self.draft_model is None or len(self._batch) != 1 or self._waiting:
+            return False
+        seq = self._batch.seqs[0]
+        return seq.req.max_new_tokens - len(seq.output_ids) > 1
+
+    def _distribution(
+        self, seq: _Sequence, logits: torch.Tensor, ids: list[int], with_logprobs: bool = False
+    ):
+        """
+        A kérés mintavételezése szerinti eloszlás (mohó esetben egy-forró);
+        with_logprobs esetén a log-valószínűségekkel együtt (ha kérték őket).
+        """
+        scores = logits[:self.spec_vocab].unsqueeze(0).float()
+        if seq.processors:
+            scores = seq.processors(torch.tensor([ids], device=logits.device), scores)
+        if seq.req.temperature > 0:
+            dist = torch.softmax(scores, dim=-1)[0]
+        else:
+            dist = F.one_hot(scores.argmax(dim=-1), scores.shape[-1])[0].float()
+        if not with_logprobs:
+            return dist
+        return dist, torch.log_softmax(scores, dim=-1)[0] if seq.req.logprobs else None
+
+    def _draft_propose(self, seq: _Sequence, ids: list[int], k: int) -> tuple[list[int], list]:
+        """k token javaslata a draft modellel; a cache hiányzó részét előbb pótolja."""
+        dm = self.draft_model
+        device = dm.device
+        past = seq.draft_past
+        feed = ids[seq.draft_len:]
+        drafts, dists = [], []
+        for _ in range(k):
+            out = dm(
+                input_ids=torch.tensor([feed], device=device),
+                past_key_values=(
+                    _cache_from_legacy(dm, past) if past is not None else _empty_cache(dm)
+                ),
+                use_cache=True,
+            )
+            past = _cache_to_legacy(out.past_key_values)
+            q = self._distribution(seq, out.logits[0, -1], ids + drafts).to(self.device)
+            token = int(torch.multinomial(q, num_samples=1)[0])
+            drafts.append(token)
+            dists.append(q)
+            feed = [token]
+        seq.draft_past = past
+        return drafts, dists
+
+    def _speculative_step(self) -> None:
+        """
+        Draft javaslat + egyetlen célmodell-hívás az ellenőrzéshez
+        (spekulatív mintavételezés: az eredmény eloszlása megegyezik a
+        normál dekódoláséval, mohó esetben pontosan ugyanaz a szöveg).
+        """
+        batch = self._batch
+        seq = batch.seqs[0]
+        k = min(self.spec_num_tokens, seq.req.max_new_tokens - len(seq.output_ids) - 1)
+        ids = seq.prompt_ids + seq.output_ids
+        try:
+            with _profiler.range("clawdbot::draft_propose"):
+                drafts, dists = self._draft_propose(seq, ids, k)
+            past_len = _kv_len(batch.past)
+            with _profiler.range("clawdbot::verify_forward"):
+                out = self.model(
+                    input_ids=torch.tensor([[seq.output_ids[-1]] + drafts], device=self.device),
+                    past_key_values=_cache_from_legacy(self.model, batch.past),
+                    use_cache=True,
+                )
+            logits = out.logits[0]
+
+            accepted = 0
+            logprobs = []
+            for i, draft in enumerate(drafts):
+                p, lp = self._distribution(seq, logits[i], ids + drafts[:i], with_logprobs=True)
+                logprobs.append(lp)
+                q = dists[i]
+                if torch.rand(()) < p[draft] / q[draft]:
+                    accepted += 1
+                    continue
+                residual = torch.clamp(p - q, min=0)
+                if residual.sum() <= 0:
+                    residual = p
+                token = int(torch.multinomial(residual / residual.sum(), num_samples=1)[0])
+                break
+            else:
+                p, lp = self._distribution(seq, logits[k], ids + drafts, with_logprobs=True)
+                logprobs.append(lp)
+                token = int(torch.multinomial(p, num_samples=1)[0])
+
+            # A cache-ekben csak az elfogadott tokenek maradnak
+            keep_len = past_len + 1 + accepted
+            batch.past = _kv_map(
+                lambda t: t[..., :keep_len, :], _cache_to_legacy(out.past_key_values)
+            )
+            batch.attention_mask = torch.ones((1, keep_len), dtype=torch.long, device=self.device)
+            seq.draft_len = len(ids) + min(accepted, k - 1)
+            seq.draft_past = _kv_map(lambda t: t[..., :seq.draft_len, :], seq.draft_past)
+            seq.spec_proposed += k
+            seq.spec_accepted += accepted
+
+            for token_id, lp in zip(drafts[:accepted] + [token], logprobs):
+                if seq.profile is not None:
+                    seq.profile.batch_sizes.append(1)
+                self._accept(seq, token_id, float(lp[token_id]) if lp is not None else None)
+                if seq.finished:
+                    break
+        except Exception as e:
+            log.exception("Spekulatív dekódolási hiba – a futó batch eldobva")
+            self._fail(seq, e)
+            batch.keep([])
+            return
+        _profiler.step(batch.seqs)
+
+        if seq.finished:
+            self._finish(seq)
+            batch.keep([])
+
+    def _sample(self, seq: _Sequence, logits: torch.Tensor) -> tuple[int, Optional[float]]:
+        scores = logits.unsqueeze(0).float()
+        if seq.processors:
+            ids = torch.tensor([seq.prompt_ids + seq.output_ids], device=logits.device)
+            scores = seq.processors(ids, scores)
+        if seq.req.temperature > 0:
+            probs = torch.softmax(scores, dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1)[0, 0])
+        else:
+            token = int(scores.argmax(dim=-1)[0])
+        if not seq.req.logprobs:
+            return token, None
+        return token, float(torch.log_softmax(scores, dim=-1)[0, token])
+
+    def _accept(self, seq: _Sequence, token_id: int, logprob: Optional[float] = None) -> None:
+        if not seq.output_ids:
+            seq.t_first_token = time.perf_counter()
+        if seq.profile is not None:
+            seq.profile.token_times.append(time.perf_counter())
+        seq.output_ids.append(token_id)
+        if logprob is not None:
+            seq.output_logprobs.append(logprob)
+        self.tokens_generated_total += 1
+        seq.emitted += 1
+        if seq.stopper is not None:
+            t0 = time.perf_counter()
+            seq.text_delta = seq.stopper.push(token_id)
+        if token_id in self.eos_ids:
+            seq.finish_reason = "eos"
+        elif seq.stopper is not None and seq.stopper.matched is not None:
+            seq.finish_reason = "stop"
+        elif len(seq.output_ids) >= seq.req.max_new_tokens:
+            seq.finish_reason = "length"
+        elif seq.expired(time.perf_counter()):
+            seq.finish_reason = "timeout"
+        elif seq.cancel_requested:
+            seq.finish_reason = "cancelled"
+        if seq.stopper is not None:
+            if seq.finished:
+                seq.text_delta += seq.stopper.flush()
+            seq.detokenize_s += time.perf_counter() - t0
+        if seq.on_token is not None:
+            seq.on_token(seq, token_id)
+
+    def _finish(self, seq: _Sequence) -> None:
+        seq.t_end = time.perf_counter()
+        seq.draft_past = None
+        seq.prefill_past = None
+        self.kv_pool.release(seq)
+        _record_sequence_metrics(seq)
+        if seq.profile is not None:
+            _profiler.finish(seq)
+        if seq.on_finish is not None:
+            seq.on_finish(seq)
+
+    def _fail(self, seq: _Sequence, error: BaseException) -> None:
+        seq.error = error
+        seq.finish_reason = "error"
+        self._finish(seq)
+
+    def _expire(self, seq: _Sequence) -> None:
+        """Még el sem indult, de lejárt határidejű kérés: nincs részeredmény."""
+        seq.error = HTTPException(504, "A kérés határideje lejárt a sorban állás alatt.")
+        seq.finish_reason = "timeout"
+        self._finish(seq)
+
+
+def _set_future(fut: asyncio.Future, result, error: Optional[BaseException]) -> None:
+    """Eseményhurok-oldali eredménybeállítás (a várakozó közben elmehetett)."""
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+def _collect_eos_ids(model, tokenizer) -> set[int]:
+    eos = getattr(model.generation_config, "eos_token_id", None)
+    ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    return ids
+
+
+# ---------------------------------------------------------------------------
+# Replikák közötti elosztás (adatpárhuzamos kiszolgálás)
+# ---------------------------------------------------------------------------
+
+class ReplicaDispatcher:
+    """
+    Minden replika saját modellpéldánnyal és ütemező szállal fut, így a
+    GPU-k egymástól függetlenül, párhuzamosan dekódolnak (a rétegenkénti
+    szétosztásnál tokenenként mindig csak egy GPU dolgozik).
+    Az új kérés a legkevésbé terhelt egészséges replikára kerül; azonos
+    session_id a korábbi replikájára (ott van a prefix cache-e), amíg az
+    legfeljebb AFFINITY_SLACK szekvenciával terheltebb a legjobbnál.
+    """
+
+    AFFINITY_SLACK = 2
+    MAX_SESSIONS = 4096
+
+    def __init__(self, schedulers: list[GenerationScheduler]):
+        self.replicas = schedulers
+        self._affinity: OrderedDict[str, int] = OrderedDict()
+        self.routed = [0] * len(schedulers)
+        self.affinity_hits = 0
+
+    def start(self) -> None:
+        for s in self.replicas:
+            s.start()
+
+    def stop(self) -> None:
+        for s in self.replicas:
+            s.stop()
+
+    def pick(self, session_id: Optional[str] = None) -> GenerationScheduler:
+        healthy = [i for i, s in enumerate(self.replicas) if s.healthy]
+        if not healthy:
+            raise HTTPException(503, "Nincs működő modell replika.")
+        best = min(healthy, key=lambda i: self.replicas[i].load)
+
+        if session_id is not None:
+            prev = self._affinity.get(session_id)
+            if (prev in healthy
+                    and self.replicas[prev].load <= self.replicas[best].load + self.AFFINITY_SLACK):
+                best = prev
+                self.affinity_hits += 1
+            self._affinity[session_id] = best
+            self._affinity.move_to_end(session_id)
+            while len(self._affinity) > self.MAX_SESSIONS:
+                self._affinity.popitem(last=False)
+
+        self.routed[best] += 1
+        return self.replicas[best]
+
+    def stats(self) -> dict:
+        return {
+            "count": len(self.replicas),
+            "healthy": sum(s.healthy for s in self.replicas),
+            "affinity_hits": self.affinity_hits,
+            "sessions": len(self._affinity),
+            "replicas": [
+                {**s.stats(), "routed_total": n} for s, n in zip(self.replicas, self.routed)
+            ],
+        }
+
+
+_dispatcher: Optional[ReplicaDispatcher] = None
+
+# ---------------------------------------------------------------------------
+# Mikro-batching (nem streaming, áteresztőképesség-orientált mód)
+# ---------------------------------------------------------------------------
+
+def _generate_batch_sync(
+    reqs: list[GenerateRequest], model, draft_model=None
+) -> list[GenerateResponse]:
+    """Azonos mintavételezésű kérések egyetlen, balra paddolt generate() hívásban."""
+    first = reqs[0]
+    stops = _resolve_stops(first)
+
+    # Cache-elt szegmens id-k, kézi bal padding (a tokenizer állapota érintetlen)
+    t_tok = time.perf_counter()
+    prompts = [_prompt_encoder.encode_prompt_sync(r) for r in reqs]
+    input_len = max(len(ids) for ids in prompts)
+    pad_id = _tokenizer.pad_token_id
+    device = _model_device(model)
+    inputs = {
+        "input_ids": torch.tensor(
+            [[pad_id] * (input_len - len(ids)) + ids for ids in prompts], device=device
+        ),
+        "attention_mask": torch.tensor(
+            [[0] * (input_len - len(ids)) + [1] * len(ids) for ids in prompts], device=device
+        ),
+    }
+    for ids in prompts:
+        M_PROMPT_LEN.observe(len(ids))
+
+    t0 = time.perf_counter()
+    M_PHASE.observe(t0 - t_tok, phase="tokenize")
+    outputs = model.generate(
+        **inputs,
+        max_new_tokens=first.max_new_tokens,
+        temperature=first.temperature,
+        top_p=first.top_p,
+        top_k=first.top_k,
+        repetition_penalty=first.repetition_penalty,
+        do_sample=first.temperature > 0,
+        pad_token_id=_tokenizer.pad_token_id,
+        # A leállt sorok innen paddinget (EOS) kapnak
+        stop_strings=stops or None,
+        tokenizer=_tokenizer if stops else None,
+        # Az assisted generation csak batch 1-gyel működik
+        assistant_model=draft_model if len(reqs) == 1 else None,
+    )
+    elapsed = time.perf_counter() - t0
+    # A generate() nem bontható prefillre és dekódolásra
+    M_PHASE.observe(elapsed, phase="generate")
+
+    # A sor az első EOS-ig (azt is beleszámolva) tart, utána csak padding jön
+    eos_ids = _collect_eos_ids(model, _tokenizer)
+    responses = []
+    t_detok = time.perf_counter()
+    for row in outputs[:, input_len:].tolist():
+        n = next((i + 1 for i, t in enumerate(row) if t in eos_ids), len(row))
+        text = _tokenizer.decode(row[:n], skip_special_tokens=True)
+        finish_reason = "eos" if n < len(row) else "length"
+        hit = min(((i, stop) for stop in stops if (i := text.find(stop)) != -1), default=None)
+        if hit is not None:
+            text, finish_reason = text[:hit[0]], "stop"
+        responses.append(GenerateResponse(
+            text=text,
+            tokens_generated=n,
+            elapsed_seconds=round(elapsed, 3),
+            model=MODEL_NAME,
+            finish_reason=finish_reason,
+            stop_sequence=hit[1] if hit is not None else None,
+        ))
+        M_GEN_LEN.observe(n)
+        M_TOKENS.inc(n)
+        M_REQUESTS.inc(mode="microbatch", finish_reason=finish_reason)
+    M_PHASE.observe(time.perf_counter() - t_detok, phase="detokenize")
+    return responses
+
+
+class MicroBatcher:
+    """
+    A beérkező nem streaming kéréseket window_ms ideig (vagy max_size
+    kérésig) gyűjti, mintavételezési beállítás szerinti vödrökbe.
+    Vödrönként egy közös generate() fut a legkevésbé terhelt replika
+    ütemező szálán.
+    """
+
+    def __init__(self, dispatcher: ReplicaDispatcher, window_ms: int, max_size: int):
+        self.dispatcher = dispatcher
+        self.window_s = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self._buckets: dict[tuple, list[tuple[GenerateRequest, asyncio.Future, float]]] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.batches_run = 0
+        self.requests_batched = 0
+
+    @staticmethod
+    def _bucket_key(req: GenerateRequest) -> tuple:
+        return (
+            req.temperature > 0,
+            req.temperature,
+            req.top_p,
+            req.top_k,
+            req.repetition_penalty,
+            req.max_new_tokens,
+            tuple(_resolve_stops(req)),
+        )
+
+    async def generate(self, req: GenerateRequest) -> GenerateResponse:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        key = self._bucket_key(req)
+        bucket = self._buckets.setdefault(key, [])
+        bucket.append((req, fut, time.perf_counter()))
+
+        if len(bucket) >= self.max_size:
+            self._flush(key)
+        elif len(bucket) == 1:
+            self._timers[key] = loop.call_later(self.window_s, self._flush, key)
+        return await fut
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": round(self.window_s * 1000),
+            "max_size": self.max_size,
+            "pending": sum(len(b) for b in self._buckets.values()),
+            "batches_run": self.batches_run,
+            "avg_batch_size": (
+                round(self.requests_batched / self.batches_run, 2) if self.batches_run else 0.0
+            ),
+        }
+
+    def _flush(self, key: tuple) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        bucket = [entry for entry in self._buckets.pop(key, []) if not entry[1].done()]
+        if not bucket:
+            return
+        task = asyncio.create_task(self._run_bucket(bucket))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_bucket(self, bucket: list[tuple[GenerateRequest, asyncio.Future, float]]) -> None:
+        reqs = [r for r, _, _ in bucket]
+
+        def job() -> list[GenerateResponse]:
+            t_start = time.perf_counter()
+            for _, _, t_enqueued in bucket:
+                M_PHASE.observe(t_start - t_enqueued, phase="queue")
+            return _generate_batch_sync(reqs, scheduler.model, scheduler.draft_model)
+
+        try:
+            scheduler = self.dispatcher.pick()
+            responses = await scheduler.run_exclusive(job)
+        except Exception as e:
+            log.exception("Mikro-batch generálási hiba")
+            for _, fut, _ in bucket:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        self.batches_run += 1
+        self.requests_batched += len(reqs)
+        for (_, fut, _), resp in zip(bucket, responses):
+            if not fut.done():
+                fut.set_result(resp)
+
+
+_microbatcher: Optional[MicroBatcher] = None
+
+# ---------------------------------------------------------------------------
+# Beengedés-szabályozás (token-keret, prioritási osztályok)
+# ---------------------------------------------------------------------------
+
+def _kv_bytes_per_token(model) -> int:
+    """Egy token KV-cache mérete az összes rétegben (K és V)."""
+    cfg = model.config
+    heads = cfg.num_attention_heads
+    kv_heads = getattr(cfg, "num_key_value_heads", None) or heads
+    head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // heads
+    return 2 * cfg.num_hidden_layers * kv_heads * head_dim * model.dtype.itemsize
+
+
+def _derive_token_budget(schedulers: list[GenerationScheduler]) -> int:
+    """
+    ADMISSION_TOKEN_BUDGET, vagy a replikák KV blokk-pooljainak összkapacitása
+    (a pool a betöltés utáni szabad memóriából méretezett).
+    """
+    if ADMISSION_TOKEN_BUDGET > 0:
+        return ADMISSION_TOKEN_BUDGET
+    return sum(s.kv_pool.capacity_tokens for s in schedulers)
+
+
+class AdmissionTicket:
+    """Egy beengedett kérés foglalása; a release() idempotens."""
+
+    def __init__(self, priority: str, cost: int):
+        self.priority = priority
+        self.cost = cost
+        self.released = False
+
+
+class AdmissionController:
+    """
+    Költség = prompt tokenek + max_new_tokens. A futó kérések összköltsége
+    nem lépheti túl a keretet; a batch osztály ebből legfeljebb batch_share
+    arányt foglalhat, így az interaktív kérésekre mindig marad hely.
+    Ami nem fér be, rövid ideig sorban áll (az interaktív elsőbbséggel),
+    teli sor vagy lejárt várakozás esetén 429 + Retry-After a válasz.
+    Csak az eseményhurokból használható (nincs zárolás).
+    """
+
+    PRIORITIES = ("interactive", "batch")
+    # Az áteresztőképesség-becslés (Retry-After) ablaka, mp
+    RATE_WINDOW = 60.0
+
+    def __init__(self, budget: int, batch_share: float, max_queue: int, queue_timeout: float):
+        self.budget = max(1, budget)
+        self.batch_budget = max(1, int(self.budget * batch_share))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_use = {p: 0 for p in self.PRIORITIES}
+        self._queues: dict[str, deque[tuple[AdmissionTicket, asyncio.Future]]] = {
+            p: deque() for p in self.PRIORITIES
+        }
+        self._released: deque[tuple[float, int]] = deque()
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    def _limit(self, priority: str) -> int:
+        return self.batch_budget if priority == "batch" else self.budget
+
+    @property
+    def idle(self) -> bool:
+        """Nincs beengedett és várakozó kérés."""
+        return not any(self.in_use.values()) and not any(self._queues.values())
+
+    def _fits(self, ticket: AdmissionTicket) -> bool:
+        if sum(self.in_use.values()) + ticket.cost > self.budget:
+            return False
+        return ticket.priority != "batch" or self.in_use["batch"] + ticket.cost <= self.batch_budget
+
+    def _grant(self, ticket: AdmissionTicket) -> None:
+        self.in_use[ticket.priority] += ticket.cost
+        self.admitted_total += 1
+        M_ADMISSION.inc(priority=ticket.priority, outcome="admitted")
+
+    def _reject(self, ticket: AdmissionTicket, detail: str) -> HTTPException:
+        self.rejected_total += 1
+        M_ADMISSION.inc(priority=ticket.priority, outcome="rejected")
+        return HTTPException(
+            429, detail, headers={"Retry-After": str(self.retry_after(ticket.cost))}
+        )
+
+    async def acquire(self, priority: str, cost: int) -> AdmissionTicket:
+        ticket = AdmissionTicket(priority, cost)
+        if cost > self._limit(priority):
+            raise HTTPException(
+                413,
+                f"A kérés költsége ({cost} token) meghaladja a(z) {priority} "
+                f"osztály keretét ({self._limit(priority)} token).",
+            )
+
+        # Az interaktív sor a batch kéréseket is visszatartja, fordítva nem
+        ahead = self._queues["interactive"] or (priority == "batch" and self._queues["batch"])
+        if not ahead and self._fits(ticket):
+            self._grant(ticket)
+            return ticket
+
+        queue = self._queues[priority]
+        if len(queue) >= self.max_queue:
+            raise self._reject(ticket, "Túlterhelés: a várakozási sor megtelt.")
+
+        M_ADMISSION.inc(priority=priority, outcome="queued")
+        fut = asyncio.get_running_loop().create_future()
+        entry = (ticket, fut)
+        queue.append(entry)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # A foglalás a megszakítással egy időben megtörtént
+                self.release(ticket)
+            elif entry in queue:
+                queue.remove(entry)
+                self._drain()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._reject(ticket, "Túlterhelés: a várakozási idő lejárt.")
+        return ticket
+
+    def release(self, ticket: Optional[AdmissionTicket]) -> None:
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        self.in_use[ticket.priority] -= ticket.cost
+        self._released.append((time.monotonic(), ticket.cost))
+        self._drain()
+
+    def _drain(self) -> None:
+        """Várakozók beengedése prioritási sorrendben (osztályon belül FIFO)."""
+        for priority in self.PRIORITIES:
+            queue = self._queues[priority]
+            while queue:
+                ticket, fut = queue[0]
+                if fut.done():
+                    queue.popleft()
+                    continue
+                if not self._fits(ticket):
+                    break
+                queue.popleft()
+                self._grant(ticket)
+                fut.set_result(None)
+            if queue:
+                return
+
+    def retry_after(self, cost: int) -> int:
+        """Becslés (mp): a foglalt és várakozó tokenek az utóbbi áteresztéssel."""
+        now = time.monotonic()
+        while self._released and now - self._released[0][0] > self.RATE_WINDOW:
+            self._released.popleft()
+        rate = sum(c for _, c in self._released) / self.RATE_WINDOW
+        if rate <= 0:
+            return max(1, int(self.queue_timeout))
+        backlog = sum(self.in_use.values()) + self._queued_tokens() + cost - self.budget
+        return min(300, max(1, int(backlog / rate + 0.999)))
+
+    def _queued_tokens(self) -> int:
+        return sum(t.cost for q in self._queues.values() for t, f in q if not f.done())
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "batch_budget": self.batch_budget,
+            "in_use": sum(self.in_use.values()),
+            "in_use_by_priority": dict(self.in_use),
+            "queued": self._queued_tokens(),
+            "queued_requests": {p: len(q) for p, q in self._queues.items()},
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+_admission: Optional[AdmissionController] = None
+
+
+
+# ---------------------------------------------------------------------------
+# Válasz cache determinisztikus (temperature == 0) generálásokhoz
+# ---------------------------------------------------------------------------
+
+class ResponseCache:
+    """
+    Pontos egyezés szerinti cache: kulcs = hash(MODEL_NAME, teljes prompt,
+    generálási paraméterek). Méret- és TTL-korlát, opcionálisan JSONL
+    naplófájl a lemezen, ami újraindításkor visszatöltődik. A naplót egy
+    háttérszál írja, és LOG_COMPACT_FACTOR × max_entries sor felett a
+    memóriabeli tartalomra tömöríti.
+    """
+
+    LOG_COMPACT_FACTOR = 2
+
+    def __init__(self, max_entries: int, ttl_seconds: float, path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self.path = path
+        self._entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.compactions = 0
+        self._log_lines = 0
+        self._writes: Optional[SimpleQueue] = None
+        self._writer: Optional[threading.Thread] = None
+        if path:
+            self._load()
+            self._writes = SimpleQueue()
+            self._writer = threading.Thread(
+                target=self._write_loop, name="clawdbot-cache-writer", daemon=True
+            )
+            self._writer.start()
+
+    @staticmethod
+    def cacheable(req: GenerateRequest) -> bool:
+        # A tárolt válasz nem tartalmaz tokenenkénti log-valószínűséget,
+        # a profilozott kérésnek pedig a modellen kell futnia
+        return req.temperature == 0 and not req.logprobs and not req.profile
+
+    @staticmethod
+    def key(req: GenerateRequest) -> str:
+        # Mohó dekódolásnál a top_p / top_k nem számít; a kvantálás és a súlyforrás
+        # (snapshot vagy eredeti modell) viszont a kimenetet is megváltoztathatja
+        payload = json.dumps(
+            {
+                "model": MODEL_NAME,
+                "source": _readiness.get("source"),
+                "quantization": _quantization_info["mode"],
+                "prompt": _build_full_prompt(req),
+                "max_new_tokens": req.max_new_tokens,
+                "repetition_penalty": req.repetition_penalty,
+                "stop": _resolve_stops(req),
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                M_RESPONSE_CACHE.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            M_RESPONSE_CACHE.inc(result="hit")
+            return entry[1]
+
+    def bypass(self) -> None:
+        self.bypasses += 1
+        M_RESPONSE_CACHE.inc(result="bypass")
+
+    def put(self, key: str, value: dict) -> None:
+        created = time.time()
+        with self._lock:
+            self._entries[key] = (created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self._writes is not None:
+            # Lemezre a háttérszál ír: sem a loop, sem a zár nem vár az I/O-ra
+            self._writes.put({"key": key, "t": created, "value": value})
+
+    def close(self) -> None:
+        """A még függő naplósorok kiírása (leállításkor)."""
+        if self._writes is not None:
+            self._writes.put(None)
+            self._writer.join(timeout=10)
+            self._writes = None
+
+    def _write_loop(self) -> None:
+        while True:
+            records = [self._writes.get()]
+            # Ami közben felgyűlt, egy megnyitással megy ki
+            while records[-1] is not None and not self._writes.empty():
+                records.append(self._writes.get())
+            done = records[-1] is None
+            if done:
+                records.pop()
+            try:
+                if records:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        for rec in records:
+                            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    self._log_lines += len(records)
+                if self._log_lines > self.LOG_COMPACT_FACTOR * self.max_entries:
+                    self._compact()
+            except OSError as e:
+                log.warning(f"Válasz cache írási hiba: {e}")
+            if done:
+                return
+
+    def _compact(self) -> None:
+        """A napló újraírása az élő bejegyzésekkel (lejárt / kiszorult sorok nélkül)."""
+        now = time.time()
+        with self._lock:
+            entries = [
+                (key, created, value) for key, (created, value) in self._entries.items()
+                if now - created <= self.ttl
+            ]
+        self._rewrite(entries)
+        self.compactions += 1
+
+    def _rewrite(self, entries: list) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, created, value in entries:
+                f.write(json.dumps({"key": key, "t": created, "value": value},
+                                   ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self._log_lines = len(entries)
+
+    def _load(self) -> None:
+        """Napló visszatöltése és tömörítése (lejárt / felesleges sorok nélkül)."""
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if now - rec["t"] <= self.ttl:
+                    self._entries[rec["key"]] = (rec["t"], rec["value"])
+                    self._entries.move_to_end(rec["key"])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        self._rewrite([(key, created, value) for key, (created, value) in self._entries.items()])
+        log.info(f"Válasz cache betöltve: {len(self._entries)} bejegyzés ({self.path})")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "persistent": bool(self.path),
+            "log_lines": self._log_lines if self.path else None,
+            "compactions": self.compactions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def _profile_requested(request: Request) -> bool:
+    return request.headers.get("x-profile", "").lower() in ("1", "true", "yes")
+
+
+def _cache_bypassed(request: Request) -> bool:
+    if request.headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+
+# ---------------------------------------------------------------------------
+# Chat munkamenetek (tokenizált előzmény szerveroldalon)
+# ---------------------------------------------------------------------------
+
+def _context_length() -> int:
+    if CHAT_CONTEXT_TOKENS > 0:
+        return CHAT_CONTEXT_TOKENS
+    for attr in ("max_position_embeddings", "n_positions", "max_sequence_length"):
+        n = getattr(_model.config, attr, None)
+        if n:
+            return int(n)
+    return 2048
+
+
+class _ChatTurn:
+    __slots__ = ("role", "content", "ids")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        # Az első helyen álló üzenetet a tokenizer másképp kódolhatja
+        self.ids: dict[bool, tuple[int, ...]] = {}
+
+    @property
+    def text(self) -> str:
+        return PROMPT_SEGMENTS[self.role].format(self.content)
+
+    def encoded(self, first: bool) -> tuple[int, ...]:
+        ids = self.ids.get(first)
+        if ids is None:
+            ids = self.ids[first] = _prompt_encoder.segment(self.text, first)
+        return ids
+
+
+class ChatSession:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.system: Optional[_ChatTurn] = None
+        self.turns: list[_ChatTurn] = []
+        self.last_used = time.time()
+
+    def trim(self, max_tokens: int) -> None:
+        """A tárolt előzmény sem nőhet a kontextusablak fölé."""
+        total = sum(len(t.encoded(False)) for t in self.turns)
+        while self.turns and total > max_tokens:
+            total -= len(self.turns.pop(0).encoded(False))
+
+
+class ChatSessionStore:
+    """Munkamenetek LRU-ban, TTL lejárattal (csak az eseményhurokból használt)."""
+
+    def __init__(self, max_sessions: int, ttl_seconds: float):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl_seconds
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.truncated_total = 0
+
+    def get(self, session_id: str) -> ChatSession:
+        now = time.time()
+        session = self._sessions.get(session_id)
+        if session is None or now - session.last_used > self.ttl:
+            session = self._sessions[session_id] = ChatSession(session_id)
+        self._sessions.move_to_end(session_id)
+        session.last_used = now
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "truncated_messages_total": self.truncated_total,
+        }
+
+
+def _build_chat_prompt(
+    system: Optional[_ChatTurn], turns: list[_ChatTurn], max_new_tokens: int
+) -> tuple[list[int], int]:
+    """
+    Prompt összeállítása a tárolt token id-kból. Ha nem fér a kontextus-
+    ablakba, a legrégebbi üzenetek kimaradnak (a rendszer prompt és az
+    utolsó üzenet soha). Visszaad: (prompt id-k, kihagyott üzenetek száma).
+    """
+    head = list(_prompt_encoder.prefix) + (list(system.encoded(True)) if system is not None else [])
+    tail = _prompt_encoder.segment(GENERATION_PROMPT)
+    budget = _context_length() - max_new_tokens - len(head) - len(tail)
+
+    def cost(i: int, first: bool = False) -> int:
+        return len(turns[i].encoded(first))
+
+    # Hátulról annyi üzenet, amennyi belefér
+    start, used = len(turns), 0
+    while start > 0 and used + cost(start - 1) <= budget:
+        start -= 1
+        used += cost(start)
+    # Felhasználói üzenettel kezdünk; rendszer prompt nélkül az első
+    # üzenet kódolása (és így a hossza) eltérhet
+    while start < len(turns):
+        if turns[start].role == "user" and used - cost(start) + cost(start, system is None) <= budget:
+            break
+        used -= cost(start)
+        start += 1
+    if start >= len(turns):
+        raise HTTPException(
+            413,
+            f"Az utolsó üzenet és a max_new_tokens ({max_new_tokens}) nem fér "
+            f"a kontextusablakba ({_context_length()} token).",
+        )
+
+    if not _prompt_encoder.segmented:
+        # A kiválasztott üzenetek egyben kódolódnak (a hosszuk fent becslés)
+        parts = ([system] if system is not None else []) + turns[start:]
+        text = "".join(t.text for t in parts) + GENERATION_PROMPT
+        return list(_prompt_encoder.prefix) + list(_prompt_encoder.segment(text, True)), start
+
+    ids = head
+    for i, turn in enumerate(turns[start:]):
+        ids.extend(turn.encoded(system is None and i == 0))
+    ids.extend(tail)
+    return ids, start
+
+
+_chat_sessions = ChatSessionStore(CHAT_MAX_SESSIONS, CHAT_SESSION_TTL)
+
+
+# ---------------------------------------------------------------------------
+# Határidők, megszakítás, leállítás
+# ---------------------------------------------------------------------------
+
+# Leállításkor nem fogadunk új kérést, a futók SHUTDOWN_GRACE_SECONDS-ig futhatnak
+_draining = False
+
+
+def _request_deadline(req: GenerateRequest, request: Optional[Request] = None) -> Optional[float]:
+    """Abszolút határidő (perf_counter): a mező, a fejléc és az alapérték közül a legszigorúbb."""
+    limits = [req.timeout] if req.timeout else []
+    raw = request.headers.get("X-Request-Timeout") if request is not None else None
+    if raw:
+        try:
+            limit = float(raw)
+        except ValueError:
+            limit = 0.0
+        if not limit > 0:
+            raise HTTPException(400, f"Érvénytelen X-Request-Timeout fejléc: {raw!r}")
+        limits.append(limit)
+    if not limits and REQUEST_TIMEOUT > 0:
+        limits.append(REQUEST_TIMEOUT)
+    return time.perf_counter() + min(limits) if limits else None
+
+
+async def _before_deadline(aw, deadline: Optional[float]):
+    """Várakozás (pl. beengedésre) legfeljebb a határidőig, utána 504."""
+    if deadline is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, max(0.0, deadline - time.perf_counter()))
+    except asyncio.TimeoutError:
+        raise HTTPException(504, "A kérés határideje lejárt a beengedésre várva.")
+
+
+async def _wait_disconnect(request: Request) -> None:
+    # A törzs már beolvasva: a következő ASGI üzenet csak a bontás lehet
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _cancel_on_disconnect(request: Request, coro):
+    """
+    coro futtatása; ha közben a kliens bontja a kapcsolatot, a coro
+    megszakad (a beengedési sorból kilép, a futó generálás leáll) és
+    None a visszatérési érték.
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_wait_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        M_DISCONNECTS.inc()
+        log.info("Kliens lecsatlakozott – kérés megszakítva.")
+        return None
+    return task.result()
+
+
+async def _drain(grace_seconds: float) -> None:
+    """Leállítás előtt a beengedett és sorban álló kérések befejezésének kivárása."""
+    deadline = time.monotonic() + grace_seconds
+    while _admission is not None and not _admission.idle:
+        if time.monotonic() >= deadline:
+            log.warning(f"Leállítás: {grace_seconds:g} mp után is van futó kérés – megszakítva.")
+            return
+        await asyncio.sleep(0.1)
+
+
+class _GracefulServer(uvicorn.Server):
+    """
+    Az uvicorn a lifespan leállítását csak a figyelő socket bezárása után
+    futtatja, ott a draining állapot már nem látszana. Ezért az első
+    leállítási jelnél a szerver még fogad kapcsolatokat: az új kérések
+    503 + Retry-After választ kapnak, a /health "draining", a futó kérések
+    SHUTDOWN_GRACE_SECONDS-ig befejeződhetnek – csak ezután indul az
+    uvicorn saját leállása. Második jel: azonnali leállás.
+    """
+
+    def __init__(self, config: uvicorn.Config):
+        super().__init__(config)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def serve(self, sockets=None) -> None:
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets)
+
+    def handle_exit(self, sig, frame) -> None:
+        global _draining
+        if _draining or self.should_exit or self._loop is None:
+            super().handle_exit(sig, frame)
+            return
+        _draining = True
+        log.info(f"Leállítási jel – draining, legfeljebb {SHUTDOWN_GRACE_SECONDS:g} mp.")
+        self._loop.call_soon_threadsafe(
+            lambda: self._loop.create_task(self._drain_then_exit(sig, frame))
+        )
+
+    async def _drain_then_exit(self, sig, frame) -> None:
+        await _drain(SHUTDOWN_GRACE_SECONDS)
+        super().handle_exit(sig, frame)
+
+
+# ---------------------------------------------------------------------------
+# Endpointok
+# ---------------------------------------------------------------------------
+
+@app.get("/health")
+async def health():
+    gpu_info = []
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            alloc = torch.cuda.memory_allocated(i) / (1024**3)
+            total = torch.cuda.get_device_properties(i).total_memory / (1024**3)
+            gpu_info.append({
+                "index": i,
+                "name": torch.cuda.get_device_properties(i).name,
+                "used_gb": round(alloc, 2),
+                "total_gb": round(total, 2),
+            })
+    stage = _readiness["stage"]
+    status = "ok" if stage == "ready" else "error" if stage == "failed" else "loading"
+    if _draining:
+        status = "draining"
+    return {
+        "status": status,
+        "model": MODEL_NAME,
+        "model_loaded": _dispatcher is not None,
+        "readiness": {
+            **_readiness,
+            "elapsed_seconds": round(time.time() - _readiness["started_at"], 2),
+        },
+        "gpus": gpu_info,
+        "quantization": {
+            "mode": _quantization_info["mode"],
+            # Replikánként
+            "footprint_mb": [round(b / 1024 ** 2, 1) for b in _quantization_info["footprint_bytes"]],
+        },
+        "replicas": {**_dispatcher.stats(), **_replica_info} if _dispatcher is not None else None,
+        "microbatch": _microbatcher.stats() if _microbatcher is not None else None,
+        "response_cache": _response_cache.stats() if _response_cache is not None else None,
+        "admission": _admission.stats() if _admission is not None else None,
+        "chat": _chat_sessions.stats(),
+        "tokenizer": _prompt_encoder.stats() if _prompt_encoder is not None else None,
+        "profiler": _profiler.stats(),
+    }
+
+
+@app.post("/generate", response_model=GenerateResponse)
+async def generate(req: GenerateRequest, request: Request, response: Response):
+    await _await_ready()
+    deadline = _request_deadline(req, request)
+    if _profile_requested(request):
+        req.profile = True
+
+    # Determinisztikus kérés: a cache-ből, a modell érintése nélkül
+    cache_key = None
+    if _response_cache is not None and ResponseCache.cacheable(req):
+        if _cache_bypassed(request):
+            _response_cache.bypass()
+            response.headers["X-Cache"] = "BYPASS"
+        else:
+            cache_key = ResponseCache.key(req)
+            cached = _response_cache.get(cache_key)
+            if cached is not None:
+                if req.stream:
+                    return _cached_stream_response(cached, req.stream_format)
+                response.headers["X-Cache"] = "HIT"
+                return GenerateResponse(
+                    **{**cached, "elapsed_seconds": 0.0, "draft_acceptance_rate": None}
+                )
+            response.headers["X-Cache"] = "MISS"
+
+    profile = _profiler.begin(req)
+    t_tok = time.perf_counter()
+    prompt_ids = await _prompt_encoder.encode_prompt(req)
+    if profile is not None:
+        profile.tokenize_s = time.perf_counter() - t_tok
+        response.headers["X-Profile-Id"] = profile.id
+
+    async def run():
+        # Token-keret: ami most nem fér be, rövid ideig vár, különben gyors 429
+        ticket = await _before_deadline(
+            _admission.acquire(req.priority, len(prompt_ids) + req.max_new_tokens), deadline
+        )
+        if req.stream:
+            return await _stream_response(
+                req, cache_key, ticket, prompt_ids=prompt_ids, deadline=deadline, profile=profile
+            )
+        M_IN_FLIGHT.inc()
+        try:
+            # Határidős és profilozott kérés nem megy mikro-batch-be: ott nem
+            # lehet soronként leállítani, és nincs ütemező-lépés a méréshez
+            if _microbatcher is not None and deadline is None and profile is None:
+                return await _microbatcher.generate(req)
+            seq = await _dispatcher.pick(req.session_id).generate(
+                req, prompt_ids, deadline, profile
+            )
+            return _build_response(seq)
+        finally:
+            M_IN_FLIGHT.dec()
+            _admission.release(ticket)
+
+    result = await _cancel_on_disconnect(request, run())
+    if result is None:
+        return Response(status_code=499)
+    if isinstance(result, StreamingResponse):
+        return result
+    if cache_key is not None and result.finish_reason != "timeout":
+        _response_cache.put(cache_key, result.model_dump())
+    return result
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _sse_event(text: str) -> str:
+    """SSE esemény; a többsoros szöveg soronként külön data: mezőbe kerül."""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+
+def _ndjson_frame(frame: dict) -> str:
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _cached_stream_response(cached: dict, stream_format: str = "sse") -> StreamingResponse:
+    """Cache találat streaming kérésre: a teljes szöveg egy eseményben."""
+
+    async def event_generator() -> AsyncGenerator[str, None]:
+        if stream_format == "ndjson":
+            if cached["text"]:
+                yield _ndjson_frame({"ids": [], "text": cached["text"], "t_ms": []})
+            yield _ndjson_frame({
+                "done": True, **cached, "elapsed_seconds": 0.0, "draft_acceptance_rate": None,
+            })
+            return
+        if cached["text"]:
+            yield _sse_event(cached["text"])
+        yield "data: [DONE]\n\n"
+
+    media_type = NDJSON_MEDIA_TYPE if stream_format == "ndjson" else "text/event-stream"
+    return StreamingResponse(event_generator(), media_type=media_type, headers={"X-Cache": "HIT"})
+
+
+class _AdmittedStreamingResponse(StreamingResponse):
+    """
+    A beengedési foglalást a válasz küldése után mindenképp elengedi. Ha a
+    kliens a törzs iterálása előtt bont (ClientDisconnect a válasz
+    indításakor), a generátor el sem indul, így annak finally ága sem fut.
+    """
+
+    def __init__(self, *args, ticket: Optional[AdmissionTicket] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if _admission is not None:
+                _admission.release(self.ticket)
+
+
+async def _stream_response(
+    req: GenerateRequest,
+    cache_key: Optional[str] = None,
+    ticket: Optional[AdmissionTicket] = None,
+    prompt_ids: Optional[list[int]] = None,
+    on_complete: Optional[Callable[[_Sequence], dict]] = None,
+    deadline: Optional[float] = None,
+    profile: Optional[_ProfileRecord] = None,
+) -> StreamingResponse:
+    """
+    Streaming válasz SSE vagy NDJSON formátumban.
+    A tokenek asyncio sorban érkeznek az ütemező szálból; ha a kliens
+    bontja a kapcsolatot, a generálás a következő lépésnél leáll.
+
+    A szövegdeltákat az ütemező állítja elő (stop szekvenciák nélkül).
+
+    NDJSON keret: {"ids": [...], "text": "...", "t_ms": [...], "logprobs": [...]}
+    – terhelés alatt egy keret az összes addig felgyűlt tokent viszi. A
+    t_ms a beküldés óta eltelt idő tokenenként; a záró keret a
+    GenerateResponse mezői + "done": true.
+    Az on_complete a sikeres generálás után fut; az általa visszaadott
+    mezők a záró NDJSON keretbe kerülnek. Profilozott kérésnél az
+    azonosító az X-Profile-Id fejlécben, az időbontás a záró keretben.
+    """
+    try:
+        scheduler = _dispatcher.pick(req.session_id)
+        if prompt_ids:
+            scheduler.kv_pool.check(len(prompt_ids) + req.max_new_tokens)
+    except HTTPException:
+        # A foglalást különben a (el sem induló) generátor engedné el
+        _admission.release(ticket)
+        raise
+    ndjson = req.stream_format == "ndjson"
+
+    def on_token(seq: _Sequence, token_id: int) -> None:
+        # Az ütemező szálán fut: itt a logprob és a szövegdelta már a helyén van
+        logprob = seq.output_logprobs[-1] if seq.req.logprobs else None
+        item = (token_id, time.perf_counter(), logprob, seq.text_delta)
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[Optional[tuple]] = asyncio.Queue()
+
+    async def event_generator() -> AsyncGenerator[str, None]:
+        seq = _Sequence(
+            req,
+            on_token=on_token,
+            on_finish=lambda _: loop.call_soon_threadsafe(queue.put_nowait, None),
+            prompt_ids=prompt_ids,
+            deadline=deadline,
+            profile=profile,
+        )
+        seq.mode = "stream"
+        seq.max_backlog = STREAM_MAX_BACKLOG
+        M_IN_FLIGHT.inc()
+        scheduler.submit(seq)
+
+        try:
+            done = False
+            while not done:
+                # Ami a sorban már várakozik, egy keretbe kerül
+                items = [await queue.get()]
+                while not queue.empty():
+                    items.append(queue.get_nowait())
+                if items[-1] is None:
+                    items.pop()
+                    done = True
+                if not items:
+                    continue
+                seq.consumed += len(items)
+                if seq.paused and seq.drained:
+                    scheduler.wake()
+                text = "".join(delta for _, _, _, delta in items)
+                if ndjson:
+                    frame = {
+                        "ids": [token_id for token_id, _, _, _ in items],
+                        "text": text,
+                        "t_ms": [round((t - seq.t_submit) * 1000, 2) for _, t, _, _ in items],
+                    }
+                    if req.logprobs:
+                        frame["logprobs"] = [round(lp, 5) for _, _, lp, _ in items]
+                    yield _ndjson_frame(frame)
+                elif text:
+                    yield _sse_event(text)
+
+            result = None
+            if seq.error is None and (ndjson or cache_key is not None):
+                result = _build_response(seq).model_dump()
+            if cache_key is not None and result is not None and seq.finish_reason not in ("cancelled", "timeout"):
+                _response_cache.put(cache_key, result)
+            if seq.error is None and on_complete is not None:
+                extra = on_complete(seq)
+                if result is not None:
+                    result = {**result, **extra}
+            if not ndjson:
+                yield "data: [DONE]\n\n"
+            elif result is None:
+                yield _ndjson_frame({
+                    "done": True,
+                    "error": getattr(seq.error, "detail", None) or str(seq.error),
+                    "finish_reason": seq.finish_reason,
+                })
+            else:
+                yield _ndjson_frame({"done": True, **result})
+        finally:
+            M_IN_FLIGHT.dec()
+            if not seq.finished:
+                log.info("Streaming kliens lecsatlakozott – generálás megszakítva.")
+                seq.cancel()
+                scheduler.wake()
+            _admission.release(ticket)
+
+    headers = {"X-Cache": "MISS"} if cache_key is not None else {}
+    if profile is not None:
+        headers["X-Profile-Id"] = profile.id
+    media_type = NDJSON_MEDIA_TYPE if ndjson else "text/event-stream"
+    return _AdmittedStreamingResponse(
+        event_generator(), media_type=media_type, headers=headers, ticket=ticket
+    )
+
+
+def _response_text(seq: _Sequence) -> str:
+    """A kliensnek szóló szöveg (stop szekvencia nélkül)."""
+    if seq.stopper is not None:
+        # Az ütemező már detokenizált (a stop szekvencia nélkül)
+        return seq.stopper.text
+    t0 = time.perf_counter()
+    text = _tokenizer.decode(seq.output_ids, skip_special_tokens=True)
+    M_PHASE.observe(time.perf_counter() - t0, phase="detokenize")
+    return text
+
+
+def _build_response(seq: _Sequence) -> GenerateResponse:
+    return GenerateResponse(
+        text=_response_text(seq),
+        tokens_generated=len(seq.output_ids),
+        elapsed_seconds=round(seq.elapsed, 3),
+        model=MODEL_NAME,
+        draft_acceptance_rate=seq.draft_acceptance_rate,
+        finish_reason=seq.finish_reason,
+        stop_sequence=seq.stopper.matched if seq.stopper is not None else None,
+        profile=seq.profile.result if seq.profile is not None and not seq.profile.sampled else None,
+    )
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest, request: Request, response: Response):
+    """
+    Chat strukturált üzenetekkel. Az előzmény token id-ként tárolódik, a
+    prompt ezekből áll össze (újratokenizálás nélkül), és a kontextusablakon
+    túllógó legrégebbi üzenetek kimaradnak.
+    """
+    await _await_ready()
+    deadline = _request_deadline(req, request)
+    if _profile_requested(request):
+        req.profile = True
+    profile = _profiler.begin(req)
+
+    session = _chat_sessions.get(req.session_id) if req.session_id else None
+    incoming = list(req.messages)
+    if req.prompt:
+        incoming.append(ChatMessage(role="user", content=req.prompt))
+    if not incoming:
+        raise HTTPException(422, "Üres chat kérés: messages vagy prompt szükséges.")
+
+    system = session.system if session is not None else None
+    if req.system_prompt:
+        system = _ChatTurn("system", req.system_prompt)
+    new_turns = []
+    for msg in incoming:
+        if msg.role == "system":
+            system = _ChatTurn("system", msg.content)
+        else:
+            new_turns.append(_ChatTurn(msg.role, msg.content))
+    if not new_turns or new_turns[-1].role != "user":
+        raise HTTPException(422, "A chat kérés utolsó üzenete felhasználói üzenet kell legyen.")
+
+    history = (session.turns if session is not None else []) + new_turns
+    # Az új szegmensek egy kötegben tokenizálódnak (a többi már a cache-ben van)
+    t_tok = time.perf_counter()
+    await _prompt_encoder.segments(
+        [(t.text, False) for t in new_turns] + ([(system.text, True)] if system else [])
+    )
+    prompt_ids, truncated = _build_chat_prompt(system, history, req.max_new_tokens)
+    _chat_sessions.truncated_total += truncated
+    if profile is not None:
+        profile.tokenize_s = time.perf_counter() - t_tok
+        response.headers["X-Profile-Id"] = profile.id
+
+    def commit(seq: _Sequence, text: Optional[str] = None) -> dict:
+        """
+        Sikeres válasz után az új üzenetek és a válasz a munkamenetbe kerülnek
+        – a kliensnek küldött (stop szekvencia nélküli) szöveggel, hogy egy
+        kitalált új kör ne kerüljön a későbbi promptokba.
+        """
+        if session is not None:
+            reply = text if text is not None else _response_text(seq)
+            session.system = system
+            session.turns.extend(new_turns + [_ChatTurn("assistant", reply)])
+            session.trim(_context_length())
+        return {
+            "session_id": req.session_id,
+            "prompt_tokens": len(prompt_ids),
+            "truncated_messages": truncated,
+        }
+
+    async def run():
+        ticket = await _before_deadline(
+            _admission.acquire(req.priority, len(prompt_ids) + req.max_new_tokens), deadline
+        )
+        if req.stream:
+            return await _stream_response(
+                req, None, ticket, prompt_ids=prompt_ids, on_complete=commit, deadline=deadline,
+                profile=profile,
+            )
+        M_IN_FLIGHT.inc()
+        try:
+            seq = await _dispatcher.pick(req.session_id).generate(
+                req, prompt_ids, deadline, profile
+            )
+        finally:
+            M_IN_FLIGHT.dec()
+            _admission.release(ticket)
+        result = _build_response(seq)
+        return ChatResponse(**result.model_dump(), **commit(seq, result.text))
+
+    result = await _cancel_on_disconnect(request, run())
+    return result if result is not None else Response(status_code=499)
+
+
+async def _tokenize(req: TokenizeRequest) -> list[list[int]]:
+    texts = [req.text] if isinstance(req.text, str) else req.text
+    if req.template:
+        return await asyncio.gather(*(
+            _prompt_encoder.encode_prompt(GenerateRequest(prompt=t, system_prompt=req.system_prompt))
+            for t in texts
+        ))
+    return [list(ids) for ids in await _prompt_encoder.segments([(t, True) for t in texts])]
+
+
+@app.post("/tokenize")
+async def tokenize(req: TokenizeRequest):
+    """Token id-k (a generálással azonos, cache-elt kódolással)."""
+    await _await_ready()
+    ids = await _tokenize(req)
+    if isinstance(req.text, str):
+        return {"ids": ids[0], "count": len(ids[0])}
+    return {"ids": ids, "count": [len(x) for x in ids]}
+
+
+@app.post("/count_tokens")
+async def count_tokens(req: TokenizeRequest):
+    """Csak a tokenszám és a kontextusablak – a hívó generálás nélkül költségvetéshez."""
+    await _await_ready()
+    counts = [len(x) for x in await _tokenize(req)]
+    return {
+        "count": counts[0] if isinstance(req.text, str) else counts,
+        "context_length": _context_length(),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Offline batch generálás (JSONL be → JSONL ki)
+# ---------------------------------------------------------------------------
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """
+    Válasz, ami a kérés törzsének olvasása közben már ír. A StreamingResponse
+    bontásfigyelője a receive()-ből olvasna, és elnyelné a törzs darabjait;
+    itt a bontást a _JsonlBody észleli.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+
+
+class _JsonlBody:
+    """
+    A kérés törzse soronként, korlátos pufferrel. Amíg a puffer a korlát
+    alatt van, mindig fut egy receive() a háttérben: így a kapcsolatbontás
+    akkor is kiderül, ha épp szabad helyre várunk, és a törzs vége után is.
+    A korlátnál hosszabb sor helyén None jön, a sor többi része eldobódik.
+    """
+
+    BUFFER_LIMIT = 1024 * 1024
+
+    def __init__(self, request: Request):
+        self._receive = request.receive
+        self._lines: deque[Optional[bytes]] = deque()
+        self._partial = b""
+        self._queued = 0
+        self._skipping = False
+        self._more = True
+        self._recv: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self.disconnected = asyncio.Event()
+
+    def _pump(self) -> None:
+        if (self._recv is not None or self.disconnected.is_set()
+                or self._queued + len(self._partial) >= self.BUFFER_LIMIT):
+            return
+        self._recv = asyncio.create_task(self._receive())
+        self._recv.add_done_callback(self._on_message)
+
+    def _on_message(self, task: asyncio.Task) -> None:
+        self._recv = None
+        if task.cancelled():
+            return
+        message = task.result()
+        if message["type"] == "http.disconnect":
+            self.disconnected.set()
+        else:
+            *lines, self._partial = (self._partial + message.get("body", b"")).split(b"\n")
+            if self._skipping and lines:
+                # A túl hosszú sor vége
+                lines.pop(0)
+                self._skipping = False
+            self._more = message.get("more_body", False)
+            if self._skipping:
+                self._partial = b""
+            elif len(self._partial) >= self.BUFFER_LIMIT:
+                # Sorvég nélkül a puffer sosem ürülne ki: a sort eldobjuk
+                self._partial = b""
+                self._skipping = self._more
+                lines.append(None)
+            if not self._more and self._partial:
+                lines.append(self._partial)
+                self._partial = b""
+            self._lines.extend(lines)
+            self._queued += sum(len(line) + 1 for line in lines if line is not None)
+        self._changed.set()
+        # A törzs vége után a függő receive() már csak a bontást jelezheti
+        self._pump()
+
+    async def lines(self) -> AsyncGenerator[Optional[str], None]:
+        while True:
+            self._pump()
+            if self._lines:
+                line = self._lines.popleft()
+                if line is None:
+                    yield None
+                    continue
+                self._queued -= len(line) + 1
+                yield line.decode("utf-8")
+                continue
+            if not self._more:
+                return
+            if self.disconnected.is_set():
+                raise ClientDisconnect()
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def guard(self, aw) -> bool:
+        """aw bevárása; False, ha közben bontott a kliens (aw ilyenkor megszakad)."""
+        task = asyncio.ensure_future(aw)
+        watch = asyncio.create_task(self.disconnected.wait())
+        try:
+            await asyncio.wait({task, watch}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watch.cancel()
+        if not task.done():
+            task.cancel()
+            return False
+        return True
+
+    def close(self) -> None:
+        if self._recv is not None:
+            self._recv.cancel()
+
+
+async def _acquire_patiently(priority: str, cost: int) -> AdmissionTicket:
+    """Batch feladatnál a 429 nem hiba: Retry-After szerint újrapróbáljuk."""
+    while True:
+        try:
+            return await _admission.acquire(priority, cost)
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise
+            await asyncio.sleep(min(float(e.headers["Retry-After"]), 5.0))
+
+
+async def _generate_one(req: GenerateRequest) -> dict:
+    """Egy batch sor: cache, beengedés, majd ugyanaz az út, mint a /generate-nél."""
+    cache_key = None
+    if _response_cache is not None and ResponseCache.cacheable(req):
+        cache_key = ResponseCache.key(req)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            return {**cached, "elapsed_seconds": 0.0, "draft_acceptance_rate": None}
+
+    deadline = _request_deadline(req)
+    profile = _profiler.begin(req)
+    t_tok = time.perf_counter()
+    prompt_ids = await _prompt_encoder.encode_prompt(req)
+    if profile is not None:
+        profile.tokenize_s = time.perf_counter() - t_tok
+    ticket = await _before_deadline(
+        _acquire_patiently(req.priority, len(prompt_ids) + req.max_new_tokens), deadline
+    )
+    M_IN_FLIGHT.inc()
+    try:
+        if _microbatcher is not None and deadline is None and profile is None:
+            result = await _microbatcher.generate(req)
+        else:
+            seq = await _dispatcher.pick(req.session_id).generate(
+                req, prompt_ids, deadline, profile
+            )
+            result = _build_response(seq)
+    finally:
+        M_IN_FLIGHT.dec()
+        _admission.release(ticket)
+
+    if cache_key is not None and result.finish_reason != "timeout":
+        _response_cache.put(cache_key, result.model_dump())
+    return result.model_dump()
+
+
+async def _batch_results(request: Request) -> AsyncGenerator[str, None]:
+    """
+    Legfeljebb BATCH_MAX_IN_FLIGHT sor van egyszerre úton (futó vagy kész,
+    de még el nem küldött); a hely csak a kimeneti sor elküldése után
+    szabadul fel, így sem a bemenet, sem a kimenet nem gyűlik fel.
+    Az eredmények befejezési sorrendben, az azonosítóval együtt jönnek.
+    """
+    body = _JsonlBody(request)
+    window = asyncio.Semaphore(max(1, BATCH_MAX_IN_FLIGHT))
+    results: asyncio.Queue[Optional[dict]] = asyncio.Queue()
+    tasks: set[asyncio.Task] = set()
+
+    async def run_one(item_id, req: GenerateRequest) -> None:
+        try:
+            out = {"id": item_id, **await _generate_one(req)}
+        except HTTPException as e:
+            out = {"id": item_id, "error": e.detail, "status": e.status_code}
+        except Exception as e:
+            log.exception("Batch sor generálási hiba")
+            out = {"id": item_id, "error": str(e), "status": 500}
+        results.put_nowait(out)
+
+    async def reader() -> None:
+        line_no = 0
+        try:
+            async for line in body.lines():
+                line_no += 1
+                if line is not None and not line.strip():
+                    continue
+                if not await body.guard(window.acquire()):
+                    raise ClientDisconnect()
+                item_id = line_no
+                if line is None:
+                    results.put_nowait({
+                        "id": item_id, "status": 413,
+                        "error": f"A sor hosszabb {_JsonlBody.BUFFER_LIMIT} bájtnál.",
+                    })
+                    continue
+                try:
+                    obj = json.loads(line)
+                    item_id = obj.pop("id", line_no)
+                    # Alapból batch prioritás; a streaming itt értelmetlen
+                    req = GenerateRequest(**{"priority": "batch", **obj, "stream": False})
+                except (ValueError, TypeError, AttributeError, ValidationError) as e:
+                    results.put_nowait({"id": item_id, "error": str(e), "status": 422})
+                    continue
+                task = asyncio.create_task(run_one(item_id, req))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            while tasks:
+                if not await body.guard(asyncio.wait(set(tasks))):
+                    raise ClientDisconnect()
+        except ClientDisconnect:
+            log.info("Batch kliens lecsatlakozott – a futó sorok megszakítva.")
+        except Exception as e:
+            log.warning(f"Batch bemenet olvasása megszakadt: {e}")
+            results.put_nowait({"id": None, "error": f"Bemeneti hiba: {e}", "status": 400})
+        finally:
+            results.put_nowait(None)
+
+    reader_task = asyncio.create_task(reader())
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+            window.release()
+    finally:
+        body.close()
+        for task in (reader_task, *tasks):
+            task.cancel()
+
+
+@app.post("/generate_batch")
+async def generate_batch(request: Request):
+    """
+    JSONL bemenet (soronként egy GenerateRequest, opcionális "id" mezővel),
+    JSONL kimenet befejezési sorrendben: {"id", "text", ...} vagy
+    {"id", "error", "status"}. Nagy fájlokhoz chunked feltöltéssel.
+    """
+    await _await_ready()
+    return _DuplexStreamingResponse(_batch_results(request), media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/profiles")
+async def list_profiles(limit: int = 50):
+    """A legutóbbi profilok időbontása (a legfrissebbel kezdve)."""
+    return {"profiles": _profiler.recent(limit)}
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    summary = _profiler.load(profile_id)
+    if summary is None:
+        raise HTTPException(404, "Ismeretlen profil azonosító.")
+    return summary
+
+
+@app.get("/profiles/{profile_id}/trace")
+async def get_profile_trace(profile_id: str):
+    """A trace fájl: torch backendnél Chrome trace (chrome://tracing, Perfetto), cProfile-nál pstats."""
+    if not profile_id.isalnum() or not os.path.exists(_profiler.trace_path(profile_id)):
+        raise HTTPException(404, "Nincs (még) trace ehhez a profilhoz.")
+    path = _profiler.trace_path(profile_id)
+    media_type = "application/json" if path.endswith(".json") else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
+
+@app.get("/gpu_info")
+async def gpu_info_endpoint():
+    info = detect_gpus()
+    if _dispatcher is not None:
+        replicas = []
+        for s in _dispatcher.replicas:
+            entry = {"replica": s.replica, "device": str(s.device), "healthy": s.healthy}
+            if s.device.type == "cuda":
+                entry["used_gb"] = round(torch.cuda.memory_allocated(s.device) / (1024**3), 2)
+            replicas.append(entry)
+        info["replicas"] = replicas
+    return info
+
+
+# ---------------------------------------------------------------------------
+# Belépési pont
+# ---------------------------------------------------------------------------
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="ClawDBot LLM szerver")
+    sub = ap.add_subparsers(dest="command")
+    sub.add_parser("serve", help="HTTP szerver indítása (alapértelmezett)")
+    snap = sub.add_parser("snapshot", help="Gyors induláshoz használható modell snapshot")
+    snap.add_argument("out_dir", nargs="?", default=MODEL_SNAPSHOT_DIR,
+                      help="Cél könyvtár (alapból MODEL_SNAPSHOT_DIR)")
+    args = ap.parse_args(argv)
+
+    if args.command == "snapshot":
+        if not args.out_dir:
+            ap.error("Add meg a cél könyvtárat vagy a MODEL_SNAPSHOT_DIR-t.")
+        create_snapshot(args.out_dir)
+        return
+
+    # Az app objektum (nem "model_server:app"): a draining jelző így ugyanabban
+    # a modulpéldányban áll be, amelyiket a kérések látnak
+    config = uvicorn.Config(
+        app,
+        host=HOST,
+        port=PORT,
+        log_level="info",
+        workers=1,          # Több worker nem kompatibilis a GPU-megosztással
+        # A kérések a draining alatt befejeződtek; ez már csak a válaszok
+        # kiküldésének és a nyitva maradt kapcsolatoknak szóló tartalék
+        timeout_graceful_shutdown=5,
+    )
+    try:
+        _GracefulServer(config).run()
+    except KeyboardInterrupt:
+        # Ctrl+C: az uvicorn a leállás után újra kiváltja a jelet
+        pass
+
+
+if __name__ == "__main__":
+    main()
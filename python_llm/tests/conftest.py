@@ -0,0 +1,77 @@
+"""
+Közös tesztkörnyezet: a model_server modul importja és apró, véletlen
+súlyú Llama modellek (letöltés nélkül, CPU-n).
+"""
+
+import asyncio
+import os
+import sys
+from typing import Optional
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_server as ms  # noqa: E402
+
+VOCAB_SIZE = 64
+
+
+def tiny_llama(seed: int) -> LlamaForCausalLM:
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        # EOS nélkül minden kérés max_new_tokens hosszú, ami sok lépést ellenőriz
+        bos_token_id=None,
+        eos_token_id=None,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def run_scheduler(model, tokenizer, prompts: list, draft=None, max_new_tokens: int = 24,
+                  stats: Optional[dict] = None, stop: Optional[list] = None) -> list:
+    """
+    Mohó kérések egymás utáni végigfuttatása egy saját ütemezőn (így a
+    későbbiek a korábbiak prefix cache-ét is láthatják); a kész szekvenciák.
+    A stats dict (ha van) az ütemező végső stats()-át kapja.
+    """
+    scheduler = ms.GenerationScheduler(model, tokenizer, max_batch_size=1, draft_model=draft)
+    scheduler.start()
+
+    async def run() -> list:
+        seqs = []
+        for prompt_ids in prompts:
+            req = ms.GenerateRequest(
+                prompt="teszt", max_new_tokens=max_new_tokens, temperature=0.0, stop=stop or [],
+            )
+            seqs.append(await scheduler.generate(req, prompt_ids=prompt_ids))
+        return seqs
+
+    try:
+        return asyncio.run(run())
+    finally:
+        scheduler.stop()
+        if stats is not None:
+            stats.update(scheduler.stats())
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    vocab = {f"t{i}": i for i in range(VOCAB_SIZE)}
+    return PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(models.WordLevel(vocab, unk_token="t0")),
+    )
+
+
+@pytest.fixture(scope="session")
+def target():
+    return tiny_llama(seed=0)
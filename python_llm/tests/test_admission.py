@@ -0,0 +1,222 @@
+"""
+Beengedés token-keretre: foglalás és elengedés minden úton, a keretnél
+nagyobb kérés elutasítása, interaktív elsőbbség a sorban, és lejárt
+várakozásnál 429 + Retry-After.
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from conftest import ms
+
+
+def _controller(budget: int = 100, max_queue: int = 4, queue_timeout: float = 5.0):
+    return ms.AdmissionController(
+        budget, batch_share=0.5, max_queue=max_queue, queue_timeout=queue_timeout
+    )
+
+
+async def _settle() -> None:
+    """A várakozó feladatok eljutnak a sorba állásig / a beengedés feldolgozásáig."""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_acquire_release_round_trip():
+    async def run():
+        adm = _controller()
+        a = await adm.acquire("interactive", 60)
+        b = await adm.acquire("batch", 40)
+        assert adm.stats()["in_use_by_priority"] == {"interactive": 60, "batch": 40}
+
+        adm.release(a)
+        adm.release(a)
+        adm.release(None)
+        assert adm.stats()["in_use"] == 40
+        adm.release(b)
+        assert adm.idle
+        assert adm.admitted_total == 2
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("priority, cost", [("interactive", 101), ("batch", 51)])
+def test_request_over_the_class_budget_is_rejected(priority, cost):
+    async def run():
+        adm = _controller()
+        with pytest.raises(HTTPException) as exc:
+            await adm.acquire(priority, cost)
+        assert exc.value.status_code == 413
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_interactive_requests_are_admitted_before_batch():
+    async def run():
+        adm = _controller()
+        running = await adm.acquire("interactive", 100)
+        order = []
+
+        async def waiter(name: str, priority: str, cost: int):
+            ticket = await adm.acquire(priority, cost)
+            order.append(name)
+            return ticket
+
+        # A batch kérések előbb érkeznek, mégis az interaktív jut be elsőként
+        tasks = [asyncio.create_task(waiter("batch-1", "batch", 30))]
+        await _settle()
+        tasks.append(asyncio.create_task(waiter("batch-2", "batch", 30)))
+        await _settle()
+        tasks.append(asyncio.create_task(waiter("interactive", "interactive", 60)))
+        await _settle()
+        assert order == []
+
+        adm.release(running)
+        await _settle()
+        # 60 interaktív + 30 batch fér be; a második batch a batch keretbe (50) nem
+        assert order == ["interactive", "batch-1"]
+
+        adm.release(tasks[0].result())
+        await _settle()
+        assert order == ["interactive", "batch-1", "batch-2"]
+        for task in tasks[1:]:
+            adm.release(await task)
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_queued_interactive_request_holds_back_batch():
+    async def run():
+        adm = _controller()
+        running = await adm.acquire("interactive", 80)
+        queued = asyncio.create_task(adm.acquire("interactive", 30))
+        await _settle()
+
+        # 10 token még szabad, de a sorban álló interaktív kérés elsőbbséget élvez
+        late = asyncio.create_task(adm.acquire("batch", 10))
+        await _settle()
+        assert not late.done()
+
+        adm.release(running)
+        await _settle()
+        adm.release(await queued)
+        adm.release(await late)
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_returns_429_with_retry_after():
+    async def run():
+        adm = _controller(queue_timeout=0.05)
+        running = await adm.acquire("interactive", 100)
+        with pytest.raises(HTTPException) as exc:
+            await adm.acquire("interactive", 10)
+        assert exc.value.status_code == 429
+        # Áteresztési előzmény nélkül a becslés a várakozási idő (legalább 1 mp)
+        assert exc.value.headers["Retry-After"] == "1"
+        assert adm.rejected_total == 1
+
+        adm.release(running)
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_full_queue_returns_429():
+    async def run():
+        adm = _controller(max_queue=1)
+        running = await adm.acquire("interactive", 100)
+        queued = asyncio.create_task(adm.acquire("interactive", 10))
+        await _settle()
+        with pytest.raises(HTTPException) as exc:
+            await adm.acquire("interactive", 10)
+        assert exc.value.status_code == 429
+        assert int(exc.value.headers["Retry-After"]) >= 1
+
+        adm.release(running)
+        adm.release(await queued)
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_retry_after_follows_recent_throughput():
+    async def run():
+        adm = _controller()
+        # 60 mp alatt 600 token engedődött el: 10 token/s
+        for _ in range(6):
+            adm.release(await adm.acquire("interactive", 100))
+        running = await adm.acquire("interactive", 100)
+        # 100 foglalt + 50 kért - 100 keret = 50 token lemaradás → 5 mp
+        assert adm.retry_after(50) == 5
+        adm.release(running)
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_no_reservation():
+    async def run():
+        adm = _controller()
+        running = await adm.acquire("interactive", 100)
+        waiter = asyncio.create_task(adm.acquire("interactive", 50))
+        await _settle()
+        assert adm.stats()["queued"] == 50
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert adm.stats()["queued"] == 0
+
+        adm.release(running)
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_waiter_cancelled_as_it_is_admitted_leaks_nothing():
+    async def run():
+        adm = _controller()
+        running = await adm.acquire("interactive", 100)
+        waiter = asyncio.create_task(adm.acquire("interactive", 50))
+        await _settle()
+
+        # A beengedés és a megszakítás ugyanabban a körben történik: vagy a
+        # hívó kapja meg a foglalást, vagy az acquire maga engedi el
+        adm.release(running)
+        waiter.cancel()
+        [result] = await asyncio.gather(waiter, return_exceptions=True)
+        if isinstance(result, ms.AdmissionTicket):
+            adm.release(result)
+        else:
+            assert isinstance(result, asyncio.CancelledError)
+        assert adm.admitted_total == 2
+        assert adm.idle
+
+    asyncio.run(run())
+
+
+def test_stream_rejected_by_the_kv_pool_releases_its_ticket(monkeypatch, target, tokenizer):
+    scheduler = ms.GenerationScheduler(target, tokenizer, max_batch_size=1)
+    scheduler.kv_pool = ms.KVBlockPool(num_blocks=1, block_size=16, bytes_per_token=8)
+    adm = _controller()
+    monkeypatch.setattr(ms, "_dispatcher", ms.ReplicaDispatcher([scheduler]))
+    monkeypatch.setattr(ms, "_admission", adm)
+    req = ms.GenerateRequest(prompt="teszt", max_new_tokens=24, stream=True)
+
+    async def run():
+        ticket = await adm.acquire(req.priority, 30)
+        with pytest.raises(HTTPException) as exc:
+            await ms._stream_response(req, ticket=ticket, prompt_ids=[5, 17, 9, 33, 41, 8])
+        assert exc.value.status_code == 413
+        assert adm.idle
+
+    scheduler.start()
+    try:
+        asyncio.run(run())
+    finally:
+        scheduler.stop()
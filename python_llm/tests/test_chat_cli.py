@@ -0,0 +1,75 @@
+"""
+chat_cli: a websockets csak kapcsolódáskor, a rich csak a kirajzoló
+(interaktív) úton töltődik be – a --help és a batch mód nélküle fut.
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("websockets")
+from websockets.asyncio.server import serve  # noqa: E402
+
+CLI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A futás után a betöltött modulok kerülnek a kimenet utolsó sorába
+RUNNER = """
+import asyncio, json, sys
+import chat_cli
+args = chat_cli.parse_args(sys.argv[1:])
+code = asyncio.run(chat_cli.run_batch(args)) if args.batch else 0
+print(json.dumps({"code": code, "rich": "rich" in sys.modules,
+                  "websockets": "websockets" in sys.modules}))
+"""
+
+
+def test_help_loads_neither_dependency():
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "chat_cli.py", "--help"],
+        cwd=CLI_DIR, capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0
+    imported = {line.rsplit("|", 1)[-1].strip() for line in proc.stderr.splitlines()}
+    assert not imported & {"rich", "websockets"}
+
+
+async def _fake_gateway(connection):
+    """A Rust gateway /ws/chat protokolljának annyi része, amennyi a batch módhoz kell."""
+    await connection.send(json.dumps({"type": "connected", "session_id": "s1", "resume_token": "t1"}))
+    async for raw in connection:
+        msg = json.loads(raw)
+        await connection.send(json.dumps({
+            "type": "reply", "id": msg.get("id"), "data": msg["message"].upper(),
+            "tokens_generated": 1, "finish_reason": "stop",
+        }))
+
+
+def _health(connection, request):
+    if request.path == "/health":
+        return connection.respond(200, "ok\n")
+    return None
+
+
+def test_batch_mode_runs_without_rich():
+    async def run():
+        async with serve(_fake_gateway, "127.0.0.1", 0, process_request=_health) as server:
+            port = server.sockets[0].getsockname()[1]
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", RUNNER, "--batch", "-", "--connections", "2",
+                cwd=CLI_DIR, env={**os.environ, "CLAWDBOT_WS_URL": f"ws://127.0.0.1:{port}/ws/chat"},
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            out, err = await asyncio.wait_for(proc.communicate(b"szia\nhello\nharmadik\n"), 60)
+            return out.decode(), err.decode()
+
+    out, err = asyncio.run(run())
+    *results, summary = out.splitlines()
+    summary = json.loads(summary)
+    assert summary == {"code": 0, "rich": False, "websockets": True}, err
+    replies = {r["id"]: r["reply"] for r in map(json.loads, results)}
+    assert replies == {1: "SZIA", 2: "HELLO", 3: "HARMADIK"}
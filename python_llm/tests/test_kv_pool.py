@@ -0,0 +1,125 @@
+"""
+KV blokk-pool: a szekvencia a prefill előtt a teljes hosszára foglal, és
+minden befejezési úton (rendes vég, megszakítás, határidő, hiba) visszaadja
+a blokkjait; ami nem fér be, vár, ami üres poolba sem férne, 413-at kap.
+"""
+
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from conftest import ms
+
+PROMPT = [5, 17, 9, 33, 41, 8]
+
+
+def _seq(max_new_tokens: int = 24, prompt_ids=PROMPT, **kwargs) -> ms._Sequence:
+    req = ms.GenerateRequest(prompt="teszt", max_new_tokens=max_new_tokens, temperature=0.0, stop=[])
+    return ms._Sequence(req, prompt_ids=prompt_ids, **kwargs)
+
+
+def test_reserve_release_round_trip():
+    pool = ms.KVBlockPool(num_blocks=4, block_size=16, bytes_per_token=8)
+    first, second, third = _seq(), _seq(), _seq()
+
+    # 6 + 24 token = 2 blokk szekvenciánként
+    assert pool.reserve(first) and pool.reserve(second)
+    assert pool.used == 4 and pool.free == 0
+    assert not pool.reserve(third)
+    assert not pool.reserve(third)
+    assert third.kv_deferred and pool.deferred_total == 1
+
+    pool.release(first)
+    pool.release(first)
+    assert pool.used == 2 and first.kv_blocks == 0
+    assert pool.reserve(third)
+    pool.release(second)
+    pool.release(third)
+    assert pool.used == 0 and pool.peak_used == 4
+
+
+def test_request_larger_than_the_pool_is_rejected():
+    pool = ms.KVBlockPool(num_blocks=4, block_size=16, bytes_per_token=8)
+    pool.check(64)
+    with pytest.raises(HTTPException) as exc:
+        pool.check(65)
+    assert exc.value.status_code == 413
+    assert pool.rejected_total == 1
+
+
+def test_kv_pool_tokens(monkeypatch, target):
+    per_token = ms._kv_bytes_per_token(target)
+    monkeypatch.setattr(ms, "KV_POOL_MB", 1)
+    assert ms._kv_pool_tokens(target) == 1024 ** 2 // per_token
+
+    # GPU nélkül MAX_BATCH_SIZE teljes kontextus
+    monkeypatch.setattr(ms, "KV_POOL_MB", 0)
+    monkeypatch.setattr(ms, "MAX_BATCH_SIZE", 3)
+    assert ms._kv_pool_tokens(target) == 3 * target.config.max_position_embeddings
+
+
+@pytest.fixture
+def scheduler(target, tokenizer):
+    scheduler = ms.GenerationScheduler(target, tokenizer, max_batch_size=2)
+    # Két blokknyi szekvenciából egyszerre csak egy fér el
+    scheduler.kv_pool = ms.KVBlockPool(num_blocks=3, block_size=16, bytes_per_token=8)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def _run(scheduler, seqs: list) -> None:
+    done = threading.Semaphore(0)
+    # Egyszerre kerülnek a sorba: az ütemező egy lépésben látja mindet
+    with scheduler._cv:
+        for seq in seqs:
+            seq.on_finish = lambda _: done.release()
+            scheduler.submit(seq)
+    for _ in seqs:
+        assert done.acquire(timeout=30)
+
+
+def _after(n: int, action):
+    """on_token callback: az n-edik token után fut le."""
+
+    def on_token(seq, token_id):
+        if len(seq.output_ids) == n:
+            action(seq)
+
+    return on_token
+
+
+def _raise(seq):
+    raise RuntimeError("fogyasztói hiba")
+
+
+def test_blocks_are_returned_on_every_finish_path(scheduler):
+    seqs = {
+        "length": _seq(),
+        "cancelled": _seq(on_token=_after(2, lambda s: s.cancel())),
+        "timeout": _seq(on_token=_after(2, lambda s: setattr(s, "deadline", time.perf_counter()))),
+        "error": _seq(on_token=_after(2, _raise)),
+    }
+    _run(scheduler, list(seqs.values()))
+
+    assert {name: seq.finish_reason for name, seq in seqs.items()} == {
+        name: name for name in seqs
+    }
+    assert isinstance(seqs["error"].error, RuntimeError)
+    assert all(seq.kv_blocks == 0 for seq in seqs.values())
+    stats = scheduler.kv_pool.stats()
+    assert stats["used_blocks"] == 0
+    assert stats["peak_used_blocks"] == 2
+    # Mind a négy ugyanarra a két blokkra várt: a későbbiek egyszer-egyszer
+    assert stats["deferred_total"] == 3
+
+
+def test_oversized_request_fails_without_reserving(scheduler):
+    seq = _seq(max_new_tokens=60)
+    _run(scheduler, [seq])
+
+    assert seq.error.status_code == 413
+    assert seq.output_ids == []
+    assert scheduler.kv_pool.used == 0
@@ -0,0 +1,39 @@
+"""
+Darabolt prefill: a PREFILL_CHUNK_TOKENS csak az ütemezést változtatja
+meg, a kimenetet nem – mohó esetben a tokenek darabmérettől és prefix
+cache találattól függetlenül azonosak.
+"""
+
+import pytest
+
+from conftest import ms, run_scheduler
+
+# Több darabnyi prompt; a második az első 32 tokenjét (két teljes prefix
+# cache blokkot) osztja meg, így a prefillje a cache-elt past-ról folytatódik
+LONG = [(7 * i + 3) % 60 + 4 for i in range(40)]
+SHARED = LONG[:32] + [11, 23, 5, 42, 19, 8, 30]
+
+
+@pytest.fixture(scope="module")
+def reference(target, tokenizer):
+    """Darabolás és prefix cache nélküli kimenet promptonként."""
+    mp = pytest.MonkeyPatch()
+    mp.setattr(ms, "PREFILL_CHUNK_TOKENS", 0)
+    mp.setattr(ms, "PREFIX_CACHE_MB", 0)
+    try:
+        return [seq.output_ids for seq in run_scheduler(target, tokenizer, [LONG, SHARED])]
+    finally:
+        mp.undo()
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 0])
+def test_chunked_prefill_matches_unchunked(monkeypatch, target, tokenizer, reference, chunk):
+    monkeypatch.setattr(ms, "PREFILL_CHUNK_TOKENS", chunk)
+    stats = {}
+    first, second = run_scheduler(target, tokenizer, [LONG, SHARED], stats=stats)
+
+    # A második prompt a közös 32 tokent a prefix cache-ből kapja
+    assert stats["prefix_cache"]["hits"] == 1
+    assert stats["prefix_cache"]["reused_tokens"] == 32
+    assert first.output_ids == reference[0]
+    assert second.output_ids == reference[1]
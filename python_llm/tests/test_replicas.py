@@ -0,0 +1,31 @@
+"""
+Replikaszám: GPU-nként egy (vagy a kért szám), CPU-n mindig egy – a
+közös súlyokon futó szálak nem skálázódnak.
+"""
+
+import pytest
+
+from conftest import ms
+
+
+@pytest.fixture(autouse=True)
+def replica_info(monkeypatch):
+    info = {"requested": 1, "note": None}
+    monkeypatch.setattr(ms, "_replica_info", info)
+    return info
+
+
+@pytest.mark.parametrize("replicas, gpus, expected", [("auto", 3, 3), ("2", 1, 2), ("1", 2, 1)])
+def test_gpu_replica_count(monkeypatch, replica_info, replicas, gpus, expected):
+    monkeypatch.setattr(ms, "REPLICAS", replicas)
+    assert ms.resolve_replica_count({"device_count": gpus}) == expected
+    assert ms.build_replica_devices({"device_count": gpus}, expected)[-1] == f"cuda:{(expected - 1) % gpus}"
+    assert replica_info["note"] is None
+
+
+@pytest.mark.parametrize("gpus, quantization", [(0, "fp16"), (2, "int8_dynamic")])
+def test_cpu_runs_a_single_replica(monkeypatch, replica_info, gpus, quantization):
+    monkeypatch.setattr(ms, "REPLICAS", "4")
+    assert ms.resolve_replica_count({"device_count": gpus}, quantization) == 1
+    assert replica_info["requested"] == 4
+    assert "nem skálázódnak" in replica_info["note"]
@@ -0,0 +1,48 @@
+"""
+Spekulatív dekódolás: mohó mintavételezésnél a kimenetnek tokenre pontosan
+meg kell egyeznie a draft nélküli dekódoláséval, akár elfogadja a célmodell
+a javaslatokat, akár elveti őket (ilyenkor a cache-eket vissza kell vágni).
+
+Futtatás (a python_llm könyvtárból):
+    python -m pytest -q tests
+"""
+
+import copy
+
+import torch
+
+from conftest import run_scheduler
+
+PROMPT = [5, 17, 9, 33, 41, 8]
+
+
+def _perturbed(model, scale: float, seed: int = 1):
+    """A modell zajjal terhelt másolata: draftként részben egyező javaslatokat ad."""
+    torch.manual_seed(seed)
+    draft = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in draft.parameters():
+            param.add_(torch.randn_like(param) * scale)
+    return draft
+
+
+def test_greedy_speculative_matches_plain_decoding(target, tokenizer):
+    [plain] = run_scheduler(target, tokenizer, [PROMPT])
+    # Kissé eltérő draft: a lépések egy részében csak a javaslatok eleje
+    # fogadódik el, a cache-eket az elutasított tokenek előtt kell elvágni
+    [spec] = run_scheduler(target, tokenizer, [PROMPT], draft=_perturbed(target, scale=0.005))
+
+    assert plain.finish_reason == spec.finish_reason == "length"
+    assert 0 < spec.spec_accepted < spec.spec_proposed
+    assert spec.output_ids == plain.output_ids
+
+
+def test_all_drafts_accepted_keeps_caches_in_sync(target, tokenizer):
+    [plain] = run_scheduler(target, tokenizer, [PROMPT])
+    # A célmodell saját magának draftja: minden javaslat elfogadódik, így a
+    # lépésenként k+1 token és a draft cache k-1 hosszú visszavágása fut
+    [spec] = run_scheduler(target, tokenizer, [PROMPT], draft=target)
+
+    assert spec.spec_proposed > 0
+    assert spec.spec_accepted == spec.spec_proposed
+    assert spec.output_ids == plain.output_ids
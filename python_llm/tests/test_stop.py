@@ -0,0 +1,77 @@
+"""
+_StopChecker: stop szekvencia keresés tokenenként, a lehetséges stop
+elejének visszatartásával.
+"""
+
+from conftest import ms, run_scheduler
+
+
+class _PieceTokenizer:
+    """Minden token egy előre megadott szövegdarab; a dekódolás összefűzés."""
+
+    def __init__(self, pieces: list[str]):
+        self.pieces = pieces
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        return "".join(self.pieces[i] for i in ids)
+
+
+def _push_all(pieces: list[str], stops: list[str]) -> tuple[ms._StopChecker, list[str]]:
+    checker = ms._StopChecker(_PieceTokenizer(pieces), stops)
+    return checker, [checker.push(i) for i in range(len(pieces))]
+
+
+def test_stop_split_across_tokens():
+    checker, out = _push_all(["Hel", "lo ", "wo", "rld", "##", "EN", "D", "after"], ["##END"])
+
+    # A "##" és az "EN" egy lehetséges stop eleje: visszatartódik
+    assert out == ["Hel", "lo ", "wo", "rld", "", "", "", ""]
+    assert checker.matched == "##END"
+    assert checker.text == "Hello world"
+    assert checker.flush() == ""
+
+
+def test_partial_match_is_released_when_it_is_not_a_stop():
+    checker, out = _push_all(["a", "##", "EX", "b"], ["##END"])
+
+    assert out == ["a", "", "##EX", "b"]
+    assert checker.matched is None
+    assert checker.text == "a##EXb"
+
+
+def test_held_back_tail_is_flushed_at_the_end():
+    checker, out = _push_all(["a", "##E"], ["##END"])
+
+    assert out == ["a", ""]
+    assert checker.flush() == "##E"
+    assert checker.text == "a##E"
+    assert checker.matched is None
+
+
+def test_earliest_stop_wins():
+    # Mindkét stop ugyanabban a darabban jelenik meg; a korábbi pozíció nyer,
+    # a stops listabeli sorrendjétől függetlenül
+    checker, out = _push_all(["Hello world", "!"], ["world", "lo w"])
+
+    assert out == ["Hel", ""]
+    assert checker.matched == "lo w"
+    assert checker.text == "Hel"
+
+
+def test_stop_sequence_and_finish_reason_are_reported(target, tokenizer):
+    [plain] = run_scheduler(target, tokenizer, [[5, 17, 9, 33, 41, 8]], max_new_tokens=12)
+    words = tokenizer.decode(plain.output_ids).split(" ")
+    # A stop a 4. token közepén kezdődik és az 5. közepén ér véget
+    stop = f"{words[3][1:]} {words[4][:2]}"
+    expected = " ".join(words[:3]) + " " + words[3][:1]
+    assert expected.find(stop) == -1
+
+    [seq] = run_scheduler(
+        target, tokenizer, [[5, 17, 9, 33, 41, 8]], max_new_tokens=12, stop=[stop, "never"]
+    )
+    result = ms._build_response(seq)
+
+    assert result.finish_reason == "stop"
+    assert result.stop_sequence == stop
+    assert result.text == expected
+    assert result.tokens_generated == 5
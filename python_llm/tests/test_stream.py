@@ -0,0 +1,88 @@
+"""
+Streaming szöveg: a tokenenkénti detokenizálás sosem ad ki félkész UTF-8
+karaktert, és az NDJSON keretek szövege összefűzve a nem-streaming
+válasszal azonos.
+"""
+
+import asyncio
+import json
+
+import pytest
+from tokenizers import Tokenizer, decoders, models
+from transformers import PreTrainedTokenizerFast
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from conftest import VOCAB_SIZE, ms, tiny_llama
+
+# Tokenenként egy bájt: ASCII betűk és többbájtos karakterek darabjai
+# (é, ő: 2 bájt, €: 3 bájt, 😀: 4 bájt)
+MULTIBYTE = "éő€😀".encode("utf-8")
+BYTES = list(dict.fromkeys(MULTIBYTE + b"abcdefghijklmnopqrstuvwxyz .,!?ABCDEFGHIJKLMNOPQRSTUVW"))[:VOCAB_SIZE]
+
+
+def _token_ids(data: bytes) -> list[int]:
+    return [BYTES.index(b) for b in data]
+
+
+@pytest.fixture(scope="module")
+def byte_tokenizer():
+    """Byte-level (GPT-2 stílusú) dekóder bájtonkénti szókinccsel."""
+    to_unicode = bytes_to_unicode()
+    vocab = {to_unicode[b]: i for i, b in enumerate(BYTES)}
+    tok = Tokenizer(models.WordLevel(vocab, unk_token=to_unicode[BYTES[-1]]))
+    tok.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=tok)
+
+
+def test_split_multibyte_char_is_never_emitted_half_finished(byte_tokenizer):
+    text = "aé b€c😀ő!"
+    decoder = ms._IncrementalDecoder(byte_tokenizer)
+    pieces = [decoder.push(i) for i in _token_ids(text.encode("utf-8"))]
+    pieces.append(decoder.flush())
+
+    assert all("�" not in p for p in pieces)
+    assert "".join(pieces) == text
+    # A 4 bájtos karakter az utolsó bájtjával együtt, egyben jelenik meg
+    assert "😀" in pieces
+
+
+def test_truncated_multibyte_char_is_flushed_at_the_end(byte_tokenizer):
+    decoder = ms._IncrementalDecoder(byte_tokenizer)
+    pieces = [decoder.push(i) for i in _token_ids("a€".encode("utf-8")[:-1])]
+
+    assert pieces == ["a", "", ""]
+    assert decoder.flush() == "�"
+
+
+def test_ndjson_frames_join_to_the_non_stream_reply(monkeypatch, byte_tokenizer):
+    scheduler = ms.GenerationScheduler(tiny_llama(seed=3), byte_tokenizer, max_batch_size=1)
+    monkeypatch.setattr(ms, "_tokenizer", byte_tokenizer)
+    monkeypatch.setattr(ms, "_dispatcher", ms.ReplicaDispatcher([scheduler]))
+    monkeypatch.setattr(ms, "_admission", ms.AdmissionController(4096, 0.5, 4, 1.0))
+    prompt_ids = _token_ids("Szia é€ ".encode("utf-8"))
+
+    def request(stream: bool) -> ms.GenerateRequest:
+        return ms.GenerateRequest(
+            prompt="teszt", max_new_tokens=48, temperature=0.0, stop=[],
+            stream=stream, stream_format="ndjson",
+        )
+
+    async def run() -> tuple[ms._Sequence, list[dict]]:
+        plain = await scheduler.generate(request(False), prompt_ids=prompt_ids)
+        response = await ms._stream_response(request(True), prompt_ids=prompt_ids)
+        frames = [json.loads(line) async for line in response.body_iterator]
+        return plain, frames
+
+    scheduler.start()
+    try:
+        plain, frames = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    expected = ms._build_response(plain).text
+    *chunks, done = frames
+    streamed_ids = [i for frame in chunks for i in frame["ids"]]
+    assert streamed_ids == plain.output_ids
+    assert "".join(frame["text"] for frame in chunks) == expected
+    assert done["done"] is True
+    assert done["text"] == expected
@@ -0,0 +1,99 @@
+"""
+PromptEncoder: a szegmensenként kódolt és cache-elt prompt id-k a teljes
+prompt kódolásával azonosak – ahol a tokenizer a szegmenshatárokon összevon
+(byte-level BPE), ott a prompt egyben kódolódik.
+"""
+
+import asyncio
+
+import pytest
+from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from conftest import ms
+
+CORPUS = [
+    "### Instruction: Write a python function",
+    "### Response: def foo(x): return x + 1",
+    "### System: Be brief.",
+    "User: hello ClawDBot: hi there",
+] * 50
+
+PROMPTS = [
+    ("Write a python function", None),
+    ("hello  ", "Be brief."),
+    ("x\n", None),
+    ("def foo(x):\n    return x + 1\n\n", "Légy tömör.\n"),
+    ("árvíztűrő tükörfúrógép ő\n\n\n", None),
+    ("", None),
+]
+
+
+def _gpt2_style() -> PreTrainedTokenizerFast:
+    """Byte-level BPE ("\\n\\n" saját tokennel), mint a GPT-2 / StarCoder."""
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400, special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator([c.replace(": ", ":\n") + "\n\n" for c in CORPUS], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tok, bos_token="<s>", eos_token="</s>")
+
+
+def _llama_style() -> PreTrainedTokenizerFast:
+    """SentencePiece jellegű BPE: "▁" szóközök, bájt-tartalék a sortörésre, BOS."""
+    tok = Tokenizer(models.BPE(unk_token="<unk>", byte_fallback=True))
+    tok.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    tok.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0),
+    ])
+    trainer = trainers.BpeTrainer(
+        vocab_size=600,
+        special_tokens=["<unk>", "<s>", "</s>"] + [f"<0x{i:02X}>" for i in range(256)],
+    )
+    tok.train_from_iterator(CORPUS, trainer)
+    tok.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", tok.token_to_id("<s>"))]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+
+
+# A byte-level BPE a szegmens végi "\n\n"-t egy tokenné vonja, a "\n\n###"
+# elejét nem: ott csak az egyben kódolás helyes
+@pytest.fixture(scope="module", params=[("gpt2", False), ("llama", True)], ids=["gpt2", "llama"])
+def encoder(request):
+    name, segmented = request.param
+    encoder = ms.PromptEncoder(_gpt2_style() if name == "gpt2" else _llama_style())
+    assert encoder.segmented is segmented
+    return encoder
+
+
+@pytest.mark.parametrize("prompt, system_prompt", PROMPTS)
+def test_prompt_ids_match_full_encoding(encoder, prompt, system_prompt):
+    req = ms.GenerateRequest(prompt=prompt, system_prompt=system_prompt)
+    expected = encoder.tokenizer(ms._build_full_prompt(req))["input_ids"]
+
+    assert encoder.encode_prompt_sync(req) == expected
+    # Másodszor a cache-ből, az aszinkron (kötegelt) úton
+    assert asyncio.run(encoder.encode_prompt(req)) == expected
+
+
+def test_chat_prompt_matches_full_encoding(monkeypatch, encoder):
+    monkeypatch.setattr(ms, "_prompt_encoder", encoder)
+    monkeypatch.setattr(ms, "CHAT_CONTEXT_TOKENS", 4096)
+    system = ms._ChatTurn("system", "Be brief.")
+    turns = [
+        ms._ChatTurn("user", "hello  "),
+        ms._ChatTurn("assistant", "hi there\n"),
+        ms._ChatTurn("user", "Write a python function"),
+    ]
+
+    ids, truncated = ms._build_chat_prompt(system, turns, max_new_tokens=16)
+
+    text = "".join(t.text for t in [system] + turns) + ms.GENERATION_PROMPT
+    assert truncated == 0
+    assert ids == encoder.tokenizer(text)["input_ids"]
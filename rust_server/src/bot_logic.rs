@@ -126,6 +126,7 @@ impl BotLogic {
             top_k: 50,
             repetition_penalty: 1.1,
             stream: false,
+            stream_format: None,
         }
     }
 
@@ -157,25 +158,48 @@ impl BotLogic {
             .join("\n")
     }
 
+    /// A válasz elejéről levágandó prefixek (pl. ha a bot saját nevével kezd)
+    fn reply_prefixes(&self) -> [String; 3] {
+        [
+            format!("{}:", self.bot_name),
+            "Assistant:".to_string(),
+            "### Response:".to_string(),
+        ]
+    }
+
     /// Tisztítja az LLM nyers kimenetét (felesleges prefixek eltávolítása stb.)
     pub fn postprocess_response(&self, raw: &str) -> String {
         let raw = raw.trim();
 
-        // Eltávolítjuk ha a bot saját nevével kezdi a választ
-        let prefixes = [
-            &format!("{}:", self.bot_name),
-            "Assistant:",
-            "### Response:",
-        ];
-
-        for prefix in &prefixes {
-            if let Some(stripped) = raw.strip_prefix(prefix) {
+        for prefix in &self.reply_prefixes() {
+            if let Some(stripped) = raw.strip_prefix(prefix.as_str()) {
                 return stripped.trim().to_string();
             }
         }
 
         raw.to_string()
     }
+
+    /// Streaming: a válasz eddigi elejéből ugyanúgy vágja le a prefixet, mint
+    /// a postprocess_response. None, amíg ez nem dönthető el (a szöveg még
+    /// egy prefix eleje lehet, vagy a prefix után csak szóköz jött).
+    pub fn strip_stream_prefix(&self, head: &str) -> Option<String> {
+        let head = head.trim_start();
+        for prefix in &self.reply_prefixes() {
+            if let Some(rest) = head.strip_prefix(prefix.as_str()) {
+                let rest = rest.trim_start();
+                return if rest.is_empty() {
+                    None
+                } else {
+                    Some(rest.to_string())
+                };
+            }
+            if prefix.starts_with(head) {
+                return None;
+            }
+        }
+        Some(head.to_string())
+    }
 }
 
 // ---------------------------------------------------------------------------
@@ -1,5 +1,5 @@
 /// HTTP kliens a Python LLM szerver felé.
-/// Támogatja a normál és a streaming (SSE) módot.
+/// Támogatja a normál és a streaming (NDJSON keretes) módot.
 
 use reqwest::Client;
 use serde::{Deserialize, Serialize};
@@ -8,6 +8,10 @@ use tracing::{debug, warn};
 
 use crate::error::AppError;
 
+/// Kérésenkénti időkorlát; a Python szerver X-Request-Timeout fejlécként
+/// kapja meg, így a generálás nem fut tovább, miután itt feladtuk.
+const LLM_TIMEOUT_SECS: u64 = 300;
+
 // ---------------------------------------------------------------------------
 // Request / Response struktúrák (tükrözik a Python API-t)
 // ---------------------------------------------------------------------------
@@ -21,6 +25,9 @@ pub struct LlmRequest {
     pub top_k: u32,
     pub repetition_penalty: f32,
     pub stream: bool,
+    /// Streaming formátum ("sse" vagy "ndjson"); None = szerver alapértelmezés
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub stream_format: Option<String>,
     #[serde(skip_serializing_if = "Option::is_none")]
     pub system_prompt: Option<String>,
 }
@@ -35,6 +42,7 @@ impl Default for LlmRequest {
             top_k: 50,
             repetition_penalty: 1.1,
             stream: false,
+            stream_format: None,
             system_prompt: None,
         }
     }
@@ -48,6 +56,54 @@ pub struct LlmResponse {
     pub model: String,
 }
 
+/// Egy NDJSON streaming keret. A köztes keretek token id-kat és
+/// szövegdeltát visznek, a záró keret ("done": true) a statisztikát.
+#[derive(Debug, Deserialize)]
+pub struct StreamFrame {
+    #[serde(default)]
+    pub ids: Vec<u32>,
+    #[serde(default)]
+    pub text: String,
+    #[serde(default)]
+    pub done: bool,
+    #[serde(default)]
+    pub error: Option<String>,
+    #[serde(default)]
+    pub tokens_generated: Option<u32>,
+    #[serde(default)]
+    pub finish_reason: Option<String>,
+}
+
+/// NDJSON keretek bontása tetszőleges chunk-határok mentén.
+#[derive(Default)]
+struct FrameReader {
+    /// Bájtpuffer: a részleges sorok (és UTF-8 szekvenciák) a következő
+    /// chunk-ig itt maradnak; a feldolgozott rész chunk-onként egyszer törlődik
+    buffer: Vec<u8>,
+}
+
+impl FrameReader {
+    /// A chunk-kal teljessé vált keretek, érkezési sorrendben.
+    fn push(&mut self, chunk: &[u8]) -> Result<Vec<StreamFrame>, AppError> {
+        self.buffer.extend_from_slice(chunk);
+
+        let mut frames = Vec::new();
+        let mut start = 0;
+        while let Some(pos) = self.buffer[start..].iter().position(|&b| b == b'\n') {
+            let line = &self.buffer[start..start + pos];
+            start += pos + 1;
+            if line.iter().all(u8::is_ascii_whitespace) {
+                continue;
+            }
+            let frame = serde_json::from_slice(line)
+                .map_err(|e| AppError::LlmGeneration(format!("Hibás stream keret: {e}")))?;
+            frames.push(frame);
+        }
+        self.buffer.drain(..start);
+        Ok(frames)
+    }
+}
+
 #[derive(Debug, Deserialize)]
 pub struct HealthResponse {
     pub status: String,
@@ -68,7 +124,7 @@ pub struct LlmClient {
 impl LlmClient {
     pub fn new(base_url: &str) -> Self {
         let client = Client::builder()
-            .timeout(Duration::from_secs(300)) // LLM generálás lassú lehet
+            .timeout(Duration::from_secs(LLM_TIMEOUT_SECS)) // LLM generálás lassú lehet
             .connect_timeout(Duration::from_secs(10))
             .build()
             .expect("Reqwest kliens létrehozása sikertelen");
@@ -87,6 +143,7 @@ impl LlmClient {
         let response = self
             .client
             .post(&url)
+            .header("X-Request-Timeout", LLM_TIMEOUT_SECS.to_string())
             .json(&req)
             .send()
             .await
@@ -116,29 +173,39 @@ impl LlmClient {
         Ok(llm_resp)
     }
 
-    /// Streaming generálás – tokenenként hívja a callback-et.
+    /// Streaming generálás – szövegdeltánként hívja a callback-et.
+    /// NDJSON kereteket kér: a szöveg JSON-ben utazik, így a sortörések
+    /// sem vesznek el, és terhelés alatt egy keret több tokent is hozhat.
+    /// Visszatérés: a záró keret (tokenszám, befejezés oka).
     pub async fn generate_streaming<F>(
         &self,
         req: LlmRequest,
         mut on_token: F,
-    ) -> Result<(), AppError>
+    ) -> Result<StreamFrame, AppError>
     where
         F: FnMut(String) + Send,
     {
         let mut stream_req = req;
         stream_req.stream = true;
+        stream_req.stream_format = Some("ndjson".to_string());
 
         let url = format!("{}/generate", self.base_url);
 
         let response = self
             .client
             .post(&url)
+            .header("X-Request-Timeout", LLM_TIMEOUT_SECS.to_string())
             .json(&stream_req)
             .send()
             .await
             .map_err(|e| AppError::LlmUnavailable(e.to_string()))?;
 
-        // SSE parsing – minden sor "data: <token>" formátumú
+        if !response.status().is_success() {
+            let status = response.status();
+            let body = response.text().await.unwrap_or_default();
+            return Err(AppError::LlmGeneration(format!("HTTP {status}: {body}")));
+        }
+
         use reqwest::header::CONTENT_TYPE;
         let ct = response
             .headers()
@@ -146,35 +213,39 @@ impl LlmClient {
             .and_then(|v| v.to_str().ok())
             .unwrap_or("");
 
-        if !ct.contains("text/event-stream") {
+        if !ct.contains("application/x-ndjson") {
             return Err(AppError::LlmGeneration(
-                "A szerver nem adott SSE választ.".to_string(),
+                "A szerver nem adott NDJSON streaming választ.".to_string(),
             ));
         }
 
         let mut stream = response.bytes_stream();
         use futures_util::StreamExt;
-        let mut buffer = String::new();
+        let mut reader = FrameReader::default();
 
         while let Some(chunk) = stream.next().await {
             let chunk = chunk.map_err(|e| AppError::LlmGeneration(e.to_string()))?;
-            buffer.push_str(&String::from_utf8_lossy(&chunk));
-
-            // Soronként feldolgozás
-            while let Some(pos) = buffer.find('\n') {
-                let line = buffer[..pos].trim().to_string();
-                buffer = buffer[pos + 1..].to_string();
-
-                if let Some(data) = line.strip_prefix("data: ") {
-                    if data == "[DONE]" {
-                        return Ok(());
+            for frame in reader.push(&chunk)? {
+                if !frame.text.is_empty() {
+                    on_token(frame.text);
+                }
+                if frame.done {
+                    if let Some(err) = frame.error {
+                        return Err(AppError::LlmGeneration(err));
                     }
-                    on_token(data.to_string());
+                    debug!(
+                        "LLM stream vége: {} token, ok: {}",
+                        frame.tokens_generated.unwrap_or(0),
+                        frame.finish_reason.as_deref().unwrap_or("?")
+                    );
+                    return Ok(frame);
                 }
             }
         }
 
-        Ok(())
+        Err(AppError::LlmGeneration(
+            "A stream a záró keret előtt megszakadt.".to_string(),
+        ))
     }
 
     /// Python LLM szerver egészségügyi ellenőrzése.
@@ -193,3 +264,75 @@ impl LlmClient {
             .map_err(|e| AppError::LlmGeneration(e.to_string()))
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const STREAM: &str = concat!(
+        "{\"ids\":[1],\"text\":\"Szia\",\"t_ms\":[1.5]}\n",
+        "\n",
+        "{\"ids\":[2,3],\"text\":\" világ\\n€\",\"t_ms\":[2.0,2.1]}\n",
+        "{\"done\":true,\"text\":\"Szia világ\\n€\",\"tokens_generated\":3,\"finish_reason\":\"length\"}\n",
+    );
+
+    fn read_all(chunks: &[&[u8]]) -> Vec<StreamFrame> {
+        let mut reader = FrameReader::default();
+        chunks
+            .iter()
+            .flat_map(|chunk| reader.push(chunk).expect("érvényes keretek"))
+            .collect()
+    }
+
+    #[test]
+    fn frames_survive_every_chunk_boundary() {
+        let bytes = STREAM.as_bytes();
+        let whole = read_all(&[bytes]);
+        assert_eq!(whole.len(), 3);
+        assert_eq!(whole[1].ids, vec![2, 3]);
+        assert_eq!(whole[1].text, " világ\n€");
+        assert!(whole[2].done);
+        assert_eq!(whole[2].tokens_generated, Some(3));
+
+        // Minden vágási pont, a többbájtos karakterek belseje is
+        for cut in 1..bytes.len() {
+            let frames = read_all(&[&bytes[..cut], &bytes[cut..]]);
+            let texts: Vec<&str> = frames.iter().map(|f| f.text.as_str()).collect();
+            assert_eq!(
+                texts,
+                ["Szia", " világ\n€", "Szia világ\n€"],
+                "vágás: {cut}"
+            );
+        }
+
+        // Bájtonkénti érkezés
+        let single: Vec<&[u8]> = bytes.chunks(1).collect();
+        assert_eq!(read_all(&single).len(), 3);
+    }
+
+    #[test]
+    fn partial_line_waits_for_the_newline() {
+        let mut reader = FrameReader::default();
+        assert!(reader
+            .push(b"{\"ids\":[7],\"text\":\"a\"}")
+            .unwrap()
+            .is_empty());
+        let frames = reader.push(b"\n{\"done\":true").unwrap();
+        assert_eq!(frames.len(), 1);
+        assert_eq!(frames[0].text, "a");
+        assert_eq!(reader.buffer, b"{\"done\":true");
+    }
+
+    #[test]
+    fn error_frame_and_malformed_line() {
+        let frames =
+            read_all(&[b"{\"done\":true,\"error\":\"OOM\",\"finish_reason\":\"error\"}\n"]);
+        assert_eq!(frames[0].error.as_deref(), Some("OOM"));
+
+        let mut reader = FrameReader::default();
+        assert!(matches!(
+            reader.push(b"data: {}\n"),
+            Err(AppError::LlmGeneration(msg)) if msg.starts_with("Hibás stream keret")
+        ));
+    }
+}
@@ -2,11 +2,13 @@
 
 use std::collections::HashMap;
 use std::sync::Arc;
-use tokio::sync::RwLock;
+use std::time::Duration;
+use serde::Deserialize;
+use tokio::sync::{mpsc, RwLock};
 use uuid::Uuid;
 
 use axum::{
-    extract::{State, WebSocketUpgrade},
+    extract::{Query, State, WebSocketUpgrade},
     extract::ws::{Message as WsMessage, WebSocket},
     http::StatusCode,
     response::{IntoResponse, Response},
@@ -23,6 +25,10 @@ use crate::error::AppError;
 use crate::llm_client::LlmClient;
 use crate::middleware::{cors_layer, timeout_layer, trace_layer};
 
+/// Bontott WebSocket session ennyi ideig folytatható
+/// (?session_id=...&resume_token=...), utána törlődik.
+const WS_RESUME_GRACE_SECS: u64 = 300;
+
 // ---------------------------------------------------------------------------
 // App State
 // ---------------------------------------------------------------------------
@@ -34,6 +40,17 @@ pub struct AppState {
     pub bot: Arc<BotLogic>,
     /// In-memory session store (produkciós verzióban Redis)
     pub sessions: Arc<RwLock<HashMap<Uuid, ChatSession>>>,
+    /// Session → az azt legutóbb birtokló WebSocket kapcsolat
+    pub ws_owners: Arc<RwLock<HashMap<Uuid, WsOwner>>>,
+}
+
+/// Egy WebSocket session birtokosa. A session csak a birtokos kapott
+/// resume_token-jével folytatható, és csak a kapcsolata bontása után.
+#[derive(Debug, Clone, Copy)]
+pub struct WsOwner {
+    pub conn_id: Uuid,
+    pub resume_token: Uuid,
+    pub live: bool,
 }
 
 // ---------------------------------------------------------------------------
@@ -49,6 +66,7 @@ pub async fn build_router(cfg: Arc<AppConfig>) -> anyhow::Result<Router> {
         llm,
         bot,
         sessions: Arc::new(RwLock::new(HashMap::new())),
+        ws_owners: Arc::new(RwLock::new(HashMap::new())),
     };
 
     let app = Router::new()
@@ -180,29 +198,107 @@ async fn handle_chat(
 // Handler: GET /ws/chat – WebSocket upgrade
 // ---------------------------------------------------------------------------
 
+#[derive(Debug, Deserialize)]
+struct WsParams {
+    /// Korábbi session folytatása újrakapcsolódáskor
+    session_id: Option<Uuid>,
+    /// A session előző kapcsolatának "connected" üzenetében kapott token
+    resume_token: Option<Uuid>,
+}
+
 async fn handle_ws_upgrade(
     State(state): State<AppState>,
+    Query(params): Query<WsParams>,
     ws: WebSocketUpgrade,
 ) -> Response {
-    ws.on_upgrade(move |socket| handle_ws(socket, state))
+    ws.on_upgrade(move |socket| handle_ws(socket, state, params))
+}
+
+/// Session hozzárendelése egy új kapcsolathoz. Ismert session_id és a
+/// birtokos tokenje esetén a korábbi kontextus folytatódik, különben
+/// (pl. szerver újraindítás után) új session indul. Élő kapcsolathoz
+/// tartozó session nem vehető át.
+/// Visszaad: (session, folytatás-e, előzmény hossza, elutasítás oka).
+fn claim_session(
+    owners: &mut HashMap<Uuid, WsOwner>,
+    sessions: &mut HashMap<Uuid, ChatSession>,
+    params: &WsParams,
+    owner: WsOwner,
+) -> (Uuid, bool, usize, Option<&'static str>) {
+    let mut rejected = None;
+    let mut resume = None;
+    if let Some(id) = params.session_id {
+        match owners.get(&id) {
+            Some(current)
+                if params.resume_token == Some(current.resume_token)
+                    && sessions.contains_key(&id) =>
+            {
+                if current.live {
+                    rejected = Some("active");
+                } else {
+                    resume = Some(id);
+                }
+            }
+            _ => rejected = Some("unknown"),
+        }
+    }
+    let (session_id, resumed, history) = match resume {
+        Some(id) => (id, true, sessions[&id].messages.len()),
+        None => {
+            let session = ChatSession::new(10);
+            let id = session.id;
+            sessions.insert(id, session);
+            (id, false, 0)
+        }
+    };
+    owners.insert(session_id, owner);
+    (session_id, resumed, history, rejected)
 }
 
-async fn handle_ws(socket: WebSocket, state: AppState) {
+/// Bontáskor a session (a tokennel) folytathatóvá válik – ha még ez a
+/// kapcsolat birtokolja.
+fn release_session(owners: &mut HashMap<Uuid, WsOwner>, session_id: Uuid, conn_id: Uuid) {
+    if let Some(owner) = owners.get_mut(&session_id) {
+        if owner.conn_id == conn_id {
+            owner.live = false;
+        }
+    }
+}
+
+async fn handle_ws(socket: WebSocket, state: AppState, params: WsParams) {
     let (mut sender, mut receiver) = socket.split();
-    let session_id = Uuid::new_v4();
+    let conn_id = Uuid::new_v4();
+    // Minden kapcsolat új tokent kap: a régi a folytatással érvényét veszti
+    let resume_token = Uuid::new_v4();
 
-    {
+    let (session_id, resumed, history, rejected) = {
+        let mut owners = state.ws_owners.write().await;
         let mut sessions = state.sessions.write().await;
-        sessions.insert(session_id, ChatSession::new(10));
-    }
+        let owner = WsOwner {
+            conn_id,
+            resume_token,
+            live: true,
+        };
+        claim_session(&mut owners, &mut sessions, &params, owner)
+    };
 
-    info!("WebSocket kapcsolat: session={session_id}");
+    info!("WebSocket kapcsolat: session={session_id}, folytatás: {resumed}");
+    if let Some(reason) = rejected {
+        warn!(
+            "WebSocket folytatás elutasítva ({reason}): {:?}",
+            params.session_id
+        );
+    }
 
     // Üdvözlő üzenet
     let welcome = json!({
         "type": "connected",
         "session_id": session_id,
+        "resume_token": resume_token,
         "bot": state.cfg.bot_name,
+        "resumed": resumed,
+        "resume_rejected": rejected,
+        "history": history,
     });
     let _ = sender
         .send(WsMessage::Text(welcome.to_string()))
@@ -237,10 +333,32 @@ async fn handle_ws(socket: WebSocket, state: AppState) {
                     .and_then(|v| v.as_u64())
                     .unwrap_or(512) as u32;
 
+                // "stream": true → a szövegdelták "token" üzenetként mennek
+                // ki generálás közben; a záró "reply" üzenet így is megjön
+                let stream = user_msg
+                    .get("stream")
+                    .and_then(|v| v.as_bool())
+                    .unwrap_or(false);
+
+                // Opcionális kliens-azonosító: változatlanul visszamegy minden
+                // válaszüzenetben (batch kliens párosításhoz)
+                let request_id = user_msg.get("id").cloned().unwrap_or(Value::Null);
+
+                // "stateless": true → független kérés (pl. batch sor): üres
+                // előzménnyel készül, és nem kerül be a session előzményei közé
+                let stateless = user_msg
+                    .get("stateless")
+                    .and_then(|v| v.as_bool())
+                    .unwrap_or(false);
+
                 debug!("WS üzenet érkezett: session={session_id}");
 
                 // LLM kérés összeállítása
-                let llm_req = {
+                let llm_req = if stateless {
+                    state
+                        .bot
+                        .build_streaming_request(&user_text, &ChatSession::new(10), max_tokens)
+                } else {
                     let sessions = state.sessions.read().await;
                     let session = sessions.get(&session_id).unwrap();
                     state
@@ -248,31 +366,57 @@ async fn handle_ws(socket: WebSocket, state: AppState) {
                         .build_streaming_request(&user_text, session, max_tokens)
                 };
 
-                // Streaming válasz küldése
-                let mut full_reply = String::new();
-                let result = state
-                    .llm
-                    .generate_streaming(llm_req, |token| {
+                // A callback szinkron: a deltákat csatornán adja át a küldő
+                // ágnak, amely a generálással párhuzamosan továbbítja őket.
+                // A küldő a callback-kel együtt szűnik meg, így a csatorna
+                // a stream végén lezárul.
+                let (tx, mut rx) = mpsc::unbounded_channel::<String>();
+                let generation = state.llm.generate_streaming(llm_req, move |token| {
+                    let _ = tx.send(token);
+                });
+                let forward = async {
+                    let mut full_reply = String::new();
+                    let mut client_gone = false;
+                    // A válasz eleje addig gyűlik, amíg a postprocess_response
+                    // prefix-vágása el nem dönthető; utána a delták változatlanok
+                    let mut head_done = false;
+                    while let Some(token) = rx.recv().await {
                         full_reply.push_str(&token);
-                        // Tokenenként küldjük WebSocket-en
+                        if !stream || client_gone {
+                            continue;
+                        }
+                        let data = if head_done {
+                            token
+                        } else {
+                            match state.bot.strip_stream_prefix(&full_reply) {
+                                Some(text) => {
+                                    head_done = true;
+                                    text
+                                }
+                                None => continue,
+                            }
+                        };
                         let payload = json!({
                             "type": "token",
-                            "data": token,
+                            "id": request_id,
+                            "data": data,
                             "session_id": session_id,
                         });
-                        // Megjegyzés: a closure-ból nem lehet async hívás –
-                        // a tokio::spawn-t a küldő tasknál kell csinálni.
-                        // Egyszerűsített megközelítés: blokkoló channel
-                        let _ = payload; // tokent a full_reply-ba összegyűjtjük
-                    })
-                    .await;
+                        client_gone = sender
+                            .send(WsMessage::Text(payload.to_string()))
+                            .await
+                            .is_err();
+                    }
+                    full_reply
+                };
+                let (result, full_reply) = tokio::join!(generation, forward);
 
                 match result {
-                    Ok(_) => {
+                    Ok(done) => {
                         let reply = state.bot.postprocess_response(&full_reply);
 
                         // Session frissítése
-                        {
+                        if !stateless {
                             let mut sessions = state.sessions.write().await;
                             if let Some(s) = sessions.get_mut(&session_id) {
                                 s.add_message(BotMessage::user(&user_text));
@@ -282,8 +426,11 @@ async fn handle_ws(socket: WebSocket, state: AppState) {
 
                         let response = json!({
                             "type": "reply",
+                            "id": request_id,
                             "session_id": session_id,
                             "data": reply,
+                            "tokens_generated": done.tokens_generated,
+                            "finish_reason": done.finish_reason,
                         });
                         let _ = sender
                             .send(WsMessage::Text(response.to_string()))
@@ -293,6 +440,7 @@ async fn handle_ws(socket: WebSocket, state: AppState) {
                         error!("WS LLM hiba: {e}");
                         let err_msg = json!({
                             "type": "error",
+                            "id": request_id,
                             "message": e.to_string(),
                         });
                         let _ = sender
@@ -309,7 +457,106 @@ async fn handle_ws(socket: WebSocket, state: AppState) {
         }
     }
 
-    // Session cleanup
-    state.sessions.write().await.remove(&session_id);
-    info!("Session eltávolítva: {session_id}");
+    release_session(&mut *state.ws_owners.write().await, session_id, conn_id);
+
+    // Session cleanup: a türelmi idő alatt újrakapcsolódó kliens folytathatja
+    let sessions = state.sessions.clone();
+    let owners = state.ws_owners.clone();
+    tokio::spawn(async move {
+        tokio::time::sleep(Duration::from_secs(WS_RESUME_GRACE_SECS)).await;
+        let mut owners = owners.write().await;
+        if owners.get(&session_id).map(|o| o.conn_id) == Some(conn_id) {
+            owners.remove(&session_id);
+            sessions.write().await.remove(&session_id);
+            info!("Session eltávolítva: {session_id}");
+        }
+    });
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[derive(Default)]
+    struct Store {
+        owners: HashMap<Uuid, WsOwner>,
+        sessions: HashMap<Uuid, ChatSession>,
+    }
+
+    impl Store {
+        /// Új kapcsolat a megadott paraméterekkel; a birtokos adataival tér vissza.
+        fn connect(
+            &mut self,
+            session_id: Option<Uuid>,
+            resume_token: Option<Uuid>,
+        ) -> (WsOwner, Uuid, bool, Option<&'static str>) {
+            let owner = WsOwner {
+                conn_id: Uuid::new_v4(),
+                resume_token: Uuid::new_v4(),
+                live: true,
+            };
+            let params = WsParams {
+                session_id,
+                resume_token,
+            };
+            let (id, resumed, _, rejected) =
+                claim_session(&mut self.owners, &mut self.sessions, &params, owner);
+            (owner, id, resumed, rejected)
+        }
+    }
+
+    #[test]
+    fn live_session_is_not_taken_over() {
+        let mut store = Store::default();
+        let (first, id, _, _) = store.connect(None, None);
+
+        let (_, other, resumed, rejected) = store.connect(Some(id), Some(first.resume_token));
+
+        assert_eq!(rejected, Some("active"));
+        assert!(!resumed);
+        assert_ne!(other, id);
+        // Az élő kapcsolat birtokos marad, a tokenje érvényes
+        assert_eq!(store.owners[&id].conn_id, first.conn_id);
+        assert!(store.owners[&id].live);
+    }
+
+    #[test]
+    fn wrong_or_missing_token_is_refused() {
+        let mut store = Store::default();
+        let (first, id, _, _) = store.connect(None, None);
+        release_session(&mut store.owners, id, first.conn_id);
+
+        for token in [Some(Uuid::new_v4()), None] {
+            let (_, other, resumed, rejected) = store.connect(Some(id), token);
+            assert_eq!(rejected, Some("unknown"));
+            assert!(!resumed);
+            assert_ne!(other, id);
+        }
+        assert_eq!(store.owners[&id].conn_id, first.conn_id);
+
+        // Ismeretlen (pl. újraindítás előtti) session
+        let (_, _, _, rejected) = store.connect(Some(Uuid::new_v4()), Some(first.resume_token));
+        assert_eq!(rejected, Some("unknown"));
+    }
+
+    #[test]
+    fn resume_after_disconnect_rotates_the_token() {
+        let mut store = Store::default();
+        let (first, id, _, _) = store.connect(None, None);
+        release_session(&mut store.owners, id, first.conn_id);
+
+        let (second, resumed_id, resumed, rejected) =
+            store.connect(Some(id), Some(first.resume_token));
+        assert_eq!((resumed_id, resumed, rejected), (id, true, None));
+        assert_eq!(store.owners[&id].resume_token, second.resume_token);
+
+        // A régi kapcsolat késői bontása nem szabadítja fel az újat
+        release_session(&mut store.owners, id, first.conn_id);
+        assert!(store.owners[&id].live);
+
+        // A régi token a folytatással érvényét vesztette
+        release_session(&mut store.owners, id, second.conn_id);
+        let (_, _, _, rejected) = store.connect(Some(id), Some(first.resume_token));
+        assert_eq!(rejected, Some("unknown"));
+    }
 }